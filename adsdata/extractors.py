@@ -9,24 +9,45 @@ import os
 import re
 import uuid
 import json
+import time
 import errno
 import ptree
 import logging
-import httplib2
+import traceback
 from datetime import datetime
 from tempfile import NamedTemporaryFile
+from collections import defaultdict
 from multiprocessing import current_process
+from multiprocessing.pool import ThreadPool
 from lxml.html.soupparser import fromstring as soupparser
 from lxml.html import fromstring as htmlparser
 from lxml import etree
 from StringIO import StringIO
 from os.path import basename
 
-from adsdata import utils
+from adsdata import utils, fulltext_meta, fulltext_segments, pdf_rpc, http_fetch
 from entitydefs import convertentities
 
 log = logging.getLogger()
 
+def write_replace(path, contents, mtime=None):
+    """
+    use the basic write-replace method, optionally setting the mtime
+    (a datetime) of the new file
+    """
+    with NamedTemporaryFile('w', dir=os.path.dirname(path), delete=False) as tf:
+        try:
+            tf.write(contents)
+        except:
+            tf.close()
+            os.unlink(tf.name)
+            raise
+        tempname = tf.name
+    if mtime is not None:
+        ts = time.mktime(mtime.timetuple()) + mtime.microsecond / 1e6
+        os.utime(tempname, (ts, ts))
+    os.rename(tempname, path)
+
 class UnknownSourceTypeException(Exception):
     pass
 
@@ -41,7 +62,7 @@ class PdfExtractException(Exception):
 
 class Extractor():
     
-    def __init__(self, bibcode, ft_source, provider, config=False):
+    def __init__(self, bibcode, ft_source, provider, config=False, stored_meta=False):
         
         if not config:
             self.config = utils.load_config()
@@ -53,6 +74,12 @@ class Extractor():
         self.provider = provider      
         self.extract_dir = self.config['FULLTEXT_EXTRACT_PATH'] + ptree.id2ptree(bibcode)
         self.meta_path = os.path.join(self.extract_dir, 'meta.json')
+        # with a fulltext_meta store the meta lives there rather than in 
+        # meta.json; stored_meta can be passed in if it's already been fetched
+        self.meta_store = fulltext_meta.get_store(self.config)
+        if self.meta_store is not None and stored_meta is False:
+            stored_meta = self.meta_store.get(bibcode)
+        self.stored_meta = stored_meta or None
         self.source_loaded = False
         self.source_content = None
         self.dry_run = False
@@ -61,15 +88,24 @@ class Extractor():
         log.debug("%s last extracted: %s", self.bibcode, self.last_extracted)
 
     @classmethod
-    def factory(cls, bibcode, ft_source, provider, config=False):
+    def from_item(cls, ft_item, config=False):
+        """
+        the extractor for an item planned by ExtractionPlanner
+        """
+        bibcode, ft_source, provider = ft_item
+        return cls.factory(bibcode, ft_source, provider, config)
+
+    @classmethod
+    def factory(cls, bibcode, ft_source, provider, config=False, stored_meta=False):
 
+        args = (bibcode, ft_source, provider, config, stored_meta)
         if ft_source.lower().startswith('http'):
             log.debug("%s is a http fulltext record", bibcode)
-            return HttpExtractor(bibcode, ft_source, provider, config)
+            return HttpExtractor(*args)
 
         if ft_source.lower().endswith('pdf'):
             log.debug("%s is a pdf fulltext record", bibcode)
-            return PdfExtractor(bibcode, ft_source, provider, config)
+            return PdfExtractor(*args)
             # we'll need to use PDFBox-based extraction via queues eventually
             # raise PdfExtractException("PDF extraction currently disabled for %s, %s, %s", bibcode, ft_source, provider)
 
@@ -77,17 +113,17 @@ class Extractor():
             log.debug("%s is a xml fulltext record", bibcode)
             
             if provider == 'Elsevier':
-                return ElsevierExtractor(bibcode, ft_source, provider, config)
+                return ElsevierExtractor(*args)
             else:
-                return XMLExtractor(bibcode, ft_source, provider, config)
+                return XMLExtractor(*args)
 
         if ft_source.lower().endswith('html'):
             log.debug("%s is a html fulltext record" % bibcode)
-            return HtmlExtractor(bibcode, ft_source, provider, config)
+            return HtmlExtractor(*args)
 
         if ft_source.lower().endswith('txt') or ft_source.lower().endswith('ocr'):
             log.debug("%s is an ocr or plain text fulltext record" % bibcode)
-            return PlainTextExtractor(bibcode, ft_source, provider, config)
+            return PlainTextExtractor(*args)
 
         raise UnknownSourceTypeException(
             "don't know what generator class to use for %s, %s, %s", bibcode, ft_source, provider)
@@ -97,6 +133,9 @@ class Extractor():
     
     def init_path(self):
         meta = { 'ft_source': self.ft_source, 'provider': self.provider }
+        # with packed output & a meta store nothing goes in the extract dir
+        if self.meta_store is not None and fulltext_segments.get_writer(self.config) is not None:
+            return meta
         if not self.dry_run:
             try:
                 os.makedirs(self.extract_dir)
@@ -110,11 +149,21 @@ class Extractor():
                     raise
         return meta
             
+    def has_meta(self):
+        if self.meta_store is not None:
+            return self.stored_meta is not None
+        return os.path.exists(self.meta_path)
+    
     def get_meta(self):
+        if self.meta_store is not None:
+            return dict((k, self.stored_meta[k]) for k in ('ft_source', 'provider', 'index_date')
+                        if self.stored_meta.get(k) is not None)
         with open(self.meta_path, 'r') as f:
             return json.load(f)
     
     def get_last_extracted(self):
+        if self.meta_store is not None:
+            return self.stored_meta and self.stored_meta['last_extracted']
         try:
             return utils.mod_time(self.meta_path)
         except OSError, e:
@@ -122,7 +171,7 @@ class Extractor():
                 return None
             raise
 
-    def needs_extraction(self, force_older_than=None):
+    def needs_extraction(self, force_older_than=None, check_source=True):
 
         if self.last_extracted is None:
             log.debug("extracting %s because last_extracted unknown", self.bibcode)
@@ -145,7 +194,7 @@ class Extractor():
             return True
 
         # check freshness of fulltext source
-        if self.content_is_stale():
+        if check_source and self.content_is_stale():
             log.debug("extracting %s because meta is older than source", self.bibcode)
             return True
 
@@ -155,6 +204,12 @@ class Extractor():
     def content_is_stale(self):
         raise NotImplementedError()
     
+    def source_mtime(self):
+        """
+        the mtime of the source, if it's a file
+        """
+        return None
+    
     def load_source(self):
         raise NotImplementedError()
     
@@ -166,28 +221,45 @@ class Extractor():
         log.debug("writing %s contents to %s", field, cpath)
         self.write_file(cpath, text.encode('utf-8'))
     
-    def write_meta(self, meta):
-        log.debug("writing %s meta to %s", self.bibcode, self.meta_path)
-        self.write_file(self.meta_path, json.dumps(meta))
+    def write_meta(self, meta, last_extracted=None):
+        if self.dry_run:
+            log.debug("not writing %s meta (dry run)", self.bibcode)
+            return
+        stored = self.meta_writer(meta, last_extracted)()
+        if self.meta_store is not None:
+            self.stored_meta = stored
         
-    def write_file(self, path, contents):
+    def meta_writer(self, meta, last_extracted=None):
         """
-        use the basic write-replace method 
+        a callable that writes meta, recording the record as extracted at
+        last_extracted (or now) from the source as it is now. It holds on
+        to those values and nothing else of the extractor, so the source 
+        can be freed while it waits to be called (see extract()).
         """
+        meta_store, meta_path, bibcode = self.meta_store, self.meta_path, self.bibcode
+        meta = dict(meta)
+        last_extracted = last_extracted or datetime.now()
+        source_mtime = self.source_mtime()
+        def write():
+            if meta_store is not None:
+                log.debug("storing %s meta in %s", bibcode, meta_store.path)
+                stored = dict(meta, last_extracted=last_extracted, source_mtime=source_mtime)
+                meta_store.put(bibcode, stored)
+                return stored
+            log.debug("writing %s meta to %s", bibcode, meta_path)
+            write_replace(meta_path, json.dumps(meta), mtime=last_extracted)
+            return meta
+        return write
+        
+    def write_file(self, path, contents):
         if self.dry_run:
             return
-        with NamedTemporaryFile('w', dir=self.extract_dir, delete=False) as tf:
-            try:
-                tf.write(contents)
-            except:
-                tf.close()
-                os.unlink(tf.name)
-                raise
-            tempname = tf.name
-        os.rename(tempname, path)
+        write_replace(path, contents)
         
     def extract(self, clobber=False):
-        if not os.path.exists(self.meta_path):
+        # anything that changes the source from here on gets extracted next time
+        started = datetime.now()
+        if not self.has_meta():
             log.debug("initializing meta path for %s", self.bibcode)
             meta = self.init_path()
         else:
@@ -199,14 +271,18 @@ class Extractor():
             log.debug("Nothing extracted")
             return
 
+        segments = fulltext_segments.get_writer(self.config)
         record_updated = False
+        written = {}
         try:
             for field, text in contents.items():
                 
                 if not len(text) and not clobber:
                     log.debug("%s contents empty; not writing to disk" % field)
                     continue
-                self.write_contents(field, text)
+                if segments is None:
+                    self.write_contents(field, text)
+                written[field] = text
                 record_updated = True
             if record_updated:
                 if 'index_date' not in meta:
@@ -214,7 +290,12 @@ class Extractor():
                 # these values might have changed
                 meta['ft_source'] = self.ft_source
                 meta['provider'] = self.provider
-                self.write_meta(meta)
+                if segments is None:
+                    self.write_meta(meta, started)
+                elif not self.dry_run:
+                    # the meta is only written once the segment is committed
+                    # so the record gets extracted again if that never happens
+                    segments.append(self.bibcode, written, on_commit=self.meta_writer(meta, started))
         except Exception, e:
             log.error("Error writing extracted contents to disk for %s: %s", self.bibcode, str(e))
             raise
@@ -223,43 +304,86 @@ class Extractor():
     
 class HttpExtractor(Extractor):
 
+    def __init__(self, *args):
+        Extractor.__init__(self, *args)
+        self.validators = None
+        # set by load_sources()
+        self.not_modified = False
+        self.fetch_error = None
+
     def content_is_stale(self):
         self.load_source(only_if_modified = True)
         return self.source_loaded
 
     def load_source(self, only_if_modified = False):
-        """fetch fulltext over http, optionally
-        using an if-modified-since header to control
-        re-extraction of unchanged content
+        """fetch fulltext over http, optionally as a conditional 
+        request to control re-extraction of unchanged content
         """
-        req_headers = {'User-Agent': 'ADSClient', 'Accept': 'text/plain'}
+        fetcher = http_fetch.get_fetcher(self.config)
+        self.set_response(fetcher.fetch(self.ft_source, only_if_modified, self.last_extracted))
 
-        if only_if_modified:
-            if self.last_extracted is not None:
-                last_extracted_str = self.last_extracted.strftime('%a, %d %b %Y %H:%M:%S %Z')
-                log.debug("setting if-modified-since: %s" % last_extracted_str)
-                req_headers['If-Modified-Since'] = last_extracted_str
-
-        http = httplib2.Http()
-        (resp_headers, resp) = http.request(
-            self.ft_source, method="GET", 
-            headers=req_headers)
-
-        if resp_headers['status'] == '200':
-            self.source_content = resp
+    def set_response(self, response):
+        if response.status == 200:
+            self.source_content = response.content
             self.source_loaded = True
-        elif resp_headers['status'] != '304':
-            log.error("http response status: %s" % resp_headers['status'])
+            self.validators = response.validators
+        elif response.status != 304:
+            log.error("http response status: %s" % response.status)
             raise FulltextSourceNotFound("no content found at %s" % self.ft_source)
 
+    @classmethod
+    def load_sources(cls, extractors, config, force=False, force_older_than=None):
+        """
+        fetch the sources of many HttpExtractors at once. Unless something
+        else already calls for extraction the requests are conditional, and 
+        the extractors whose source hasn't changed get not_modified set; any
+        that fail get the error in fetch_error.
+        """
+        conditional = [not force and not x.needs_extraction(force_older_than, check_source=False)
+                       for x in extractors]
+        since = [x.last_extracted for x in extractors]
+        fetcher = http_fetch.get_fetcher(config)
+        results = fetcher.fetch_many([x.ft_source for x in extractors], conditional, since)
+        for ext, (response, error) in zip(extractors, results):
+            try:
+                if error is not None:
+                    raise FulltextSourceNotFound(error)
+                if response.status == 304:
+                    log.debug("%s not modified since %s", ext.ft_source, ext.last_extracted)
+                    ext.not_modified = True
+                else:
+                    ext.set_response(response)
+            except FulltextSourceNotFound, e:
+                log.debug("fetching %s failed: %s", ext.ft_source, e)
+                ext.fetch_error = str(e)
+
+    def meta_writer(self, meta, last_extracted=None):
+        write = Extractor.meta_writer(self, meta, last_extracted)
+        fetcher, url, validators = http_fetch.get_fetcher(self.config), self.ft_source, self.validators
+        def write_and_save_validators():
+            stored = write()
+            # only now can a 304 be taken to mean there's nothing new
+            fetcher.save_validators(url, validators)
+            return stored
+        return write_and_save_validators
+
     def get_contents(self):
         if not self.source_loaded:
+            # don't download again what load_sources() couldn't
+            if self.fetch_error is not None:
+                raise FulltextSourceNotFound(self.fetch_error)
             self.load_source()
 
         return { 'fulltext' : utils.text_cleanup(self.source_content, translate=True, decode=True) }
 
 class FileBasedExtractor(Extractor):
 
+    def source_mtime(self):
+        try:
+            return utils.mod_time(self.ft_source)
+        except OSError:
+            return None
+
     def content_is_stale(self):
         """
         compares the mod time of the record's meta file vs. the mod time
@@ -294,47 +418,17 @@ class PlainTextExtractor(FileBasedExtractor):
 
 class PdfExtractor(FileBasedExtractor):
     
-    def _on_response(self, ch, method, props, body):
+    def load_source(self):
         """
-        callback method that consumes responses from the extraction workers
+        extract the text with the PDFBox workers, via the process's shared 
+        pdf_rpc client. To have many PDFs in flight use the client's submit()
+        and pass the reply to set_source().
         """
-        log.debug("got response for %s on %s", self.bibcode, method.routing_key)
-        if props.type == 'exception':
-            raise PdfExtractException(body)
-        self.source_content = body
-            
-    def load_source(self):
-        import pika 
-        
-        if 'RABBITMQ_PDF_QUEUE' in os.environ:
-            pdf_queue_name = os.environ['RABBITMQ_PDF_QUEUE']
-        else:
-            pdf_queue_name = self.config['RABBITMQ_PDF_QUEUE']
-        if 'RABBITMQ_EXCHANGE' in self.config:
-            exchange = self.config['RABBITMQ_EXCHANGE']
-        else:
-            exchange = ''
+        self.set_source(pdf_rpc.get_client(self.config).call(self.bibcode, self.ft_source))
 
-        self.channel = utils.rabbitmq_channel()
-
-        res = self.channel.queue_declare(auto_delete=True)
-        
-        callback_queue = res.method.queue
-        log.debug("created callback_queue: %s" % callback_queue)
-        self._consumer_tag = self.channel.basic_consume(self._on_response, no_ack=True, queue=callback_queue)
-        log.debug("queueing %s for pdf extraction on %s", self.bibcode, pdf_queue_name)
-        msg = json.dumps({ 'bibcode': self.bibcode, 'ft_source': self.ft_source })
-        properties = pika.BasicProperties(reply_to=callback_queue)
-        self.channel.basic_publish(exchange=exchange,
-                                   routing_key=pdf_queue_name,
-                                   properties=properties,
-                                   body=msg)
-
-        log.debug("waiting for responses...")
-        while self.source_content is None:
-            self.channel.connection.process_data_events()
-            
-        
+    def set_source(self, body):
+        self.source_content = body
+        self.source_loaded = True
         
     def get_contents(self):
         if not self.source_loaded:
@@ -482,6 +576,12 @@ class HtmlExtractor(FileBasedExtractor):
                 return True
         return False
     
+    def source_mtime(self):
+        try:
+            return max(utils.mod_time(sf) for sf in re.split('\s*,\s*', self.ft_source))
+        except OSError:
+            return None
+    
     def parse_html(self, file):
         html = open(file, 'r').read()
         html = html.decode('utf-8', 'ignore')
@@ -561,5 +661,68 @@ class HtmlExtractor(FileBasedExtractor):
         body = self.parse_article_text() 
         return { 'fulltext' : utils.text_cleanup(body) }
 
-
+class ExtractionPlanner(object):
+    """
+    Works out which (bibcode, ft_source, provider) items need extracting
+    before any extraction starts so only those get handed to the extraction
+    workers. The checks are all I/O -- stats of the source & meta files and
+    meta.json reads -- so they run in a pool of threads. Http sources are
+    always planned: checking one takes a request, so the workers do that 
+    with a conditional GET of each chunk's sources and skip the ones that
+    haven't changed. With a fulltext_meta store the stored meta of each 
+    chunk of items is read with a single query up front.
     
+    After plan(), stats has counts of 'planned', 'skipped' and 'exceptions'.
+    """
+    def __init__(self, threads=16, force=False, force_older_than=None, config=False):
+        self.threads = threads
+        self.force = force
+        self.force_older_than = force_older_than
+        self.config = config or utils.load_config()
+        self.stats = defaultdict(int)
+
+    def check(self, ft_item, stored_meta=False):
+        """
+        returns a (status, item, error) tuple for a single item
+        """
+        try:
+            bibcode, ft_source, provider = ft_item
+            if self.force:
+                return 'planned', ft_item, None
+            ext = Extractor.factory(bibcode, ft_source, provider, self.config, stored_meta)
+            if isinstance(ext, HttpExtractor):
+                # the workers make the conditional request, so the source 
+                # is only downloaded once if it has changed
+                return 'planned', ft_item, None
+            if not ext.needs_extraction(self.force_older_than):
+                return 'skipped', ft_item, None
+            return 'planned', ft_item, None
+        except Exception:
+            return 'exceptions', ft_item, traceback.format_exc()
+
+    def plan(self, items, chunk_size=1000):
+        """
+        the items that need extracting, in input order
+        """
+        planned = []
+        store = fulltext_meta.get_store(self.config)
+        pool = ThreadPool(self.threads)
+        try:
+            for chunk in utils.chunked(items, chunk_size):
+                if store is not None and not self.force:
+                    stored = store.get_many(x[0] for x in chunk if len(x))
+                    checks = [(x, stored.get(x[0]) if len(x) else False) for x in chunk]
+                else:
+                    checks = [(x, False) for x in chunk]
+                for status, ft_item, error in pool.imap(lambda args: self.check(*args), checks):
+                    self.stats[status] += 1
+                    if error:
+                        log.error("something went wrong checking %s: %s", ft_item[0], error)
+                    elif status == 'planned':
+                        planned.append(ft_item)
+        finally:
+            pool.close()
+            pool.join()
+        log.info("planned %d items for extraction, %d up to date, %d exceptions",
+                 self.stats.get('planned', 0), self.stats.get('skipped', 0), self.stats.get('exceptions', 0))
+        return planned
@@ -0,0 +1,142 @@
+'''
+A single-file store of fulltext extraction metadata, as an alternative to
+the meta.json file kept in each bibcode's extraction directory. Finding out
+what needs extracting then takes a few indexed queries rather than a stat
+and a read of one small file per bibcode.
+
+Enabled by setting FULLTEXT_META_DB to the path of an sqlite database,
+which should be on a local disk. Existing meta.json files can be copied in
+with `scripts/init_fulltext_meta.py migrate`.
+
+For each bibcode the store holds the meta.json values (ft_source, provider,
+index_date) along with when the record was last extracted and the mtime of
+its source at that time; these last two are datetimes in local time, as
+returned by utils.mod_time().
+'''
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+
+log = logging.getLogger()
+
+FIELDS = ['ft_source', 'provider', 'index_date', 'last_extracted', 'source_mtime']
+TIME_FIELDS = ['last_extracted', 'source_mtime']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    bibcode TEXT PRIMARY KEY,
+    ft_source TEXT,
+    provider TEXT,
+    index_date TEXT,
+    last_extracted REAL,
+    source_mtime REAL
+)
+"""
+
+def to_timestamp(value):
+    if isinstance(value, datetime):
+        return time.mktime(value.timetuple()) + value.microsecond / 1e6
+    return value
+
+def from_timestamp(value):
+    if value is None:
+        return None
+    return datetime.fromtimestamp(value)
+
+class MetaStore(object):
+    """
+    Fulltext metadata keyed by bibcode; get() returns a dict of FIELDS or
+    None. Safe to share between threads, not between processes; see
+    get_store().
+    """
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.conn.text_factory = str
+        with self.lock:
+            self.conn.execute(SCHEMA)
+            self.conn.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM meta").fetchone()[0]
+
+    def row_meta(self, row):
+        meta = dict(zip(FIELDS, row))
+        for field in TIME_FIELDS:
+            meta[field] = from_timestamp(meta[field])
+        return meta
+
+    def get(self, bibcode):
+        return self.get_many([bibcode]).get(bibcode)
+
+    def get_many(self, bibcodes, chunk_size=500):
+        """
+        the metadata of any of bibcodes that have some, keyed by bibcode
+        """
+        bibcodes = list(set(bibcodes))
+        found = {}
+        sql = "SELECT bibcode, %s FROM meta WHERE bibcode IN (%%s)" % ', '.join(FIELDS)
+        with self.lock:
+            for i in xrange(0, len(bibcodes), chunk_size):
+                chunk = bibcodes[i:i + chunk_size]
+                for row in self.conn.execute(sql % ', '.join('?' * len(chunk)), chunk):
+                    found[row[0]] = self.row_meta(row[1:])
+        return found
+
+    def put(self, bibcode, meta):
+        self.put_many([(bibcode, meta)])
+
+    def put_many(self, rows, replace=True):
+        """
+        store (bibcode, meta) pairs; any existing metadata of a bibcode is
+        replaced, or left alone if replace is False
+        """
+        sql = "INSERT OR %s INTO meta (bibcode, %s) VALUES (?, %s)" % (
+            replace and 'REPLACE' or 'IGNORE', ', '.join(FIELDS), ', '.join('?' * len(FIELDS)))
+        values = []
+        for bibcode, meta in rows:
+            values.append([bibcode] + [to_timestamp(meta.get(field)) if field in TIME_FIELDS else meta.get(field)
+                                       for field in FIELDS])
+        with self.lock:
+            self.conn.executemany(sql, values)
+            self.conn.commit()
+        return len(values)
+
+    def delete_many(self, bibcodes, chunk_size=500):
+        """
+        removes the metadata of bibcodes; returns the number of rows removed
+        """
+        bibcodes = list(set(bibcodes))
+        count = 0
+        with self.lock:
+            for i in xrange(0, len(bibcodes), chunk_size):
+                chunk = bibcodes[i:i + chunk_size]
+                cur = self.conn.execute("DELETE FROM meta WHERE bibcode IN (%s)" % ', '.join('?' * len(chunk)), chunk)
+                count += cur.rowcount
+            self.conn.commit()
+        return count
+
+    def close(self):
+        self.conn.close()
+
+_stores = {}
+
+def get_store(config):
+    """
+    the MetaStore configured as FULLTEXT_META_DB, or None. Each process
+    gets its own connection.
+    """
+    path = config.get('FULLTEXT_META_DB')
+    if not path:
+        return None
+    key = (os.getpid(), path)
+    if key not in _stores:
+        log.debug("opening fulltext meta store %s", path)
+        _stores[key] = MetaStore(path)
+    return _stores[key]
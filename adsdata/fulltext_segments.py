@@ -0,0 +1,240 @@
+'''
+Packed storage of extracted fulltext, as an alternative to writing a .txt
+file per field into each bibcode's extraction directory.
+
+Extracted records are appended to a segment file, each one compressed on
+its own so it can be read back without the rest of the segment. Once a
+segment reaches FULLTEXT_SEGMENT_SIZE bytes, or its writer is closed, it is
+committed: an index of its bibcodes is written alongside it (a
+membership.CountTable of record offsets) and it is renamed into place, so
+readers only ever see complete segments. Segments are named by commit time
+and a record in a newer segment replaces any of the same bibcode in older
+ones. A deleted bibcode gets a tombstone record, with null contents, that 
+hides its older records.
+
+Enabled by setting FULLTEXT_SEGMENT_PATH to the directory the segments
+should go in.
+
+Usage:
+
+    store = SegmentStore(path)
+    store.get(bibcode)                     # {'fulltext': ..., ...} or None
+    for bibcode, contents in store.records():
+        ...
+'''
+
+import os
+import glob
+import json
+import time
+import zlib
+import socket
+import struct
+import logging
+import tempfile
+import traceback
+
+from adsdata import membership
+
+log = logging.getLogger()
+
+# bibcode length, compressed contents length
+RECORD = struct.Struct('<HI')
+SEGMENT_SIZE = 256 * 1024 * 1024
+# record offsets are stored as int32s
+MAX_OFFSET = 2 ** 31 - 1
+
+def to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+class SegmentWriter(object):
+    """
+    Appends records to a segment, committing it once it's segment_size
+    bytes. Callbacks passed to append() are called once the record has been
+    committed. Not thread safe; use one per process (see get_writer()).
+    """
+    def __init__(self, path, segment_size=SEGMENT_SIZE, bloom_bits_per_key=10):
+        self.path = path
+        self.segment_size = min(segment_size, MAX_OFFSET)
+        self.bloom_bits_per_key = bloom_bits_per_key
+        self.file = None
+
+    def open(self):
+        fd, self.tmp_path = tempfile.mkstemp(dir=self.path, suffix='.seg.tmp')
+        self.file = os.fdopen(fd, 'wb')
+        self.offsets = {}
+        self.callbacks = []
+
+    def append(self, bibcode, contents, on_commit=None):
+        if self.file is None:
+            self.open()
+        key = to_bytes(bibcode)
+        payload = zlib.compress(json.dumps(contents))
+        # a later record of the same bibcode in the segment replaces the earlier one
+        self.offsets[key] = self.file.tell()
+        self.file.write(RECORD.pack(len(key), len(payload)))
+        self.file.write(key)
+        self.file.write(payload)
+        if on_commit is not None:
+            self.callbacks.append(on_commit)
+        if self.file.tell() >= self.segment_size:
+            self.commit()
+
+    def delete(self, bibcode):
+        """
+        appends a tombstone for bibcode
+        """
+        self.append(bibcode, None)
+
+    def commit(self):
+        """
+        makes the open segment, if any, visible to readers
+        """
+        if self.file is None:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        name = os.path.join(self.path, '%d-%s-%d' % (time.time() * 1e6, socket.gethostname(), os.getpid()))
+        try:
+            index = membership.CountTable.build(name + '.tab', sorted(self.offsets.iteritems()),
+                                                bloom_bits_per_key=self.bloom_bits_per_key)
+            index.close()
+            os.chmod(self.tmp_path, 0644)
+            os.rename(self.tmp_path, name + '.seg')
+        except:
+            os.remove(self.tmp_path)
+            raise
+        log.debug("committed fulltext segment %s of %d records", name, len(self.offsets))
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                log.error("fulltext segment commit callback failed: %s", traceback.format_exc())
+
+    def close(self):
+        self.commit()
+
+class Segment(object):
+    """
+    a committed segment and its index
+    """
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)[:-len('.seg')]
+        self.index = membership.CountTable(path[:-len('.seg')] + '.tab')
+        self.file = open(path, 'rb')
+
+    def read(self, offset):
+        """
+        the (bibcode, contents) of the record at offset
+        """
+        self.file.seek(offset)
+        key_len, payload_len = RECORD.unpack(self.file.read(RECORD.size))
+        key = self.file.read(key_len)
+        return key, json.loads(zlib.decompress(self.file.read(payload_len)))
+
+    def scan(self):
+        """
+        (offset, bibcode, compressed contents) of every record, in order
+        """
+        with open(self.path, 'rb') as f:
+            offset = 0
+            while True:
+                header = f.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break
+                key_len, payload_len = RECORD.unpack(header)
+                key = f.read(key_len)
+                yield offset, key, f.read(payload_len)
+                offset += RECORD.size + key_len + payload_len
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+class SegmentStore(object):
+    """
+    read access to the committed segments in path; see the module docstring
+    """
+    def __init__(self, path):
+        self.path = path
+        self.segments = []
+        self.refresh()
+
+    def refresh(self):
+        """
+        picks up any segments committed since the last look
+        """
+        known = dict((s.path, s) for s in self.segments)
+        segments = []
+        for path in sorted(glob.glob(os.path.join(self.path, '*.seg'))):
+            segment = known.get(path)
+            if segment is None:
+                segment = Segment(path)
+            segments.append(segment)
+        self.segments = segments
+
+    def locate(self, bibcode):
+        """
+        the (segment, offset) of the latest record of bibcode, or None
+        """
+        for segment in reversed(self.segments):
+            offset = segment.index.get(bibcode)
+            if offset is not None:
+                return segment, offset
+        return None
+
+    def get(self, bibcode):
+        """
+        the extracted contents of bibcode as a dict of field: text, or None
+        if there are none or it has been deleted
+        """
+        found = self.locate(bibcode)
+        if found is None:
+            return None
+        segment, offset = found
+        return segment.read(offset)[1]
+
+    def records(self):
+        """
+        (bibcode, contents) of the latest record of every bibcode that
+        hasn't been deleted, reading the segments sequentially
+        """
+        for segment in self.segments:
+            for offset, bibcode, payload in segment.scan():
+                if self.locate(bibcode) == (segment, offset):
+                    contents = json.loads(zlib.decompress(payload))
+                    if contents is not None:
+                        yield bibcode, contents
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+_writers = {}
+
+def get_writer(config):
+    """
+    this process's SegmentWriter for FULLTEXT_SEGMENT_PATH, or None if
+    packed output isn't configured
+    """
+    path = config.get('FULLTEXT_SEGMENT_PATH')
+    if not path:
+        return None
+    key = (os.getpid(), path)
+    if key not in _writers:
+        _writers[key] = SegmentWriter(path, config.get('FULLTEXT_SEGMENT_SIZE') or SEGMENT_SIZE)
+    return _writers[key]
+
+def close_writers():
+    """
+    commits & forgets this process's writers
+    """
+    for key in [k for k in _writers if k[0] == os.getpid()]:
+        _writers.pop(key).close()
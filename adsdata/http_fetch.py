@@ -0,0 +1,204 @@
+'''
+Fetching of http fulltext sources for extraction.
+
+An HttpFetcher keeps a small pool of httplib2.Http objects per host, so
+connections are kept alive and reused, and limits the rate at which each
+host is hit. Both limits are per fetcher, i.e. per process; get_fetcher()
+can split the configured limits between a number of processes, but gives
+each at least one connection per host, so the connection limit only holds
+for as many processes as it allows connections. 
+
+If FULLTEXT_HTTP_VALIDATORS_DB is set, the ETag and Last-Modified 
+validators of what was last extracted from each url are kept in that
+sqlite db, which all processes share, so staleness checks are conditional
+GETs that usually come back 304. Without it staleness checks fall back to
+If-Modified-Since the last extraction. fetch_many() fetches a list of urls
+with a pool of threads.
+
+Validators are only saved by save_validators(), which the extractor calls
+once what it fetched has been written, so a failed extraction doesn't make
+the next check come back 304.
+'''
+
+import os
+import time
+import Queue
+import sqlite3
+import logging
+import httplib2
+import threading
+import traceback
+from urlparse import urlparse
+from email.utils import formatdate
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger()
+
+USER_AGENT = 'ADSClient'
+CONNECTIONS_PER_HOST = 4
+THREADS = 8
+TIMEOUT = 60
+
+FetchResult = namedtuple('FetchResult', ['status', 'content', 'validators'])
+
+def http_date(dt):
+    """
+    a naive local datetime as an HTTP-date
+    """
+    return formatdate(time.mktime(dt.timetuple()), usegmt=True)
+
+class ValidatorStore(object):
+    """
+    the ETag/Last-Modified validators of each url; thread safe
+    """
+    def __init__(self, path=':memory:', timeout=60):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.conn.text_factory = str
+        with self.lock:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS validators "
+                              "(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT)")
+            self.conn.commit()
+
+    def get(self, url):
+        with self.lock:
+            row = self.conn.execute("SELECT etag, last_modified FROM validators WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        return {'etag': row[0], 'last_modified': row[1]}
+
+    def put(self, url, validators):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO validators (url, etag, last_modified) VALUES (?, ?, ?)",
+                              (url, validators.get('etag'), validators.get('last_modified')))
+            self.conn.commit()
+
+class HostLimiter(object):
+    """
+    spaces out requests to a host to at most rate per second
+    """
+    def __init__(self, rate=0):
+        self.interval = rate and 1.0 / rate or 0
+        self.lock = threading.Lock()
+        self.next_slot = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+class HttpFetcher(object):
+    """
+    See the module docstring. Safe to use from many threads; at most
+    connections_per_host requests are made to a host at once. Validators
+    are only used if there's a ValidatorStore to keep them in.
+    """
+    def __init__(self, validators=None, rate=0, connections_per_host=CONNECTIONS_PER_HOST,
+                 threads=THREADS, timeout=TIMEOUT):
+        self.validators = validators
+        self.rate = rate
+        self.connections_per_host = connections_per_host
+        self.threads = threads
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pools = {}
+        self.limiters = {}
+        self.thread_pool = None
+
+    def host_pool(self, host):
+        with self.lock:
+            if host not in self.pools:
+                pool = Queue.Queue()
+                for i in xrange(self.connections_per_host):
+                    pool.put(httplib2.Http(timeout=self.timeout))
+                self.pools[host] = pool
+                self.limiters[host] = HostLimiter(self.rate)
+            return self.pools[host], self.limiters[host]
+
+    def request_headers(self, url, conditional=False, since=None):
+        headers = {'User-Agent': USER_AGENT, 'Accept': 'text/plain'}
+        if not conditional:
+            return headers
+        validators = self.validators is not None and self.validators.get(url)
+        if validators:
+            if validators['etag']:
+                headers['If-None-Match'] = validators['etag']
+            if validators['last_modified']:
+                headers['If-Modified-Since'] = validators['last_modified']
+        elif since is not None:
+            headers['If-Modified-Since'] = http_date(since)
+        return headers
+
+    def fetch(self, url, conditional=False, since=None):
+        """
+        GET url, as a conditional request with its stored validators, or if
+        there are none modified since the since datetime, if conditional
+        """
+        headers = self.request_headers(url, conditional, since)
+        pool, limiter = self.host_pool(urlparse(url).netloc)
+        http = pool.get()
+        try:
+            limiter.wait()
+            log.debug("fetching %s with %s", url, headers)
+            resp, content = http.request(url, method="GET", headers=headers)
+        finally:
+            pool.put(http)
+        validators = {'etag': resp.get('etag'), 'last_modified': resp.get('last-modified')}
+        return FetchResult(resp.status, content, validators)
+
+    def fetch_many(self, urls, conditional=False, since=None):
+        """
+        fetches urls with a pool of threads; conditional and since are as
+        for fetch(), either one value for all the urls or a list with one 
+        per url. Returns a (FetchResult, error) pair for each url, in order
+        """
+        if not isinstance(conditional, list):
+            conditional = [conditional] * len(urls)
+        if not isinstance(since, list):
+            since = [since] * len(urls)
+        def fetch(args):
+            url = args[0]
+            try:
+                return self.fetch(*args), None
+            except Exception:
+                log.debug("fetching %s failed: %s", url, traceback.format_exc())
+                return None, traceback.format_exc()
+        with self.lock:
+            if self.thread_pool is None:
+                self.thread_pool = ThreadPool(self.threads)
+        return self.thread_pool.map(fetch, zip(urls, conditional, since))
+
+    def save_validators(self, url, validators):
+        if self.validators is not None and validators and (validators.get('etag') or validators.get('last_modified')):
+            self.validators.put(url, validators)
+
+_fetchers = {}
+
+def get_fetcher(config, processes=1):
+    """
+    this process's HttpFetcher, configured by the FULLTEXT_HTTP_* settings.
+    If it's one of processes fetching at the same time it gets its share
+    of the rate & connection limits, though at least one connection per 
+    host, so with more processes than connections the connection limit is
+    exceeded. Only the first call in a process creates the fetcher.
+    """
+    pid = os.getpid()
+    if pid not in _fetchers:
+        path = config.get('FULLTEXT_HTTP_VALIDATORS_DB')
+        connections = int(config.get('FULLTEXT_HTTP_CONNECTIONS') or CONNECTIONS_PER_HOST)
+        if processes > connections:
+            log.warning("%d processes fetching with one connection each exceed the limit "
+                        "of %d connections per host", processes, connections)
+        _fetchers[pid] = HttpFetcher(
+            ValidatorStore(path) if path else None,
+            rate=float(config.get('FULLTEXT_HTTP_RATE') or 0) / processes,
+            connections_per_host=max(1, connections / processes),
+            threads=int(config.get('FULLTEXT_HTTP_THREADS') or THREADS))
+    return _fetchers[pid]
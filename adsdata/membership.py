@@ -0,0 +1,215 @@
+'''
+Compact, read-only membership indexes for "is this bibcode in collection X"
+checks that would otherwise cost a mongo round trip each.
+
+An index file holds the sorted keys as fixed-width, NUL-padded records which
+are searched with a binary search over an mmap of the file, so the pages are
+shared by every process that opens it. Optionally a Bloom filter is stored as
+well to answer most misses without the search. Each index carries a stamp
+(the collection's DataLoadTime) and get_index() rebuilds it when that changes.
+
+A CountTable is the same thing with an int32 value stored for each key.
+'''
+
+import os
+import mmap
+import shutil
+import struct
+import hashlib
+import logging
+import tempfile
+from math import log as ln
+
+log = logging.getLogger()
+
+MAGIC = 'ADSMIDX1'
+VALUE = struct.Struct('<i')
+# magic, key width, key count, bloom filter bits, bloom filter hashes, stamp
+HEADER = struct.Struct('<8sIQQI32s')
+
+class MembershipIndex(object):
+    """
+    supports `key in index` and len(index)
+    """
+    magic = MAGIC
+    has_values = False
+    
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.width, self.count, self.bloom_bits, self.bloom_hashes, stamp = \
+            HEADER.unpack(self.mmap[:HEADER.size])
+        if magic != self.magic:
+            raise ValueError("%s is not a %s" % (path, self.__class__.__name__))
+        self.stamp = stamp.rstrip('\0')
+        self.offset = HEADER.size
+        self.bloom_offset = self.offset + self.width * self.count
+        self.values_offset = self.bloom_offset + ((self.bloom_bits + 7) >> 3)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        return self.position(key) >= 0
+    
+    def position(self, key):
+        """
+        the position of key in the sorted keys, or -1
+        """
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        if len(key) > self.width or not self.count:
+            return -1
+        if self.bloom_bits:
+            for bit in bloom_bits(key, self.bloom_bits, self.bloom_hashes):
+                byte = ord(self.mmap[self.bloom_offset + (bit >> 3)])
+                if not byte & (1 << (bit & 7)):
+                    return -1
+        key = key.ljust(self.width, '\0')
+        data, width, offset = self.mmap, self.width, self.offset
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = offset + mid * width
+            k = data[start:start + width]
+            if k < key:
+                lo = mid + 1
+            elif k > key:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def close(self):
+        self.mmap.close()
+
+    @classmethod
+    def build(cls, path, keys, stamp='', bloom_bits_per_key=0):
+        """
+        write an index of keys, which must be sorted, to path. The file is
+        written under a temporary name and then moved into place so readers
+        never see a partial index. For tables with values, keys are 
+        (key, value) pairs.
+        """
+        dirname = os.path.dirname(os.path.abspath(path))
+        # first pass to find the key width & count
+        with tempfile.TemporaryFile(dir=dirname) as spool, \
+                tempfile.TemporaryFile(dir=dirname) as values:
+            width = count = 0
+            last = None
+            for key in keys:
+                if cls.has_values:
+                    key, value = key
+                if isinstance(key, unicode):
+                    key = key.encode('utf-8')
+                if last is not None and key <= last:
+                    if key == last:
+                        continue
+                    raise ValueError("keys for %s are not sorted: %r after %r" % (path, key, last))
+                spool.write(key + '\n')
+                if cls.has_values:
+                    values.write(VALUE.pack(value))
+                width = max(width, len(key))
+                count += 1
+                last = key
+
+            bits = hashes = 0
+            if bloom_bits_per_key and count:
+                bits = count * bloom_bits_per_key
+                hashes = max(1, int(round(bloom_bits_per_key * ln(2))))
+            bloom = bytearray((bits + 7) >> 3)
+
+            fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as out:
+                    out.write(HEADER.pack(cls.magic, width, count, bits, hashes, stamp[:32]))
+                    spool.seek(0)
+                    for line in spool:
+                        key = line[:-1]
+                        out.write(key.ljust(width, '\0'))
+                        for bit in bloom_bits(key, bits, hashes):
+                            bloom[bit >> 3] |= 1 << (bit & 7)
+                    out.write(str(bloom))
+                    values.seek(0)
+                    shutil.copyfileobj(values, out)
+                os.chmod(tmp_path, 0644)
+                os.rename(tmp_path, path)
+            except:
+                os.remove(tmp_path)
+                raise
+        log.info("built %s %s of %d keys", cls.__name__, path, count)
+        return cls(path)
+
+class CountTable(MembershipIndex):
+    """
+    a MembershipIndex with an int32 count for each key; get() works like
+    dict.get(). Build from sorted (key, count) pairs.
+    """
+    magic = 'ADSCTAB1'
+    has_values = True
+    
+    def get(self, key, default=None):
+        i = self.position(key)
+        if i < 0:
+            return default
+        start = self.values_offset + i * VALUE.size
+        return VALUE.unpack(self.mmap[start:start + VALUE.size])[0]
+
+def bloom_bits(key, bits, hashes):
+    """
+    the bloom filter bit positions for key (double hashing)
+    """
+    if not hashes:
+        return []
+    h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+    return [(h1 + i * h2) % bits for i in xrange(hashes)]
+
+def sorted_ids(collection):
+    """
+    the _id values of a mongo collection in sorted order
+    """
+    cursor = collection.find({}, {'_id': 1}, manipulate=False).sort('_id', 1).batch_size(10000)
+    return (x['_id'] for x in cursor)
+
+def file_keys(data_file):
+    """
+    the distinct first column values of a sorted, tab-delimited data file
+    """
+    last = None
+    with open(data_file, 'r') as f:
+        for line in f:
+            # split the same way DataFileCollection.read_groups() does
+            if not line.rstrip('\r\n'):
+                continue
+            key = line.split('\t', 1)[0].rstrip('\r\n')
+            if key != last:
+                yield key
+                last = key
+
+_indexes = {}
+
+def get_index(index_dir, name, stamp, keys, bloom_bits_per_key=0, index_class=MembershipIndex):
+    """
+    returns the index called name in index_dir, (re)building it from the
+    iterable returned by keys() if it's missing or its stamp doesn't match.
+    Open indexes are cached for the life of the process.
+    """
+    path = os.path.join(index_dir, name + (index_class.has_values and '.tab' or '.idx'))
+    stamp = stamp[:32]
+    index = _indexes.get(path)
+    if index is not None and index.stamp == stamp:
+        return index
+    # NOTE: a stale index isn't closed as it may still be in use; its mmap
+    # goes away once the last reference does
+    index = None
+    if os.path.exists(path):
+        try:
+            index = index_class(path)
+        except (ValueError, struct.error, mmap.error), e:
+            log.warning("ignoring unreadable membership index %s: %s", path, e)
+    if index is None or index.stamp != stamp:
+        log.info("building membership index %s", path)
+        index = index_class.build(path, keys(), stamp, bloom_bits_per_key)
+    _indexes[path] = index
+    return index
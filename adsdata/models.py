@@ -5,9 +5,11 @@ Created on Sep 18, 2012
 '''
 import os
 import sys
-import csv
+import time
 import pytz
+import hashlib
 import types
+import itertools
 import inspect
 from bson import DBRef
 from stat import ST_MTIME
@@ -17,10 +19,16 @@ from mongoalchemy import fields
 from mongoalchemy.document import Document
 from collections import defaultdict
 
-from adsdata import utils
+from adsdata import utils, membership
 
 import logging
 log = logging.getLogger()
+
+class UnsortedDataError(Exception):
+    pass
+
+# max number of _id values to include in a single {'$in': [...]} query
+ENTRY_FETCH_CHUNK_SIZE = 1000
     
 def _get_models(cls):
 
@@ -44,12 +52,108 @@ class DataLoadTime(Document):
     collection = fields.StringField()
     last_synced = fields.DateTimeField()
     
+def index_stamp(session, collection_name):
+    """
+    indexes derived from a collection are stamped with its DataLoadTime
+    """
+    dlt = session.query(DataLoadTime).filter(DataLoadTime.collection == collection_name).first()
+    if dlt is None:
+        return None
+    return dlt.last_synced.isoformat()
+
+def collection_index(session, collection_name, data_file=None):
+    """
+    a membership.MembershipIndex of a collection's ids, or None if the session
+    has no index_dir or the collection has never been loaded. The index gets
+    rebuilt whenever the collection's DataLoadTime changes, from data_file 
+    if given (and sorted) or else from the collection itself.
+    """
+    index_dir = getattr(session, 'index_dir', None)
+    stamp = index_stamp(session, collection_name)
+    if not index_dir or stamp is None:
+        return None
+    bloom_bits = getattr(session, 'index_bloom_bits', 0)
+    def collection_keys():
+        return membership.sorted_ids(session.get_collection(collection_name))
+    if data_file is not None:
+        try:
+            return membership.get_index(index_dir, collection_name, stamp, 
+                                        lambda: membership.file_keys(data_file), bloom_bits)
+        except ValueError, e:
+            log.warning("can't index %s from %s: %s", collection_name, data_file, e)
+    return membership.get_index(index_dir, collection_name, stamp, collection_keys, bloom_bits)
+
+LOAD_JOURNAL_COLLECTION = 'load_journal'
+# max number of bibcodes stored in a single load journal entry
+JOURNAL_CHUNK_SIZE = 10000
+
+def new_load_id():
+    """
+    load ids sort in the order the loads happened
+    """
+    return datetime.utcnow().strftime('%Y%m%d%H%M%S')
+
+def record_load_journal(session, load_id, collection_name, bibcodes):
+    """
+    record the bibcodes whose entries in a collection changed during a load.
+    bibcodes=None means the whole collection should be considered changed.
+    """
+    journal = session.get_collection(LOAD_JOURNAL_COLLECTION)
+    journal.ensure_index([('load_id', pymongo.ASCENDING)])
+    created = datetime.utcnow().replace(tzinfo=pytz.utc)
+    if bibcodes is None:
+        journal.insert({'load_id': load_id, 'collection': collection_name, 'full': True, 'bibcodes': [], 'created': created})
+        log.info("journaled all of %s as changed for load %s", collection_name, load_id)
+        return
+    entries = [{'load_id': load_id, 'collection': collection_name, 'full': False, 'bibcodes': chunk, 'created': created}
+               for chunk in utils.chunked(bibcodes, JOURNAL_CHUNK_SIZE)]
+    if len(entries):
+        journal.insert(entries)
+    log.info("journaled %d changed %s entries for load %s", len(bibcodes), collection_name, load_id)
+
+def journal_bibcodes(session, since, neighbours=True):
+    """
+    returns the set of bibcodes journaled as changed by loads with 
+    load_id >= since, or None if a full rebuild is needed. If neighbours is True,
+    changes to collections that affect the metrics of the papers they cite
+    are expanded to include the cited papers.
+    """
+    journal = session.get_collection(LOAD_JOURNAL_COLLECTION)
+    bibcodes = set()
+    expand = set()
+    expand_collections = [x.config_collection_name for x in data_file_models() if x.journal_neighbours]
+    for entry in journal.find({'load_id': {'$gte': since}}):
+        if entry.get('full'):
+            log.info("%s was fully reloaded by load %s", entry['collection'], entry['load_id'])
+            return None
+        bibcodes.update(entry['bibcodes'])
+        if neighbours and entry['collection'] in expand_collections:
+            expand.update(entry['bibcodes'])
+    if len(expand):
+        for entry in References.get_entries(session, expand, {'references': 1}).itervalues():
+            bibcodes.update(entry.get('references', []))
+    return bibcodes
+
 class DataCollection(Document):
     """
     This super class exists only to make it easy to collect and operate
     on all the various models via one base class
     """
-    pass
+    
+    @classmethod
+    def get_entries(cls, session, bibcodes, fields=None, chunk_size=ENTRY_FETCH_CHUNK_SIZE):
+        """
+        fetch the entries for many bibcodes using a small number of
+        chunked $in queries; returns a dict of entries keyed by _id
+        """
+        collection = session.get_collection(cls.config_collection_name)
+        bibcodes = list(set(bibcodes))
+        entries = {}
+        for i in xrange(0, len(bibcodes), chunk_size):
+            spec = {'_id': {'$in': bibcodes[i:i + chunk_size]}}
+            for entry in collection.find(spec, fields):
+                entries[entry['_id']] = entry
+        return entries
 
 class DocsDataCollection(DataCollection):
     
@@ -64,6 +168,21 @@ class DocsDataCollection(DataCollection):
     @classmethod
     def add_docs_data(cls, doc, session, bibcode):
         entry = cls.get_entry(session, bibcode)
+        cls.merge_docs_data(doc, bibcode, {bibcode: entry})
+
+    @classmethod
+    def fetch_docs_sources(cls, session, bibcodes):
+        """
+        fetch whatever this model needs to contribute to the docs of
+        a batch of bibcodes; the result gets passed to merge_docs_data
+        """
+        if not cls.docs_fields and not cls.docs_ref_fields:
+            return {}
+        return cls.get_entries(session, bibcodes)
+
+    @classmethod
+    def merge_docs_data(cls, doc, bibcode, sources):
+        entry = sources.get(bibcode)
         if entry:
             for field in cls.docs_fields:
                 key = field.db_field
@@ -71,10 +190,12 @@ class DocsDataCollection(DataCollection):
             for ref_field in cls.docs_ref_fields:
                 key = ref_field.db_field
                 doc[key] = DBRef(collection=cls.config_collection_name, id=bibcode)
+
 class MetricsDataCollection(DataCollection):
 
     docs_fields = []
     docs_ref_fields = []
+    metrics_fields = []
 
     @classmethod
     def get_entry(cls, session, bibcode):
@@ -84,6 +205,19 @@ class MetricsDataCollection(DataCollection):
     @classmethod
     def add_metrics_data(cls, doc, session, bibcode):
         entry = cls.get_entry(session, bibcode)
+        cls.merge_metrics_data(doc, bibcode, {bibcode: entry})
+
+    @classmethod
+    def fetch_metrics_sources(cls, session, bibcodes):
+        """
+        fetch whatever this model needs to contribute to the metrics data
+        of a batch of bibcodes; the result gets passed to merge_metrics_data
+        """
+        return cls.get_entries(session, bibcodes)
+
+    @classmethod
+    def merge_metrics_data(cls, doc, bibcode, sources):
+        entry = sources.get(bibcode)
         if entry:
             for field in cls.metrics_fields:
                 key = field.db_field
@@ -106,6 +240,14 @@ class DataFileCollection(DataCollection):
     field_order = []
     aggregated = False
     restkey = "unwanted"
+    # for aggregated collections: the field that the grouped values are
+    # collected in and, for lists of dicts, the fields making up each value
+    aggregate_field = None
+    aggregate_value_fields = None
+    # whether changes to an entry affect the metrics of the papers it cites
+    journal_neighbours = False
+    # whether to keep a membership index of the collection's ids; see membership_index()
+    membership_indexed = False
     
     @classmethod
     def last_synced(cls, session):
@@ -116,6 +258,23 @@ class DataFileCollection(DataCollection):
         log.debug("%s last synced: %s" % (collection_name, dlt.last_synced))
         return dlt.last_synced
     
+    @classmethod
+    def update_indexes(cls, session, data_file=None):
+        """
+        rebuild whatever indexes are derived from the collection; called 
+        after it has been (re)loaded
+        """
+        if cls.membership_indexed:
+            cls.membership_index(session, data_file)
+    
+    @classmethod
+    def membership_index(cls, session, data_file=None):
+        """
+        the collection's ids as a membership.MembershipIndex, or None if
+        indexes aren't configured; see collection_index()
+        """
+        return collection_index(session, cls.config_collection_name, data_file)
+    
     @classmethod
     def last_modified(cls, data_file):
         collection_name = cls.config_collection_name
@@ -142,75 +301,455 @@ class DataFileCollection(DataCollection):
             return False
         
     @classmethod
-    def load_data(cls, session, data_file, batch_size=1000, partial=False):
+    def load_data(cls, session, data_file, batch_size=1000, partial=False, stream_aggregate=False, load_id=None):
         """
         batch load entries from a data file to the corresponding mongo collection
+        
+        if stream_aggregate is True, aggregated collections are grouped
+        by key while reading the (sorted) data file and the final documents
+        inserted directly, skipping the map-reduce step
+
+        the changed entries get recorded in the load journal under load_id
         """
         
-        collection_name = cls.config_collection_name
-        load_collection_name = collection_name + '_load'
-        collection = session.get_collection(load_collection_name)
+        collection = cls.load_collection(session)
 
         # calculate the last_synced timestamp now so that any changes to the source
         # during loading will still trigger a new sync
-        dlt = DataLoadTime(collection=collection_name, last_synced=datetime.utcnow().replace(tzinfo=pytz.utc))
-
-        log.debug("loading data into %s" % load_collection_name)
+        dlt = cls.new_load_time()
         
-        def get_collection_field_name(field):
-            if field.is_id and cls.aggregated:
-                return "load_key"
-            else:
-                return field.db_field
-            
+        # start from an empty load collection
+        collection.drop()
+
         try:
-            fh = open(data_file, 'r')
+            cls.load_chunk(session, data_file, batch_size=batch_size, stream_aggregate=stream_aggregate)
         except IOError, e:
             log.error(str(e))
-            return
-
-        field_names = [get_collection_field_name(x) for x in cls.field_order]
-        reader = csv.DictReader(fh, field_names, delimiter="\t", restkey=cls.restkey, restval="")
-        cls.insert_records(reader, collection, batch_size)
+            return False
+        except UnsortedDataError, e:
+            log.error("aborting load of %s: %s", cls.config_collection_name, e)
+            collection.drop()
+            return False
+        
+        cls.finish_load(session, dlt, stream_aggregate=stream_aggregate)
+        cls.record_changes(session, data_file, load_id or new_load_id(), batch_size)
+        return True
         
-        log.debug("done loading %d records into %s" % (collection.count(), load_collection_name))
+    @classmethod
+    def load_collection(cls, session):
+        return session.get_collection(cls.config_collection_name + '_load')
+    
+    @classmethod
+    def new_load_time(cls):
+        return DataLoadTime(collection=cls.config_collection_name, last_synced=datetime.utcnow().replace(tzinfo=pytz.utc))
+    
+    @classmethod
+    def load_chunk(cls, session, data_file, start=0, end=None, batch_size=1000, stream_aggregate=False):
+        """
+        load the lines of the data file that start within the byte range [start, end)
+        into the load collection; see file_chunks() for splitting up a data file
+        """
+        collection = cls.load_collection(session)
+        log.debug("loading data into %s from %s, bytes %d-%s", collection.name, data_file, start, end)
+        with open(data_file, 'r') as fh:
+            records = cls.read_records(cls.read_lines(fh, start, end))
+            if stream_aggregate and cls.aggregated:
+                records = cls.aggregate_records(records)
+            cls.insert_records(records, collection, batch_size)
+    
+    @classmethod
+    def finish_load(cls, session, dlt, stream_aggregate=False):
+        """
+        post-process the fully loaded load collection, swap it in and
+        record the load time
+        """
+        collection_name = cls.config_collection_name
+        collection = cls.load_collection(session)
+        log.debug("done loading %d records into %s" % (collection.count(), collection.name))
 
-        cls.post_load_data(session, collection)
+        if stream_aggregate and cls.aggregated:
+            cls.swap_in_load_collection(session, collection)
+        else:
+            cls.post_load_data(session, collection)
         
         session.update(dlt, DataLoadTime.collection == collection_name, upsert=True)
         log.debug("%s load time updated to %s" % (collection_name, str(dlt.last_synced)))
         
     @classmethod
-    def insert_records(cls, reader, collection, batch_size):
+    def read_lines(cls, fh, start=0, end=None):
+        """
+        generates the lines of a file that start within the byte range [start, end)
+        """
+        fh.seek(start)
+        pos = start
+        while end is None or pos < end:
+            line = fh.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+            
+    @classmethod
+    def file_chunks(cls, data_file, num_chunks):
+        """
+        split a data file into (start, end) byte ranges for loading in parallel.
+        Chunks always start at the beginning of a line and, for aggregated 
+        collections, at the first line of a group of lines sharing the same key.
+        The last chunk's end is None, i.e., read to the end of the file.
+        """
+        size = os.path.getsize(data_file)
+        boundaries = [0]
+        with open(data_file, 'r') as fh:
+            for i in xrange(1, num_chunks):
+                offset = max(size * i / num_chunks, boundaries[-1])
+                if offset == 0:
+                    continue
+                # move to the start of the next line 
+                fh.seek(offset - 1)
+                fh.readline()
+                pos = fh.tell()
+                if cls.aggregated:
+                    # move the rest of the group that starts here into the previous chunk
+                    line = fh.readline()
+                    key = line.split('\t', 1)[0].rstrip('\r\n')
+                    while line:
+                        pos += len(line)
+                        line = fh.readline()
+                        if line.split('\t', 1)[0].rstrip('\r\n') != key:
+                            break
+                if pos >= size:
+                    break
+                if pos > boundaries[-1]:
+                    boundaries.append(pos)
+        return zip(boundaries, boundaries[1:] + [None])
+
+    @classmethod
+    def fingerprints_collection(cls, session):
+        return session.get_collection(cls.config_collection_name + '_fingerprints')
+    
+    @classmethod
+    def fingerprint(cls, lines):
+        """
+        a compact digest of the data file lines for one entry
+        """
+        return hashlib.md5(''.join(lines)).hexdigest()[:16]
+    
+    @classmethod
+    def read_groups(cls, fh):
+        """
+        generates (key, lines) for each run of lines sharing the same key
+        (the first column) in a data file sorted by key
+        """
+        key = None
+        lines = []
+        for line in fh:
+            if not line.rstrip('\r\n'):
+                continue
+            line_key = line.split('\t', 1)[0].rstrip('\r\n')
+            if len(lines) and line_key != key:
+                if line_key < key:
+                    raise UnsortedDataError("%s follows %s in data file for %s" 
+                                            % (line_key, key, cls.config_collection_name))
+                yield key, lines
+                lines = []
+            key = line_key
+            lines.append(line)
+        if len(lines):
+            yield key, lines
+    
+    @classmethod
+    def build_entry(cls, lines):
+        """
+        build the collection entry for the data file lines of one key
+        """
+        records = cls.read_records(lines)
+        if cls.aggregated:
+            records = cls.aggregate_records(records)
+        return records.next()
+    
+    @classmethod
+    def write_fingerprints(cls, session, data_file, batch_size=1000):
+        """
+        (re)generate the fingerprints of every entry in the data file
+        """
+        fingerprints = cls.fingerprints_collection(session)
+        fingerprints.drop()
+        with open(data_file, 'r') as fh:
+            records = ({'_id': key, 'fp': cls.fingerprint(lines)} for key, lines in cls.read_groups(fh))
+            cls.insert_records(records, fingerprints, batch_size)
+    
+    @classmethod
+    def diff_fingerprints(cls, session, data_file):
+        """
+        stream-diff a sorted data file against the fingerprints from the previous 
+        load. Generates (key, lines, fingerprint) for new or changed entries and 
+        (key, None, None) for entries that are no longer in the data file.
+        """
+        fingerprints = cls.fingerprints_collection(session)
+        cursor = fingerprints.find({}, {'fp': 1}, sort=[('_id', pymongo.ASCENDING)])
+        old = next(cursor, None)
+        with open(data_file, 'r') as fh:
+            for key, lines in cls.read_groups(fh):
+                key = key.decode('utf-8')
+                fp = cls.fingerprint(lines)
+                while old is not None and old['_id'] < key:
+                    yield old['_id'], None, None
+                    old = next(cursor, None)
+                if old is not None and old['_id'] == key:
+                    if old['fp'] != fp:
+                        yield key, lines, fp
+                    old = next(cursor, None)
+                else:
+                    yield key, lines, fp
+        while old is not None:
+            yield old['_id'], None, None
+            old = next(cursor, None)
+            
+    @classmethod
+    def apply_diff(cls, session, data_file, batch_size=1000, update_entries=True):
+        """
+        diff the data file against the stored fingerprints and bring the fingerprints
+        (and, if update_entries is True, the live collection) up to date. Returns
+        the list of bibcodes that were inserted, changed or removed.
+        """
+        collection = session.get_collection(cls.config_collection_name)
+        fingerprints = cls.fingerprints_collection(session)
+        touched = []
+        updates = []
+        removes = []
+        
+        def flush():
+            if len(updates):
+                if update_entries:
+                    entries = collection.initialize_unordered_bulk_op()
+                    for key, lines, fp in updates:
+                        entry = cls.build_entry(lines)
+                        entries.find({'_id': entry['_id']}).upsert().replace_one(entry)
+                    # apply the entries first so that a failure in between gets picked up next time
+                    entries.execute()
+                fps = fingerprints.initialize_unordered_bulk_op()
+                for key, lines, fp in updates:
+                    fps.find({'_id': key}).upsert().replace_one({'_id': key, 'fp': fp})
+                fps.execute()
+            if len(removes):
+                if update_entries:
+                    collection.remove({'_id': {'$in': removes}})
+                fingerprints.remove({'_id': {'$in': removes}})
+            del updates[:]
+            del removes[:]
+            
+        for key, lines, fp in cls.diff_fingerprints(session, data_file):
+            touched.append(key)
+            if lines is None:
+                removes.append(key)
+            else:
+                updates.append((key, lines, fp))
+            if len(updates) + len(removes) >= batch_size:
+                flush()
+        flush()
+        return touched
+    
+    @classmethod
+    def record_changes(cls, session, data_file, load_id, batch_size=1000):
+        """
+        called after a full load to work out which entries changed and 
+        record them in the load journal. If there's nothing to compare against
+        (or the data file isn't sorted) the whole collection is journaled as changed.
+        """
+        collection_name = cls.config_collection_name
+        fingerprints = cls.fingerprints_collection(session)
+        touched = None
+        try:
+            if fingerprints.find_one() is not None:
+                touched = cls.apply_diff(session, data_file, batch_size, update_entries=False)
+            else:
+                cls.write_fingerprints(session, data_file, batch_size)
+        except UnsortedDataError, e:
+            log.warning("unable to fingerprint %s: %s", collection_name, e)
+            fingerprints.drop()
+        record_load_journal(session, load_id, collection_name, touched)
+        return touched
+            
+    @classmethod
+    def sync_incremental(cls, session, data_file, batch_size=1000, load_id=None):
+        """
+        apply only the differences between the data file and the previously
+        loaded one to the live collection. Returns the list of bibcodes that were
+        inserted, changed or removed, or None if there were no fingerprints to 
+        diff against and a full load was done instead.
+        """
+        collection_name = cls.config_collection_name
+        if load_id is None:
+            load_id = new_load_id()
+        
+        if cls.fingerprints_collection(session).find_one() is None:
+            log.info("no fingerprints for %s; doing a full load", collection_name)
+            cls.load_data(session, data_file, batch_size=batch_size, stream_aggregate=True, load_id=load_id)
+            return None
+        
+        dlt = cls.new_load_time()
+        touched = cls.apply_diff(session, data_file, batch_size)
+        record_load_journal(session, load_id, collection_name, touched)
+        
+        log.info("%d entries of %s inserted, changed or removed", len(touched), collection_name)
+        session.update(dlt, DataLoadTime.collection == collection_name, upsert=True)
+        log.debug("%s load time updated to %s" % (collection_name, str(dlt.last_synced)))
+        return touched
+    
+    @classmethod
+    def insert_records(cls, records, collection, batch_size):
         log.debug("inserting records into %s..." % collection.name)
         
         batch = []
         batch_num = 1
+        count = 0
+        start = time.time()
         
         def insert_batch(batch):
             try:
-                collection.insert(batch, continue_on_error=True)
+                # keys come from field_order so there's no need to have them checked
+                collection.insert(batch, continue_on_error=True, check_keys=False)
             except pymongo.errors.DuplicateKeyError, e:
                 log.error(e)
             
-        while True:
-            try:
-                record = reader.next()
-                if record.has_key('unwanted'):
-                    del record['unwanted']
-            except StopIteration:
-                break
-            cls.coerce_types(record)
+        for record in records:
             batch.append(record)
             if len(batch) >= batch_size:
                 log.debug("inserting batch %d into %s", batch_num, collection.name)
                 insert_batch(batch)
+                count += len(batch)
                 batch = []
                 batch_num += 1
 
         if len(batch):
             log.debug("inserting final batch into %s" % collection.name)
             insert_batch(batch)
+            count += len(batch)
+        
+        elapsed = time.time() - start
+        log.info("inserted %d records into %s in %.1fs (%.0f rows/s)", 
+                 count, collection.name, elapsed, count / max(elapsed, 0.001))
+        return count
+
+    @classmethod
+    def load_field_name(cls, field):
+        if field.is_id and cls.aggregated:
+            return "load_key"
+        else:
+            return field.db_field
+
+    @classmethod
+    def field_converter(cls, field):
+        """
+        returns the function needed to convert a string value from the data
+        file to the type defined in the model, or None if no conversion is needed
+        """
+        if hasattr(field, 'constructor'):
+            constructor = field.constructor
+        elif hasattr(field, 'child_type'):
+            constructor = field.child_type().constructor
+        elif hasattr(field, 'item_type'):
+            constructor = field.item_type.constructor
+        else:
+            return None
+        if constructor in [int, float] or isinstance(constructor, types.FunctionType):
+            return constructor
+        return None
+
+    @classmethod
+    def row_decoder(cls):
+        """
+        compiles a function that decodes a line of the tab-separated data file
+        into a record ready for insertion. This does the equivalent of a 
+        csv.DictReader + coerce_types, but works out the field names & type 
+        conversions once up front instead of for every value of every row.
+        The decoder returns None for blank lines.
+        
+        NOTE: unlike the csv module there is no handling of quoted values; 
+        the data files don't use them
+        """
+        model_fields = cls.get_fields()
+        names = [cls.load_field_name(x) for x in cls.field_order]
+        num_columns = len(names)
+        
+        # assume id's are strings and we don't need to process
+        # (_id field is called "load_key" for aggregated collections
+        conversions = []
+        for i, name in enumerate(names):
+            if name in ['_id','load_key']:
+                continue
+            converter = cls.field_converter(model_fields[name])
+            if converter is not None:
+                conversions.append((i, name, converter))
+        
+        restkey = cls.restkey
+        keep_rest = restkey != 'unwanted'
+        rest_converter = None
+        if keep_rest and restkey in model_fields:
+            rest_converter = cls.field_converter(model_fields[restkey])
+            
+        def decode(line):
+            line = line.rstrip('\r\n')
+            if not line:
+                return None
+            values = line.split('\t')
+            record = dict(itertools.izip(names, values))
+            for i, name, converter in conversions:
+                if i < len(values) and values[i]:
+                    record[name] = converter(values[i])
+            if len(values) < num_columns:
+                for name in names[len(values):]:
+                    record[name] = ""
+            elif len(values) > num_columns and keep_rest:
+                rest = values[num_columns:]
+                if rest_converter is not None:
+                    rest = [rest_converter(x) for x in rest]
+                record[restkey] = rest
+            return record
+        
+        return decode
+    
+    @classmethod
+    def read_records(cls, fh):
+        """
+        generates ready-to-insert records from the lines of a data file
+        """
+        decode = cls.row_decoder()
+        for line in fh:
+            record = decode(line)
+            if record is not None:
+                yield record
+
+    @classmethod
+    def aggregate_records(cls, records):
+        """
+        groups runs of records with the same load_key into single documents,
+        the streaming equivalent of utils.map_reduce_listify/map_reduce_dictify.
+        The data file must be sorted by key.
+        """
+        field = cls.aggregate_field
+        value_fields = cls.aggregate_value_fields
+        doc = None
+        last_key = None
+        for record in records:
+            key = record['load_key']
+            if value_fields:
+                value = dict((k, record.get(k)) for k in value_fields)
+            else:
+                value = record.get(field)
+            if doc is not None:
+                if key == last_key:
+                    if len(doc[field]) < utils.max_array_length:
+                        doc[field].append(value)
+                    continue
+                if key < last_key:
+                    raise UnsortedDataError("%s follows %s in data file for %s" 
+                                            % (key, last_key, cls.config_collection_name))
+                yield doc
+            doc = {'_id': key, field: [value]}
+            last_key = key
+        if doc is not None:
+            yield doc
 
     @classmethod
     def coerce_types(cls, record):
@@ -353,6 +892,7 @@ class Readers(DataFileCollection, DocsDataCollection):
     
     aggregated = True
     config_collection_name = 'readers'
+    aggregate_field = 'readers'
     field_order = [bibcode, readers]
     docs_fields = [readers]
     
@@ -371,6 +911,8 @@ class References(DataFileCollection):
     
     aggregated = True
     config_collection_name = 'references'
+    journal_neighbours = True
+    aggregate_field = 'references'
     field_order = [bibcode, references]
     
     def __str__(self):
@@ -381,6 +923,57 @@ class References(DataFileCollection):
         target_collection_name = cls.config_collection_name
         utils.map_reduce_listify(session, source_collection, target_collection_name, 'load_key', 'references')
 
+    @classmethod
+    def update_indexes(cls, session, data_file=None):
+        cls.reference_counts(session)
+    
+    @classmethod
+    def reference_counts(cls, session):
+        """
+        a membership.CountTable of the number of references of each paper, or
+        None if indexes aren't configured. The counts are worked out by mongo
+        so the reference lists themselves never leave the server. Rebuilt 
+        whenever the collection is reloaded.
+        """
+        collection_name = cls.config_collection_name
+        index_dir = getattr(session, 'index_dir', None)
+        stamp = index_stamp(session, collection_name)
+        if not index_dir or stamp is None:
+            return None
+        return membership.get_index(index_dir, collection_name, stamp, 
+                                    lambda: cls.iter_counts(session),
+                                    index_class=membership.CountTable)
+    
+    @classmethod
+    def iter_counts(cls, session):
+        """
+        (bibcode, number of references) for every entry, in bibcode order
+        """
+        collection = session.get_collection(cls.config_collection_name)
+        pipeline = [
+            {'$project': {'count': {'$size': {'$ifNull': ['$references', []]}}}},
+            {'$sort': {'_id': 1}},
+            ]
+        cursor = collection.aggregate(pipeline, allowDiskUse=True, cursor={'batchSize': 10000})
+        return ((x['_id'], x['count']) for x in cursor)
+    
+    @classmethod
+    def get_counts(cls, session, bibcodes, chunk_size=ENTRY_FETCH_CHUNK_SIZE):
+        """
+        number of references of each of bibcodes that has an entry; from the
+        reference_counts() table if there is one
+        """
+        table = cls.reference_counts(session)
+        if table is not None:
+            return table
+        counts = {}
+        for bibcode, entry in cls.get_entries(session, bibcodes, {'references': 1}, chunk_size).iteritems():
+            try:
+                counts[bibcode] = len(entry.get('references',[]))
+            except:
+                pass
+        return counts
+
 class Citations(DataFileCollection, DocsDataCollection, MetricsDataCollection):
     
     bibcode = fields.StringField(_id=True)
@@ -388,6 +981,7 @@ class Citations(DataFileCollection, DocsDataCollection, MetricsDataCollection):
     
     aggregated = True
     config_collection_name = 'citations'
+    aggregate_field = 'citations'
     field_order = [bibcode, citations]
     docs_fields = [citations]
     
@@ -395,29 +989,48 @@ class Citations(DataFileCollection, DocsDataCollection, MetricsDataCollection):
         return "Citations(%s): [%s]" % (self.bibcode, self.citations)
     
     @classmethod
-    def add_metrics_data(cls, doc, session, bibcode):
+    def add_metrics_data(cls, doc, session, bibcode, chunk_size=ENTRY_FETCH_CHUNK_SIZE):
+        sources = cls.fetch_metrics_sources(session, [bibcode], chunk_size)
+        cls.merge_metrics_data(doc, bibcode, sources)
+
+    @classmethod
+    def fetch_metrics_sources(cls, session, bibcodes, chunk_size=ENTRY_FETCH_CHUNK_SIZE):
+        """
+        fetch the citations of a batch of papers and then the refereed status
+        & references of the papers and all of their citations up front rather
+        than doing a find_one for each one
+        """
+        entries = cls.get_entries(session, bibcodes, {'citations': 1}, chunk_size)
+        wanted = set(bibcodes)
+        for entry in entries.itervalues():
+            try:
+                wanted.update(entry.get('citations',[]))
+            except:
+                pass
+        return {
+            'citations': entries,
+            'refereed': Refereed.membership_index(session) or Refereed.get_entries(session, wanted, {'_id': 1}, chunk_size),
+            'reference_counts': References.get_counts(session, wanted, chunk_size),
+            'authors': Authors.get_entries(session, bibcodes, {'authors': 1}, chunk_size),
+            }
+
+    @classmethod
+    def merge_metrics_data(cls, doc, bibcode, sources):
         today = datetime.today()
         age = max(1.0, today.year - int(bibcode[:4]) + 1)
-        entry = cls.get_entry(session, bibcode)
+        entry = sources['citations'].get(bibcode)
         try:
             citations = entry.get('citations',[])
         except:
             citations = []
-        refereed_collection = session.get_collection('refereed')
-        refereed = False
-        if refereed_collection.find_one({'_id':bibcode}):
-            refereed = True
-        reference_collection = session.get_collection('references')
+        refereed_ids = sources['refereed']
+        reference_counts = sources['reference_counts']
+        refereed = bibcode in refereed_ids
         ref_norm = 0.0
         rn_citations_hist = defaultdict(float)
         rn_citation_data = []
-        res = reference_collection.find_one({'_id':bibcode})
-        try:
-            doc['reference_num'] = len(res.get('references',[]))
-        except:
-            doc['reference_num'] = 0
-        author_collection = session.get_collection('authors')
-        res = author_collection.find_one({'_id':bibcode})
+        doc['reference_num'] = reference_counts.get(bibcode, 0)
+        res = sources['authors'].get(bibcode)
         try:
             doc['author_num'] = max(len(res.get('authors',[])),1)
         except:
@@ -425,8 +1038,9 @@ class Citations(DataFileCollection, DocsDataCollection, MetricsDataCollection):
         auth_norm = 1.0 / float(doc['author_num'])
         for citation in citations:
             try:
-                res = reference_collection.find_one({'_id':citation})
-                Nrefs = len(res.get('references',[]))
+                Nrefs = reference_counts.get(citation)
+                if Nrefs is None:
+                    continue
                 Nrefs_normalized = 1.0/float(max(5, Nrefs))
                 ref_norm += Nrefs_normalized
                 rn_citations_hist[citation[:4]] += ref_norm
@@ -436,7 +1050,7 @@ class Citations(DataFileCollection, DocsDataCollection, MetricsDataCollection):
         doc['refereed'] = refereed
         doc['citations'] = citations
         doc['citation_num'] = len(doc['citations'])
-        doc['refereed_citations'] = filter(lambda a: refereed_collection.find_one({'_id':a}), doc['citations'])
+        doc['refereed_citations'] = filter(lambda a: a in refereed_ids, doc['citations'])
         doc['refereed_citation_num'] = len(doc['refereed_citations'])
         doc['an_citations'] = float(doc['citation_num'])/float(age)
         doc['an_refereed_citations'] = float(doc['refereed_citation_num'])/float(age)
@@ -454,6 +1068,8 @@ class Refereed(DataFileCollection, DocsDataCollection):
     bibcode = fields.StringField(_id=True)
     
     config_collection_name = 'refereed'
+    journal_neighbours = True
+    membership_indexed = True
     field_order = [bibcode]
     docs_fields = []
     
@@ -489,6 +1105,8 @@ class SimbadObjects(DataFileCollection, DocsDataCollection):
     
     aggregated = True
     config_collection_name = "simbad_objects"
+    aggregate_field = 'simbad_objects'
+    aggregate_value_fields = ['id', 'type']
     field_order = [bibcode, id, type]
     docs_fields = [simbad_objects]
 
@@ -506,6 +1124,7 @@ class Canonical(DataFileCollection):
     bibcode = fields.StringField(_id=True)
 
     config_collection_name = 'canonical'
+    membership_indexed = True
     field_order = [bibcode]
 
     def __str__(self):
@@ -587,6 +1206,8 @@ class Grants(DataFileCollection, DocsDataCollection):
     
     aggregated = True
     config_collection_name = "grants"
+    aggregate_field = 'grants'
+    aggregate_value_fields = ['agency', 'grant']
     field_order = [bibcode, agency, grant]
     docs_fields = [grants]
     
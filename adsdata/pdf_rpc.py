@@ -0,0 +1,181 @@
+'''
+Client for the PDF extraction workers in pdf_extraction/extract_pdf.py.
+
+Requests go out over rabbitmq with a correlation id and all replies come
+back on one exclusive reply queue per client, so a process can have many
+PDFs in flight at once rather than one queue & one blocking wait per PDF.
+Requests that get no reply within the timeout are sent again, with a new
+correlation id, up to retries times; they are also sent with that timeout
+as their expiration so ones still queued by then are dropped by rabbitmq.
+
+Usage:
+
+    client = get_client(config)
+    client.submit(bibcode, ft_source, callback)   # callback(body, error)
+    ...
+    client.drain()
+
+or, for a single PDF:
+
+    body = client.call(bibcode, ft_source)
+'''
+
+import os
+import json
+import time
+import uuid
+import logging
+from collections import deque
+
+from adsdata import utils
+
+log = logging.getLogger()
+
+MAX_IN_FLIGHT = 8
+TIMEOUT = 300
+RETRIES = 2
+
+class PdfRequestTimeout(Exception):
+    pass
+
+class PdfRpcClient(object):
+    """
+    Keeps up to max_in_flight extraction requests outstanding. Callbacks
+    get called, from submit(), poll(), drain() or call(), with the reply
+    body and None, or with None and an exception if the request timed out
+    every time.
+    """
+    def __init__(self, queue_name, exchange='', max_in_flight=MAX_IN_FLIGHT, timeout=TIMEOUT, retries=RETRIES):
+        self.queue_name = queue_name
+        self.exchange = exchange
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.retries = retries
+        self.channel = None
+        self.in_flight = {}
+        self.replies = deque()
+
+    def connect(self):
+        if self.channel is not None and self.channel.is_open:
+            return self.channel
+        self.channel = utils.rabbitmq_channel()
+        res = self.channel.queue_declare(exclusive=True)
+        self.reply_queue = res.method.queue
+        self.consumer_tag = self.channel.basic_consume(self.on_response, no_ack=True, queue=self.reply_queue)
+        log.debug("pdf rpc client consuming replies on %s", self.reply_queue)
+        # anything sent on an earlier channel would be replied to on its queue
+        for request in self.in_flight.values():
+            request['sent'] = 0
+        return self.channel
+
+    def on_response(self, ch, method, props, body):
+        request = self.in_flight.pop(props.correlation_id, None)
+        if request is None:
+            log.debug("ignoring reply to an unknown or timed out request: %s", props.correlation_id)
+            return
+        log.debug("got pdf extraction reply for %s", request['bibcode'])
+        self.replies.append((request, body, None))
+
+    def send(self, request):
+        import pika
+        correlation_id = str(uuid.uuid4())
+        properties = pika.BasicProperties(reply_to=self.reply_queue, correlation_id=correlation_id,
+                                          expiration=str(int(self.timeout * 1000)))
+        msg = json.dumps({'bibcode': request['bibcode'], 'ft_source': request['ft_source']})
+        self.channel.basic_publish(exchange=self.exchange, routing_key=self.queue_name,
+                                   properties=properties, body=msg)
+        request['sent'] = time.time()
+        request['attempts'] += 1
+        self.in_flight[correlation_id] = request
+
+    def submit(self, bibcode, ft_source, callback):
+        """
+        queue a PDF for extraction, first waiting for replies while there
+        are max_in_flight requests outstanding
+        """
+        self.connect()
+        while len(self.in_flight) >= self.max_in_flight:
+            self.poll()
+        log.debug("queueing %s for pdf extraction on %s", bibcode, self.queue_name)
+        self.send({'bibcode': bibcode, 'ft_source': ft_source, 'callback': callback, 'attempts': 0})
+        self.run_callbacks()
+
+    def poll(self, time_limit=1):
+        """
+        waits up to time_limit seconds for replies, resends or fails
+        requests that have timed out and runs the callbacks of everything
+        that's finished
+        """
+        if self.in_flight:
+            self.connect().connection.process_data_events(time_limit=time_limit)
+        now = time.time()
+        for correlation_id, request in self.in_flight.items():
+            if now - request['sent'] < self.timeout:
+                continue
+            del self.in_flight[correlation_id]
+            if request['attempts'] <= self.retries:
+                log.warning("pdf extraction of %s timed out, retrying", request['bibcode'])
+                self.send(request)
+            else:
+                log.error("pdf extraction of %s timed out %d times", request['bibcode'], request['attempts'])
+                error = PdfRequestTimeout("no pdf extraction reply for %s" % request['bibcode'])
+                self.replies.append((request, None, error))
+        self.run_callbacks()
+
+    def run_callbacks(self):
+        while self.replies:
+            request, body, error = self.replies.popleft()
+            request['callback'](body, error)
+
+    def drain(self):
+        """
+        waits until every request has been replied to or has failed
+        """
+        while self.in_flight or self.replies:
+            self.poll()
+
+    def call(self, bibcode, ft_source):
+        """
+        extract a single PDF, returning the reply body
+        """
+        result = {}
+        def done(body, error):
+            result['body'], result['error'] = body, error
+        self.submit(bibcode, ft_source, done)
+        while not result:
+            self.poll()
+        if result['error'] is not None:
+            raise result['error']
+        return result['body']
+
+    def close(self):
+        if self.channel is None:
+            return
+        import pika
+        try:
+            self.channel.basic_cancel(self.consumer_tag)
+            self.channel.close()
+        except pika.exceptions.AMQPError, e:
+            log.debug("error closing pdf rpc channel: %s", e)
+        self.channel = None
+
+_clients = {}
+
+def get_client(config):
+    """
+    this process's PdfRpcClient; the request queue can be overridden with
+    the RABBITMQ_PDF_QUEUE environment variable
+    """
+    pid = os.getpid()
+    if pid not in _clients:
+        queue_name = os.environ.get('RABBITMQ_PDF_QUEUE') or config['RABBITMQ_PDF_QUEUE']
+        _clients[pid] = PdfRpcClient(queue_name, config.get('RABBITMQ_EXCHANGE', ''),
+                                     max_in_flight=config.get('PDF_MAX_IN_FLIGHT') or MAX_IN_FLIGHT,
+                                     timeout=config.get('PDF_TIMEOUT') or TIMEOUT,
+                                     retries=config.get('PDF_RETRIES', RETRIES))
+    return _clients[pid]
+
+def close_client():
+    client = _clients.pop(os.getpid(), None)
+    if client is not None:
+        client.close()
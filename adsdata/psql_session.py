@@ -1,16 +1,18 @@
+import logging
 import datetime
 
 from sqlalchemy import Column, Integer, String, DateTime, Boolean
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
-from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
+from sqlalchemy import create_engine, select
+from sqlalchemy.exc import SQLAlchemyError
 
 from psql_models import Metrics, Base
 from adsdata import utils
 
 config = utils.load_config()
+log = logging.getLogger()
 
 
 class Session:
@@ -26,6 +28,15 @@ class Session:
     self.session = sessionmaker(bind=self.engine)()
 
   def save_metrics_records(self,records):
+    """
+    Inserts new and updates changed metrics records. The current rows are
+    fetched with a single query and everything that differs gets written 
+    with one upsert. If that fails the records are retried one at a time so
+    a single bad record doesn't lose the whole batch.
+
+    Returns a dict of counts for 'unchanged', 'inserted' and 'updated' 
+    records and the list of bibcodes that could not be saved as 'failed'.
+    """
     #Very domain specific; strong assumption of the incoming data's schema
 
     #example data:
@@ -46,30 +57,101 @@ class Session:
     #                                                      u'2000': 0.089170328250193845,
     #                                                      u'2001': 0.070302403721891962}
     #                                }  
+    rows = {}
     for record in records:
-      record['bibcode'] = record['_id']
-
-      deletions = ['_id','_digest','_dt']
-      for k in deletions:
-        if k in record:
-          del record[k]
-
-      record['modtime'] = datetime.datetime.now()
-      try:
-        current = self.session.query(Metrics).filter(Metrics.bibcode==record['bibcode']).one()
-        excluded_fields = ['modtime']
-        if dict((k,current.__getattribute__(k)) for k in record if k not in excluded_fields)==dict((k,v) for k,v in record.iteritems() if k not in excluded_fields):
-          #Record is the same as the current one: no-op
-          continue
-        for k,v in record.iteritems():
-          current.__setattr__(k,v)
-      except NoResultFound:
-        self.session.add(Metrics(**record))
-      
+      row = self.metrics_row(record)
+      # a statement can't upsert the same bibcode twice; the last one wins
+      rows[row['bibcode']] = row
+
+    result = {'unchanged': 0, 'inserted': 0, 'updated': 0, 'failed': []}
+    current = self.current_metrics(rows.keys())
+    changed = []
+    for bibcode, row in rows.iteritems():
+      if bibcode not in current:
+        result['inserted'] += 1
+      elif self.same_metrics(current[bibcode], row):
+        result['unchanged'] += 1
+        continue
+      else:
+        result['updated'] += 1
+      changed.append(row)
+
+    if not changed:
+      return result
     try:
+      self.upsert_metrics(changed)
       self.session.commit()
-    except:
+    except SQLAlchemyError, e:
       self.session.rollback()
+      log.warning("bulk upsert of %d metrics records failed, retrying one by one: %s", len(changed), e)
+      for row in changed:
+        try:
+          self.upsert_metrics([row])
+          self.session.commit()
+        except SQLAlchemyError, e:
+          self.session.rollback()
+          log.error("failed to save metrics record for %s: %s", row['bibcode'], e)
+          result['failed'].append(row['bibcode'])
+          if row['bibcode'] in current:
+            result['updated'] -= 1
+          else:
+            result['inserted'] -= 1
+    return result
+
+  def metrics_row(self, record):
+    """
+    metrics record -> row values for the metrics table
+    """
+    row = dict((k,v) for k,v in record.iteritems() if k not in ('_id','_digest','_dt'))
+    row['bibcode'] = record.get('_id', record.get('bibcode'))
+    row['modtime'] = datetime.datetime.now()
+    return row
+
+  def current_metrics(self, bibcodes):
+    """
+    fetches the stored rows for bibcodes in a single query
+    """
+    if not bibcodes:
+      return {}
+    table = Metrics.__table__
+    query = select([table]).where(table.c.bibcode.in_(bibcodes))
+    return dict((r['bibcode'], r) for r in self.session.execute(query))
+
+  def same_metrics(self, current, row):
+    """
+    compares only the columns present in the new row, modtime excluded
+    """
+    for k,v in row.iteritems():
+      if k == 'modtime':
+        continue
+      if current[k] != v:
+        return False
+    return True
+
+  def upsert_metrics(self, rows):
+    """
+    INSERT ... ON CONFLICT (bibcode) DO UPDATE, one statement per distinct 
+    set of columns so that columns missing from a record are left alone
+    """
+    table = Metrics.__table__
+    groups = {}
+    for row in rows:
+      groups.setdefault(tuple(sorted(row.keys())), []).append(row)
+    for columns, group in groups.iteritems():
+      stmt = postgresql.insert(table).values(group)
+      stmt = stmt.on_conflict_do_update(
+        index_elements=['bibcode'],
+        set_=dict((k, stmt.excluded[k]) for k in columns if k != 'bibcode')
+        )
+      self.session.execute(stmt)
+
+  def delete_metrics_records(self, bibcodes):
+    """
+    deletes the metrics rows for bibcodes; returns the number deleted
+    """
+    count = self.session.query(Metrics).filter(Metrics.bibcode.in_(bibcodes)).delete(synchronize_session=False)
+    self.session.commit()
+    return count
 
   def close(self):
     self.session.close()
@@ -9,14 +9,19 @@ warnings.filterwarnings("ignore", category=DeprecationWarning, module="pymongo")
 warnings.filterwarnings("ignore", category=DeprecationWarning, module="mongoalchemy") 
 
 import pytz
+import zlib
 import logging
 import hashlib
 from json import dumps
 from bson import DBRef
 from datetime import datetime
+from collections import OrderedDict
 from mongoalchemy.session import Session
+from pymongo.errors import BulkWriteError
 from pymongo.son_manipulator import SONManipulator
 
+from adsdata import utils
+
 DOCS_COLLECTION = 'docs'
 METRICS_DATA_COLLECTION = 'metrics_data'
 MONGO_DOCS_DEREF_FIELDS = []
@@ -26,10 +31,20 @@ class DataSession(object):
     Wraps a mongoalchemy.Session object and provides methods for 
     directly accessing the internal pymongo client and for querying
     the data collections in models.py
+    
+    With raw=True no SON manipulators are installed. store() & store_many()
+    stamp the _digest and _dt values themselves, and get_doc(), 
+    get_metrics_data() and find_docs() strip them and resolve DBRef fields
+    for a whole page of docs at a time instead of one doc at a time.
     """
     def __init__(self, db, uri, create_ok=False, inc_manipulators=True, **kwargs):
 
         self.proc_name = kwargs.get('name')
+        self.digest_hashtype = kwargs.get('digest_hashtype', 'sha1')
+        self.raw = kwargs.get('raw', False)
+        # where membership indexes get kept, if anywhere; see models.collection_index
+        self.index_dir = kwargs.get('index_dir')
+        self.index_bloom_bits = kwargs.get('index_bloom_bits', 0)
         self.malchemy = Session.connect(db, host=uri, timezone=pytz.utc)
         self.create_ok = create_ok
         self.db = self.malchemy.db
@@ -38,9 +53,9 @@ class DataSession(object):
         self.metrics_data = self.db[METRICS_DATA_COLLECTION]
         self.metrics_data.ensure_index('_digest')
         self.pymongo = self.db.connection
-        if inc_manipulators:
+        if inc_manipulators and not self.raw:
             # NOTE: order is important here
-            self.add_manipulator(DigestInjector([DOCS_COLLECTION, METRICS_DATA_COLLECTION]))
+            self.add_manipulator(DigestInjector([DOCS_COLLECTION, METRICS_DATA_COLLECTION], self.digest_hashtype))
             self.add_manipulator(DatetimeInjector([DOCS_COLLECTION, METRICS_DATA_COLLECTION]))
             self.add_manipulator(DereferenceManipulator(MONGO_DOCS_DEREF_FIELDS))
     
@@ -68,7 +83,36 @@ class DataSession(object):
 
     def get_doc(self, bibcode, manipulate=True):
         spec = {'_id': bibcode}
-        return self.docs.find_one(spec, manipulate=manipulate)
+        if not self.raw:
+            return self.docs.find_one(spec, manipulate=manipulate)
+        doc = self.docs.find_one(spec, manipulate=False)
+        if doc is not None and manipulate:
+            self.prepare_outgoing([doc], self.docs)
+        return doc
+    
+    def find_docs(self, spec=None, fields=None, manipulate=True, page_size=1000):
+        """
+        returns a cursor over the docs matching spec. The manipulators are 
+        bypassed; with manipulate=True the cursor strips the meta values and 
+        resolves DBRef fields a page of docs at a time instead. 
+        """
+        cursor = self.docs.find(spec, fields, manipulate=False).batch_size(page_size)
+        if not manipulate:
+            return cursor
+        return DereferencingCursor(cursor, self.db, deref_fields(self.docs), page_size=page_size)
+    
+    def prepare_outgoing(self, docs, collection):
+        """
+        does what the manipulators would do to docs read from collection in
+        raw mode, but resolves the DBRef fields for all of the docs at once
+        """
+        fields = deref_fields(collection)
+        if len(fields):
+            dereference_many(self.db, docs, fields)
+        for doc in docs:
+            doc.pop('_digest', None)
+            doc.pop('_dt', None)
+        return docs
         
     def docs_sources(self):
         if not hasattr(self, 'doc_source_models'):
@@ -82,7 +126,44 @@ class DataSession(object):
             model_class.add_docs_data(doc, self, bibcode)
         return doc
 
+    def generate_docs(self, bibcodes):
+        """
+        generate the docs for a chunk of bibcodes using one $in query
+        per source collection; docs are yielded in input order
+        """
+        bibcodes = list(bibcodes)
+        return self.assemble_docs(bibcodes, self.fetch_docs_sources(bibcodes))
+    
+    def fetch_docs_sources(self, bibcodes):
+        """
+        the I/O half of generate_docs(); fetches the source entries
+        """
+        return [(m, m.fetch_docs_sources(self, bibcodes)) for m in self.docs_sources()]
+    
+    def assemble_docs(self, bibcodes, sources):
+        """
+        the CPU half of generate_docs(); builds the docs from the sources
+        returned by fetch_docs_sources()
+        """
+        for bibcode in bibcodes:
+            doc = {'_id': bibcode}
+            for model_class, model_sources in sources:
+                model_class.merge_docs_data(doc, bibcode, model_sources)
+            yield doc
+
     def get_metrics_data(self, bibcode, manipulate=True):
+        if self.raw:
+            if isinstance(bibcode, list):
+                spec = {'_id': {"$in": bibcode}}
+                records = list(self.metrics_data.find(spec, manipulate=False))
+            else:
+                spec = {'_id': bibcode}
+                records = filter(None, [self.metrics_data.find_one(spec, manipulate=False)])
+            if manipulate:
+                self.prepare_outgoing(records, self.metrics_data)
+            if isinstance(bibcode, list):
+                return records
+            return records and records[0] or None
         if isinstance(bibcode, list):
             spec = {'_id': {"$in": bibcode}}
             return list(self.metrics_data.find(spec, manipulate=manipulate))
@@ -102,11 +183,35 @@ class DataSession(object):
             model_class.add_metrics_data(doc, self, bibcode)
         return doc
 
+    def generate_metrics_data_many(self, bibcodes):
+        """
+        generate the metrics data for a chunk of bibcodes using a handful of 
+        $in queries per source collection; records are yielded in input order
+        """
+        bibcodes = list(bibcodes)
+        return self.assemble_metrics_data(bibcodes, self.fetch_metrics_data_sources(bibcodes))
+    
+    def fetch_metrics_data_sources(self, bibcodes):
+        """
+        the I/O half of generate_metrics_data_many()
+        """
+        return [(m, m.fetch_metrics_sources(self, bibcodes)) for m in self.metrics_data_sources()]
+    
+    def assemble_metrics_data(self, bibcodes, sources):
+        """
+        the CPU half of generate_metrics_data_many()
+        """
+        for bibcode in bibcodes:
+            doc = {'_id': bibcode}
+            for model_class, model_sources in sources:
+                model_class.merge_metrics_data(doc, bibcode, model_sources)
+            yield doc
+
     def store(self, record, collection):
         
         log = logging.getLogger()
         
-        record["_digest"] = record_digest(record, self.db)
+        record["_digest"] = record_digest(record, self.db, self.digest_hashtype)
         spec = {'_id': record['_id'] } #, '_digest': digest}
         
         # look for existing doc; fetch only id & _digest values
@@ -117,16 +222,115 @@ class DataSession(object):
                 # no change; do nothing
                 log.debug("Digest match. No change to %s", str(spec))
                 return False
+            elif existing.has_key("_digest") and self.is_stale_digest(record, existing["_digest"]):
+                # no change, but the stored digest is of an older hashtype
+                spec['_digest'] = existing["_digest"]
+                collection.update(spec, {'$set': {'_digest': record['_digest']}}, manipulate=False)
+                log.debug("Digest upgraded. No change to %s", str(spec))
+                return False
             elif existing.has_key("_digest"):
                 # add existing digest value to spec to avoid race conditions
                 spec['_digest'] = existing["_digest"]
         
+        if self.raw:
+            record['_dt'] = datetime.utcnow().replace(tzinfo=pytz.utc)
+        
         # NOTE: even for cases where there was no existing doc we need to do an 
         # upsert to avoid race conditions
-        collection.update(spec, record, manipulate=True, upsert=True)
+        collection.update(spec, record, manipulate=not self.raw, upsert=True)
         log.info("[%s] Updated %s" % (collection.name, record['_id']))
         return True
 
+    def is_stale_digest(self, record, digest):
+        """
+        True if digest is of a different hashtype than this session 
+        generates but matches the record's content
+        """
+        return digest_hashtype(digest) != self.digest_hashtype \
+            and same_content(record, digest, self.db)
+    
+    def store_many(self, records, collection):
+        """
+        bulk version of store(). Existing digests for the whole batch are fetched
+        with one query, unchanged records are dropped and the rest are written
+        with a single unordered bulk upsert. Returns a dict of counts plus the
+        list of ids that were actually written.
+        
+        NOTE: bulk writes bypass the SON manipulators so the _digest and _dt
+        values are stamped here
+        """
+        log = logging.getLogger()
+        
+        stats = {'unchanged': 0, 'inserted': 0, 'updated': 0, 'conflicts': 0, 'upgraded': 0, 'changed': []}
+        if not len(records):
+            return stats
+        
+        now = datetime.utcnow().replace(tzinfo=pytz.utc)
+        # resolve the DBRef values for the whole batch up front for the digests
+        ref_docs = fetch_ref_docs(self.db, records)
+        for record in records:
+            record['_digest'] = record_digest(record, self.db, self.digest_hashtype, ref_docs)
+            record['_dt'] = now
+        
+        # fetch only id & _digest values of any existing docs
+        spec = {'_id': {'$in': [x['_id'] for x in records]}}
+        existing = dict((x['_id'], x.get('_digest')) 
+                        for x in collection.find(spec, {'_digest': 1}, manipulate=False))
+        
+        bulk = collection.initialize_unordered_bulk_op()
+        pending = []
+        upgrades = []
+        for record in records:
+            spec = {'_id': record['_id']}
+            if record['_id'] in existing:
+                existing_digest = existing[record['_id']]
+                if existing_digest == record['_digest']:
+                    # no change; do nothing
+                    stats['unchanged'] += 1
+                    continue
+                elif existing_digest is not None and self.is_stale_digest(record, existing_digest):
+                    # no change, but the stored digest is of an older hashtype
+                    stats['unchanged'] += 1
+                    upgrades.append((record['_id'], existing_digest, record['_digest']))
+                    continue
+                elif existing_digest is not None:
+                    # add existing digest value to spec to avoid race conditions
+                    spec['_digest'] = existing_digest
+            # NOTE: even for cases where there was no existing doc we need to do an 
+            # upsert to avoid race conditions
+            bulk.find(spec).upsert().replace_one(record)
+            pending.append(record['_id'])
+        
+        if len(upgrades):
+            upgrade = collection.initialize_unordered_bulk_op()
+            for _id, old_digest, new_digest in upgrades:
+                upgrade.find({'_id': _id, '_digest': old_digest}).update_one({'$set': {'_digest': new_digest}})
+            try:
+                stats['upgraded'] = upgrade.execute().get('nModified', 0)
+            except BulkWriteError, e:
+                log.warning("[%s] Failed upgrading digests: %s", collection.name, e.details)
+        
+        if not len(pending):
+            log.debug("[%s] No changes in batch of %d", collection.name, len(records))
+            return stats
+        
+        try:
+            result = bulk.execute()
+        except BulkWriteError, e:
+            # a changed digest means another process got there first
+            result = e.details
+            for error in result.get('writeErrors', []):
+                log.warning("[%s] Failed updating %s: %s", collection.name, 
+                            pending[error['index']], error.get('errmsg'))
+        
+        failed = set(x['index'] for x in result.get('writeErrors', []))
+        stats['conflicts'] = len(failed)
+        stats['inserted'] = len(result.get('upserted', []))
+        stats['updated'] = result.get('nMatched', 0)
+        stats['changed'] = [x for i, x in enumerate(pending) if i not in failed]
+        log.info("[%s] Updated %d of %d records", collection.name, len(stats['changed']), len(records))
+        return stats
+
 class DatetimeInjector(SONManipulator):
     """
     Used for injecting/removing the datetime values of records in
@@ -150,13 +354,14 @@ class DigestInjector(SONManipulator):
     """
     Inserts a digest hash of the contents of the doc being inserted
     """
-    def __init__(self, collections=[]):
+    def __init__(self, collections=[], hashtype='sha1'):
         self.collections = collections
+        self.hashtype = hashtype
         
     def transform_incoming(self, son, collection):
         if collection.name in self.collections:
             if not son.has_key('_digest'):
-                son['_digest'] = record_digest(son, collection.database)
+                son['_digest'] = record_digest(son, collection.database, self.hashtype)
         return son
     
     def transform_outgoing(self, son, collection):
@@ -186,25 +391,174 @@ class DereferenceManipulator(SONManipulator):
                 dereference(son, collection.database, field_name)
         return son
     
-def record_digest(record, db, hashtype='sha1'):
+class CRC32(object):
     """
-    generate a digest hash from a 'docs' dictionary
+    zlib.crc32 wrapped in the update()/hexdigest() interface of hashlib
+    """
+    def __init__(self):
+        self.crc = 0
+        
+    def update(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        
+    def hexdigest(self):
+        return '%08x' % (self.crc & 0xffffffff)
+    
+def new_hash(hashtype):
+    if hashtype == 'crc32':
+        return CRC32()
+    return hashlib.new(hashtype)
+
+def digest_hashtype(digest):
+    """
+    the hashtype that generated a digest value; digests without a prefix 
+    are sha1
+    """
+    if ':' in digest:
+        return digest.split(':', 1)[0]
+    return 'sha1'
+
+def record_digest(record, db, hashtype='sha1', ref_docs=None):
     """
-    # first make a copy
-    digest_record = record.copy()
+    generate a digest hash from a 'docs' dictionary
     
-    # remove any 'meta' values
-    for k in digest_record.keys():
+    The record is hashed as if it had been serialized with 
+    json.dumps(record, sort_keys=True) minus any 'meta' values, but each value
+    is serialized and fed to the hash separately, so neither a copy of the 
+    record nor the complete json string are needed. Digests of any hashtype
+    other than sha1 are prefixed with "<hashtype>:". DBRef values are 
+    looked up in ref_docs (see fetch_ref_docs) before hitting the database.
+    """
+    h = new_hash(hashtype)
+    h.update('{')
+    sep = ''
+    for k in sorted(record.keys()):
+        # skip any 'meta' values
         if k.startswith('_'):
-            del digest_record[k]
-        elif isinstance(digest_record[k], DBRef):
-            dereference(digest_record, db, k)
+            continue
+        v = record[k]
+        if isinstance(v, DBRef):
+            ref_doc = ref_docs.get((v.collection, v.id)) if ref_docs is not None else None
+            if ref_doc is None:
+                ref_doc = db.dereference(v)
+            v = ref_doc.get(k)
+        h.update('%s%s: %s' % (sep, dumps(k), dumps(v, sort_keys=True)))
+        sep = ', '
+    h.update('}')
+    if hashtype == 'sha1':
+        return h.hexdigest()
+    return '%s:%s' % (hashtype, h.hexdigest())
+
+def same_content(record, digest, db):
+    """
+    checks a record against a digest that was generated with a different
+    hashtype, e.g. one stored before the digest hashtype was changed
+    """
+    return record_digest(record, db, digest_hashtype(digest)) == digest
+
+def deref_fields(collection):
+    """
+    names of the fields holding DBRef values for docs in collection
+    """
+    return [f for c, f in MONGO_DOCS_DEREF_FIELDS if c == collection.name]
+
+class RefCache(object):
+    """
+    small LRU cache of referenced docs keyed on (collection, id)
+    """
+    def __init__(self, size=10000):
+        self.size = size
+        self.entries = OrderedDict()
+        
+    def get(self, key):
+        ref_doc = self.entries.pop(key, None)
+        if ref_doc is not None:
+            self.entries[key] = ref_doc
+        return ref_doc
+    
+    def put(self, key, ref_doc):
+        self.entries.pop(key, None)
+        self.entries[key] = ref_doc
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
             
-    h = hashlib.new(hashtype)
-    # sort_keys=True should make this deterministic?
-    json = dumps(digest_record, sort_keys=True)
-    h.update(json)
-    return h.hexdigest()                
+def fetch_ref_docs(db, docs, fields=None, cache=None):
+    """
+    fetches the docs referenced by DBRef values in 'fields' (any top-level
+    field if None) of docs with one $in query per referenced collection. 
+    Returns a dict of referenced docs keyed on (collection, id) 
+    """
+    ref_docs = {}
+    ids = {}
+    for doc in docs:
+        for field_name in (fields is None and doc.keys() or fields):
+            db_ref = doc.get(field_name)
+            if not isinstance(db_ref, DBRef):
+                continue
+            key = (db_ref.collection, db_ref.id)
+            if key in ref_docs:
+                continue
+            ref_doc = cache and cache.get(key)
+            if ref_doc is not None:
+                ref_docs[key] = ref_doc
+            else:
+                ids.setdefault(db_ref.collection, set()).add(db_ref.id)
+    for collection_name, ref_ids in ids.iteritems():
+        spec = {'_id': {'$in': list(ref_ids)}}
+        for ref_doc in db[collection_name].find(spec, manipulate=False):
+            key = (collection_name, ref_doc['_id'])
+            ref_docs[key] = ref_doc
+            if cache is not None:
+                cache.put(key, ref_doc)
+    return ref_docs
+
+def dereference_many(db, docs, fields, cache=None):
+    """
+    batch version of dereference() that resolves the DBRef values in 'fields'
+    for all of docs with one $in query per referenced collection
+    """
+    ref_docs = fetch_ref_docs(db, docs, fields, cache)
+    for doc in docs:
+        for field_name in fields:
+            db_ref = doc.get(field_name)
+            if isinstance(db_ref, DBRef):
+                ref_doc = ref_docs.get((db_ref.collection, db_ref.id), {})
+                doc[field_name] = ref_doc.get(field_name)
+    return docs
+
+class DereferencingCursor(object):
+    """
+    Wraps a pymongo cursor. Docs are pulled a page at a time, the DBRef values
+    in 'fields' are resolved for the whole page (see dereference_many) and 
+    the _digest and _dt meta values are removed. Referenced docs are kept in 
+    a small LRU cache as they tend to be shared by neighbouring docs.
+    """
+    def __init__(self, cursor, db, fields, page_size=1000, cache_size=10000):
+        self.cursor = cursor
+        self.db = db
+        self.fields = fields
+        self.page_size = page_size
+        self.cache = RefCache(cache_size)
+        
+    def __getattr__(self, name):
+        # count(), sort(), limit(), etc. go to the wrapped cursor
+        attr = getattr(self.cursor, name)
+        if not callable(attr):
+            return attr
+        def method(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            # keep chained calls wrapped
+            return result is self.cursor and self or result
+        return method
+    
+    def __iter__(self):
+        for page in utils.chunked(self.cursor, self.page_size):
+            if len(self.fields):
+                dereference_many(self.db, page, self.fields, self.cache)
+            for doc in page:
+                doc.pop('_digest', None)
+                doc.pop('_dt', None)
+                yield doc
 
 def dereference(son, db, field_name):
     """
@@ -13,6 +13,7 @@ import os
 import re
 import sys
 import json
+import time
 import string
 import unicodedata
 from datetime import datetime
@@ -92,6 +93,19 @@ def commandList():
     registrar.map = registry
     return registrar
 
+def chunked(iterable, size):
+    """
+    break an iterable up into lists of at most 'size' items
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if len(chunk):
+        yield chunk
+
 def mongo_uri(host, port, db=None, user=None, passwd=None):
     if user and passwd:
         uri = "mongodb://%s:%s@%s:%d/%s" % (user, passwd, host, port, db)
@@ -105,6 +119,10 @@ def get_session(config, **kwargs):
                     db=config['ADSDATA_MONGO_DATABASE'], 
                     user=config['ADSDATA_MONGO_USER'], 
                     passwd=config['ADSDATA_MONGO_PASSWORD'])
+    kwargs.setdefault('digest_hashtype', config.get('ADSDATA_DIGEST_HASHTYPE', 'sha1'))
+    kwargs.setdefault('raw', bool(config.get('ADSDATA_RAW_SESSION', False)))
+    kwargs.setdefault('index_dir', config.get('ADSDATA_INDEX_DIR') or None)
+    kwargs.setdefault('index_bloom_bits', config.get('ADSDATA_INDEX_BLOOM_BITS') or 0)
     return DataSession(config['ADSDATA_MONGO_DATABASE'], uri, **kwargs)  # monkeypath: je, 03/04/2015
 
 def get_document(session, model, **kwargs):
@@ -236,21 +254,129 @@ def mod_time(file):
     mtime = os.stat(file)[ST_MTIME]
     return datetime.fromtimestamp(mtime)
 
-def rabbitmq_channel(exchange=None, durable=False):
+class RabbitPublisher(object):
+    """
+    Publishes to rabbitmq over a long-lived connection & channel with publisher
+    confirms. Items passed to publish() are buffered and sent as a single json
+    list once payload_size items have accumulated or the oldest buffered item
+    has waited longer than linger seconds. The connection is re-established if
+    it fails. Make sure to call close() before the process exits so nothing
+    buffered gets lost.
+    """
+    def __init__(self, uri, exchange='', routing_key='', payload_size=100, linger=5.0, 
+                 queue=None, retries=3):
+        self.uri = uri
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.payload_size = payload_size
+        self.linger = linger
+        self.queue = queue
+        self.retries = retries
+        self.connection = None
+        self._channel = None
+        self.payload = []
+        self.payload_started = None
+        
+    def channel(self):
+        """
+        returns the publishing channel, connecting first if necessary
+        """
+        import pika
+        if self._channel is None or not self._channel.is_open:
+            if self.connection is None or not self.connection.is_open:
+                log.debug("connecting to rabbitmq")
+                self.connection = pika.BlockingConnection(pika.URLParameters(self.uri))
+            self._channel = self.connection.channel()
+            self._channel.confirm_delivery()
+            if self.queue:
+                self._channel.queue_declare(queue=self.queue)
+        return self._channel
+    
+    def reset(self):
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+        except Exception, e:
+            log.debug("error closing rabbitmq connection: %s", e)
+        self.connection = None
+        self._channel = None
+    
+    def publish_message(self, body, exchange=None, routing_key=None, properties=None):
+        """
+        publish a single message, reconnecting & retrying on failure
+        """
+        import pika
+        if exchange is None:
+            exchange = self.exchange
+        if routing_key is None:
+            routing_key = self.routing_key
+        for attempt in xrange(1, self.retries + 1):
+            try:
+                confirmed = self.channel().basic_publish(exchange=exchange, routing_key=routing_key,
+                                                         body=body, properties=properties)
+                if confirmed is False:
+                    raise pika.exceptions.AMQPError("message to %s/%s was not confirmed" % (exchange, routing_key))
+                return
+            except pika.exceptions.AMQPError, e:
+                log.warning("publish to rabbitmq failed (attempt %d): %s", attempt, e)
+                self.reset()
+                if attempt == self.retries:
+                    raise
+        
+    def publish(self, items):
+        if not len(items):
+            return
+        if not len(self.payload):
+            self.payload_started = time.time()
+        self.payload.extend(items)
+        if len(self.payload) >= self.payload_size \
+                or time.time() - self.payload_started >= self.linger:
+            self.flush()
+            
+    def flush(self):
+        while len(self.payload):
+            batch = self.payload[:self.payload_size]
+            self.publish_message(json.dumps(batch))
+            del self.payload[:len(batch)]
+        
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.reset()
+
+_rabbitmq_connection = None
+
+def rabbitmq_connection():
+    """
+    a rabbitmq connection that gets shared by everything in the current process
+    """
     import pika
-    config = load_config()
-    conn = pika.BlockingConnection(pika.URLParameters(config['RABBITMQ_URI']))
-    channel = conn.channel()
-    return channel
+    global _rabbitmq_connection
+    conn, pid = _rabbitmq_connection or (None, None)
+    if conn is None or pid != os.getpid() or not conn.is_open:
+        config = load_config()
+        conn = pika.BlockingConnection(pika.URLParameters(config['RABBITMQ_URI']))
+        _rabbitmq_connection = (conn, os.getpid())
+    return conn
+
+def rabbitmq_channel(exchange=None, durable=False):
+    """
+    opens a channel on the process's shared connection; callers should 
+    close it when done
+    """
+    return rabbitmq_connection().channel()
 
 def publish_updates(updates):
     """
     send the list of fulltext records that were updated to rabbitmq
     """
-    channel = rabbitmq_channel()
-    channel.queue_declare(queue="fulltext_updates")
-    msg = json.dumps({ 'updates': updates })
-    channel.basic_publish(exchange="", routing_key="fulltext_updates", body=msg)
+    config = load_config()
+    publisher = RabbitPublisher(config['RABBITMQ_URI'], routing_key="fulltext_updates", queue="fulltext_updates")
+    try:
+        publisher.publish_message(json.dumps({ 'updates': updates }))
+    finally:
+        publisher.close()
 
 def get_script_path(file_name_space):
     """
@@ -0,0 +1,222 @@
+'''
+Hands out work to pools of worker processes in chunks rather than one item
+at a time. Each chunk is acknowledged by the worker that processed it, along
+with any counts and output it produced, so the parent can keep track of
+progress and of which chunks failed.
+
+Usage:
+
+    class Worker(ChunkWorker):
+        def process_chunk(self, chunk):
+            ...
+            return {'stats': {'foo': 1}, 'output': [...]}
+
+    work = WorkQueue(chunk_size=100)
+    work.add_workers(Worker(work) for i in xrange(4))
+    work.run(items)
+    print work.stats, work.output, work.failed
+'''
+
+import time
+import logging
+import traceback
+from Queue import Empty, Full
+from collections import defaultdict
+from multiprocessing import Process, Queue
+
+from adsdata import utils
+
+log = logging.getLogger()
+
+class ChunkWorker(Process):
+    """
+    Base class for WorkQueue workers. Subclasses implement process_chunk()
+    and can use setup() and teardown() for anything that has to happen in
+    the worker process itself. If idle_timeout is set, idle() gets called
+    whenever the worker has waited that many seconds for a chunk.
+    """
+    idle_timeout = None
+    
+    def __init__(self, work):
+        Process.__init__(self)
+        self.work = work
+
+    def setup(self):
+        pass
+
+    def teardown(self):
+        pass
+
+    def idle(self):
+        pass
+
+    def process_chunk(self, chunk):
+        """
+        process a list of items and return None or a dict with optional
+        'stats' (counts to be summed up) and 'output' (list of results) values
+        """
+        raise NotImplementedError()
+
+    def handle(self, chunk_id, chunk):
+        """
+        processes and acknowledges a chunk. Workers that finish their chunks
+        asynchronously can override this and call ack() themselves.
+        """
+        try:
+            result = self.process_chunk(chunk) or {}
+        except:
+            log.error("Worker %s failed on chunk starting with %s: %s", self.name, chunk[0], traceback.format_exc())
+            self.ack(chunk_id, error=traceback.format_exc())
+            return
+        self.ack(chunk_id, result.get('stats'), result.get('output'))
+
+    def ack(self, chunk_id, stats=None, output=None, error=None):
+        self.work.results.put((chunk_id, stats or {}, output or [], error))
+
+    def run(self):
+        self.setup()
+        try:
+            while True:
+                try:
+                    task = self.work.tasks.get(timeout=self.idle_timeout)
+                except Empty:
+                    self.idle()
+                    continue
+                if task is None:
+                    log.debug("Nothing left to do for worker %s", self.name)
+                    break
+                self.handle(*task)
+        finally:
+            self.teardown()
+
+class WorkQueue(object):
+    """
+    Feeds chunks of items to a set of ChunkWorkers and collects their
+    acknowledgements. After run():
+
+        stats - counts of chunks, items and failed chunks plus the sum of the
+                stats reported by the workers
+        output - everything the workers reported as output
+        failed - (first item, error) for each chunk that failed or was
+                 never acknowledged because its worker died
+    
+    If on_output is given it gets called with each chunk's output as it 
+    comes in instead of the output being collected. If it raises, the 
+    workers are terminated and the exception is passed on.
+    """
+    def __init__(self, chunk_size=100, max_queued=None, progress_every=100, on_output=None):
+        self.chunk_size = chunk_size
+        self.max_queued = max_queued
+        self.progress_every = progress_every
+        self.on_output = on_output
+        self.tasks = Queue(max_queued or 0)
+        self.results = Queue()
+        self.workers = []
+        self.pending = {}
+        self.stats = defaultdict(int)
+        self.output = []
+        self.failed = []
+
+    def add_workers(self, workers):
+        self.workers.extend(workers)
+        if self.max_queued is None:
+            # keep the workers busy without queueing everything up front
+            self.tasks = Queue(len(self.workers) * 4)
+
+    def alive(self):
+        return any(w.is_alive() for w in self.workers)
+
+    def put(self, task):
+        """
+        queue a task, collecting acknowledgements while the queue is full;
+        returns False if there are no workers left to take it
+        """
+        while True:
+            try:
+                self.tasks.put(task, timeout=1)
+                return True
+            except Full:
+                self.collect()
+                if not self.alive():
+                    return False
+
+    def collect(self, timeout=None):
+        """
+        process any acknowledgements; waits up to timeout seconds for the
+        first one. Returns the number processed.
+        """
+        count = 0
+        while True:
+            try:
+                if timeout and not count:
+                    chunk_id, stats, output, error = self.results.get(timeout=timeout)
+                else:
+                    chunk_id, stats, output, error = self.results.get_nowait()
+            except Empty:
+                return count
+            count += 1
+            first, size = self.pending.pop(chunk_id)
+            self.stats['chunks'] += 1
+            self.stats['items'] += size
+            for k, v in stats.iteritems():
+                self.stats[k] += v
+            if self.on_output is not None:
+                if len(output):
+                    self.on_output(output)
+            else:
+                self.output.extend(output)
+            if error:
+                self.stats['failed_chunks'] += 1
+                self.failed.append((first, error))
+            if self.stats['chunks'] % self.progress_every == 0:
+                self.log_progress()
+
+    def log_progress(self):
+        elapsed = time.time() - self.start_time
+        log.info("%d chunks (%d items) done, %d failed, %d outstanding, %.1f items/s",
+                 self.stats['chunks'], self.stats['items'], self.stats['failed_chunks'],
+                 len(self.pending), self.stats['items'] / max(elapsed, 0.001))
+
+    def run(self, items):
+        self.start_time = time.time()
+        for w in self.workers:
+            w.start()
+        try:
+            return self.distribute(items)
+        except:
+            for w in self.workers:
+                if w.is_alive():
+                    w.terminate()
+            raise
+
+    def distribute(self, items):
+        log.debug("Queueing work in chunks of %d", self.chunk_size)
+        for chunk_id, chunk in enumerate(utils.chunked(items, self.chunk_size)):
+            self.pending[chunk_id] = (chunk[0], len(chunk))
+            if not self.put((chunk_id, chunk)):
+                log.error("All workers have died")
+                break
+            self.collect()
+
+        # add some poison pills to the end of the queue
+        log.debug("poisoning our workers")
+        for w in self.workers:
+            if not self.put(None):
+                break
+
+        while len(self.pending):
+            if not self.collect(timeout=1) and not self.alive():
+                # one last look for anything sent before the workers exited
+                self.collect()
+                break
+
+        for w in self.workers:
+            w.join()
+
+        for first, size in self.pending.values():
+            log.error("chunk starting with %s was never acknowledged", first)
+            self.stats['failed_chunks'] += 1
+            self.failed.append((first, "not acknowledged"))
+
+        self.log_progress()
+        return self.stats
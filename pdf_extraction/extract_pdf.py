@@ -48,13 +48,14 @@ class PdfExtractor(Callable):
             delivery = self.consumer.nextDelivery()
             props = delivery.getProperties()
             task = String(delivery.getBody())
-            reply_props = BasicProperties.Builder().build()
+            # the client matches replies to its requests by correlation id
+            reply_props = BasicProperties.Builder().correlationId(props.getCorrelationId()).build()
             try:
                 task_data = json.loads(str(task))
                 log.debug("got task: %s", str(task_data))
                 resp = self.extract(task_data['bibcode'], task_data['ft_source'])
             except Exception, e:
-                msg = traceback.format_exc()
+                msg = format_exc()
                 log.debug("returning error response: %s" % str(msg))
                 resp = { '_exception': str(msg) }
             finally:
@@ -100,8 +101,8 @@ class PdfExtractor(Callable):
             parsedText = normalizer.normalizePres(parsedText)
             parsedText = parsedText.replace("\n", "")
         except: # Exception, e:
-            sys.stderr.write("exception traceback: %s" % traceback.format_exc())
-            log.error("Exception occurred during normalization of %s: %s", ft_source, traceback.format_exc())
+            sys.stderr.write("exception traceback: %s" % format_exc())
+            log.error("Exception occurred during normalization of %s: %s", ft_source, format_exc())
             #return { '_exception': traceback.format_exc() }
             raise
 
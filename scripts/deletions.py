@@ -9,48 +9,53 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import time
 import logging
+import shutil
 import itertools
-from Queue import Empty as QueueEmpty
-from multiprocessing import Process, JoinableQueue, Queue, cpu_count
+from multiprocessing import cpu_count
 from optparse import OptionParser
 from pymongo import MongoClient
 
 from adsdata import utils, models
+from adsdata.workqueue import ChunkWorker, WorkQueue
 
 commands = utils.commandList()
 
-class Worker(Process):
+# where else records for a deleted bibcode may live
+DELETE_TARGETS = ['metrics_data', 'metrics', 'fulltext']
 
-    def __init__(self, task_queue, deletes_queue, config, authority):
-        Process.__init__(self)
-        self.task_queue = task_queue
-        self.deletes_queue = deletes_queue
-        session = utils.get_session(config)
-        self.authority_collection = session.get_collection(authority)
+class Worker(ChunkWorker):
 
-    def run(self):
+    def __init__(self, work, config, authority, use_index=False):
+        ChunkWorker.__init__(self, work)
+        self.session = utils.get_session(config)
+        self.authority = authority
+        self.authority_collection = self.session.get_collection(authority)
+        self.use_index = use_index
+        self.index = None
+        
+    def setup(self):
+        if self.use_index:
+            # opens the index built by find_deletions()
+            self.index = models.collection_index(self.session, self.authority)
+
+    def process_chunk(self, bibs):
         log = logging.getLogger()
-        while True:
-            bib = self.task_queue.get()
-            if bib is None:
-                log.debug("Nothing left to do for worker %s" % self.name)
-                self.task_queue.task_done()
-                break
-            log.debug("Worker %s is working on %s" % (self.name, bib))
-            try:
-                doc = self.authority_collection.find_one({'_id': bib}, {'_id': 1})
-                if doc:
-                    log.debug("%s appears in authority collection" % bib)
-                else:
-                    log.debug("%s is missing from authority collection" % bib)
-                    self.deletes_queue.put(bib)
-            except:
-                raise
-            finally:
-                self.task_queue.task_done()
-
-def find_deletions(opts, config):
-    
+        log.debug("Worker %s is working on %d bibcodes starting with %s" % (self.name, len(bibs), bibs[0]))
+        if self.index is not None:
+            missing = [bib for bib in bibs if bib not in self.index]
+        else:
+            found = set(x['_id'] for x in self.authority_collection.find({'_id': {'$in': bibs}}, {'_id': 1}))
+            missing = [bib for bib in bibs if bib not in found]
+        for bib in missing:
+            log.debug("%s is missing from authority collection" % bib)
+        return {'stats': {'missing': len(missing)}, 'output': missing}
+
+def find_deletions(opts, config, on_output=None):
+    """
+    checks the subject ids against the authority in worker processes. If 
+    on_output is given the missing bibcodes are passed to it a chunk at a 
+    time as they're found, otherwise they're returned once the scan is done
+    """
     log = logging.getLogger()
     
     session = utils.get_session(config)
@@ -60,51 +65,161 @@ def find_deletions(opts, config):
     if opts.limit:
         bibiter = itertools.islice(bibiter, opts.limit)
     
-    tasks = JoinableQueue()
-    deletes = Queue()
-
-    # start up our builder threads
+    use_index = False
+    if opts.index:
+        # build or refresh the authority index once before the workers need it
+        use_index = models.collection_index(session, opts.authority) is not None
+        if not use_index:
+            log.warning("no membership index available for %s; using lookups" % opts.authority)
+    
+    # start up our worker processes
     log.debug("Creating %d Worker processes" % opts.threads)
-    procs = [ Worker(tasks, deletes, config, opts.authority) for i in xrange(opts.threads)]
-    for p in procs:
-        p.start()
+    work = WorkQueue(chunk_size=opts.chunk_size, on_output=on_output)
+    work.add_workers(Worker(work, config, opts.authority, use_index) for i in xrange(opts.threads))
 
     log.debug("Queueing work")
-    count = 0
-    for count, bib in enumerate(bibiter, 1):
-        tasks.put(bib)
-        
-    log.info("Subject collection contained %d items" % count)
-        
-    # add some poison pills to the end of the queue
-    log.debug("poisoning our task threads")
-    for i in xrange(opts.threads):
-        tasks.put(None)
-        
-    log.debug("joining task queue")
-    tasks.join()
+    stats = work.run(bibiter)
+    log.info("Subject collection contained %d items" % stats['items'])
+    for first, error in work.failed:
+        # the bibcodes in a failed chunk just won't be deleted this time
+        log.error("chunk starting with %s could not be checked: %s" % (first, error))
     
-    while True:
+    return work.output
+
+def sorted_ids(collection):
+    cursor = collection.find({}, {'_id': 1}).sort('_id', 1).batch_size(10000)
+    return itertools.imap(lambda x: x['_id'], cursor)
+
+def merge_missing(subject_ids, authority_ids):
+    """
+    the ids in subject_ids that aren't in authority_ids; both must be sorted
+    """
+    authority_ids = iter(authority_ids)
+    authority_id = next(authority_ids, None)
+    for subject_id in subject_ids:
+        while authority_id is not None and authority_id < subject_id:
+            authority_id = next(authority_ids, None)
+        if authority_id != subject_id:
+            yield subject_id
+
+def find_deletions_merged(opts, config):
+    """
+    alternative to find_deletions() that does a single streaming sort-merge 
+    of the subject and authority ids instead of a lookup per bibcode
+    """
+    log = logging.getLogger()
+    
+    session = utils.get_session(config)
+    subject_ids = sorted_ids(session.get_collection(opts.subject))
+    authority_ids = sorted_ids(session.get_collection(opts.authority))
+    
+    if opts.limit:
+        subject_ids = itertools.islice(subject_ids, opts.limit)
+    
+    log.debug("Merging %s against %s" % (opts.subject, opts.authority))
+    return merge_missing(subject_ids, authority_ids)
+
+def get_deletions(opts, config):
+    if opts.merge:
+        return find_deletions_merged(opts, config)
+    return find_deletions(opts, config)
+
+class DeletionLimitExceeded(Exception):
+    pass
+
+class Deleter(object):
+    """
+    Removes records from the subject collection in batches along with, 
+    optionally, whatever else was generated for the same bibcodes (see 
+    DELETE_TARGETS). Bibcodes are collected with add() as they are found 
+    and only removed by finish(), once they have all been counted: if more 
+    than max_fraction of the subject collection, or max_deletions records
+    if that's given instead, would go, add() raises DeletionLimitExceeded 
+    and nothing is deleted. The other targets are 
+    done first so an interrupted run gets picked up again by the next one.
+    """
+    def __init__(self, opts, config):
+        self.config = config
+        self.session = utils.get_session(config)
+        self.subject_collection = self.session.get_collection(opts.subject)
+        self.batch_size = opts.batch_size
+        self.targets = opts.also or []
+        if opts.max_deletions is not None:
+            self.max_deletions = opts.max_deletions
+        else:
+            self.max_deletions = int(self.subject_collection.count() * opts.max_fraction)
+        self.pending = []
+        self.count = 0
+        
+    def add(self, bibs):
+        self.pending.extend(bibs)
+        if len(self.pending) > self.max_deletions:
+            raise DeletionLimitExceeded("aborting: more than the limit of %d records of %s would be deleted" % 
+                                        (self.max_deletions, self.subject_collection.name))
+            
+    def finish(self):
+        psql = None
+        if 'metrics' in self.targets:
+            from adsdata import psql_session
+            psql = psql_session.Session()
         try:
-            yield deletes.get_nowait()
-        except QueueEmpty:
-            break
+            for batch in utils.chunked(self.pending, self.batch_size):
+                self.delete_batch(batch, psql)
+        finally:
+            if psql is not None:
+                psql.close()
+        self.pending = []
+            
+    def delete_batch(self, batch, psql=None):
+        log = logging.getLogger()
+        log.info("deleting %s" % ', '.join(batch))
+        if 'metrics_data' in self.targets:
+            self.session.metrics_data.remove({'_id': {'$in': batch}})
+        if 'metrics' in self.targets:
+            psql.delete_metrics_records(batch)
+        if 'fulltext' in self.targets:
+            self.remove_fulltext(batch)
+        self.subject_collection.remove({'_id': {'$in': batch}})
+        self.count += len(batch)
+        
+    def remove_fulltext(self, bibs):
+        import ptree
+        from adsdata import fulltext_meta, fulltext_segments
+        log = logging.getLogger()
+        for bib in bibs:
+            extract_dir = self.config['FULLTEXT_EXTRACT_PATH'] + ptree.id2ptree(bib)
+            if os.path.isdir(extract_dir):
+                log.debug("removing fulltext extract dir %s" % extract_dir)
+                shutil.rmtree(extract_dir)
+        store = fulltext_meta.get_store(self.config)
+        if store is not None:
+            log.debug("removed %d rows from the fulltext meta store" % store.delete_many(bibs))
+        writer = fulltext_segments.get_writer(self.config)
+        if writer is not None:
+            for bib in bibs:
+                writer.delete(bib)
+            # committed per batch, before the subject records go
+            writer.commit()
 
 @commands
 def delete(opts, config):
+    log = logging.getLogger()
     log.info("Deleting all records from %s that do not appear in %s" % (opts.subject, opts.authority))
-    session = utils.get_session(config)
-    subject_collection = session.get_collection(opts.subject)
-    count = 0
-    for count, bib in enumerate(find_deletions(opts, config), 1):
-        log.info("deleting %s" % bib)
-        subject_collection.remove({'_id': bib})
-    log.info("done. %d items deleted" % count)
+    deleter = Deleter(opts, config)
+    # everything is found & counted before anything is deleted
+    if opts.merge:
+        for batch in utils.chunked(find_deletions_merged(opts, config), opts.batch_size):
+            deleter.add(batch)
+    else:
+        find_deletions(opts, config, on_output=deleter.add)
+    deleter.finish()
+    log.info("done. %d items deleted" % deleter.count)
 
 @commands
 def list(opts, config):
+    log = logging.getLogger()
     log.info("Listing all records from %s that do not appear in %s" % (opts.subject, opts.authority))
-    for bib in find_deletions(opts, config):
+    for bib in get_deletions(opts, config):
         print bib
 
 if __name__ == '__main__':
@@ -116,6 +231,20 @@ if __name__ == '__main__':
     op.add_option('-s', '--subject', dest="subject", action="store", default='docs',
                   help="collection to be examined for possible deletions")
     op.add_option('-t','--threads', dest="threads", action="store", type=int, default=int(cpu_count() / 2))
+    op.add_option('--index', dest="index", action="store_true", default=False,
+                  help="check against a membership index of the authority (needs ADSDATA_INDEX_DIR)")
+    op.add_option('-m', '--merge', dest="merge", action="store_true", default=False,
+                  help="find deletions with a sort-merge of both collections' ids instead of worker lookups")
+    op.add_option('-b', '--batch_size', dest="batch_size", action="store", type=int, default=1000,
+                  help="number of records removed per $in remove")
+    op.add_option('--max_fraction', dest="max_fraction", action="store", type=float, default=0.05,
+                  help="delete nothing if more than this fraction of the subject collection would be deleted")
+    op.add_option('--max_deletions', dest="max_deletions", action="store", type=int, default=None,
+                  help="delete nothing if more than this many records would be deleted; overrides --max_fraction")
+    op.add_option('--also', dest="also", action="append", choices=DELETE_TARGETS,
+                  help="also delete the records from %s (repeatable)" % ', '.join(DELETE_TARGETS))
+    op.add_option('--chunk_size', dest="chunk_size", action="store", type=int, default=1000,
+                  help="number of bibcodes handed to a worker at a time")
     op.add_option('-l','--limit', dest='limit', action='store',
         help='process this many', type=int, default=None)
     op.add_option('-d','--debug', dest="debug", action="store_true", default=False)
@@ -11,56 +11,119 @@ import itertools
 import traceback
 from datetime import datetime
 from optparse import OptionParser
-from multiprocessing import Process, JoinableQueue, Lock, Manager
 
-from adsdata import utils, models
-from adsdata.extractors import Extractor
+from adsdata import utils, models, fulltext_segments, pdf_rpc, http_fetch
+from adsdata.extractors import Extractor, HttpExtractor, PdfExtractor, ExtractionPlanner
+from adsdata.workqueue import ChunkWorker, WorkQueue
 
 config = utils.load_config()
 commands = utils.commandList()
 log = logging.getLogger()
 
-class ExtractWorker(Process):
+class ExtractWorker(ChunkWorker):
     
-    def __init__(self, queue, opts, thread_lock, stats, updates):
-        Process.__init__(self)
-        self.queue = queue
-        self.stats = stats
-        self.updates = updates
+    # keep collecting pdf extraction replies while waiting for work
+    idle_timeout = 1
+    
+    def __init__(self, work, opts):
+        ChunkWorker.__init__(self, work)
         self.opts = opts
-        self.thread_lock = thread_lock
         
-    def run(self):
-        while True:
-            ft_item = self.queue.get()
-            if ft_item is None:
-                self.queue.task_done()
-                break
-            ext = None
-
+    def setup(self):
+        self.pdf_client = pdf_rpc.get_client(config)
+        # the extractors all fetch through this, sharing the http limits with the other workers
+        http_fetch.get_fetcher(config, processes=self.opts.threads)
+        
+    def handle(self, chunk_id, ft_items):
+        """
+        extracts items that ExtractionPlanner has already found to need it.
+        Http sources are fetched concurrently and PDFs are sent off to the
+        PDFBox workers without waiting for the text to come back; the chunk
+        is acknowledged once all of it has.
+        """
+        # the extra pending count is for the chunk itself
+        task = {'id': chunk_id, 'pending': 1, 'updates': [],
+                'stats': {'processed': 0, 'exceptions': 0, 'skipped': 0}}
+        extractors = []
+        for ft_item in ft_items:
             try:
-                ext = Extractor.factory(*ft_item)
+                ext = Extractor.from_item(ft_item, config)
                 if self.opts.dry_run:
                     ext.dry_run = True
-                    
-                self.thread_lock.acquire()
-                try:
-                    if not self.opts.force and not ext.needs_extraction(self.opts.force_older_than):
-                        continue # note: the finally clause is still executed
-                finally:
-                    self.thread_lock.release()
-                
-                updated = ext.extract(clobber=self.opts.clobber)
-                if updated:
-                    self.updates.append(ext.bibcode)
-                
+                extractors.append(ext)
             except Exception, e:
-                bibcode, ft_source, provider = ft_item
-                log.error("something went wrong extracting %s: %s", bibcode, traceback.format_exc())
-                self.stats['exceptions'] += 1
-            finally:
-                self.stats['processed'] += 1
-                self.queue.task_done()
+                log.error("something went wrong extracting %s: %s", ft_item[0], traceback.format_exc())
+                task['stats']['exceptions'] += 1
+                task['stats']['processed'] += 1
+        
+        # fetch the chunk's http sources concurrently, only the changed ones
+        # come back with content
+        http = [ext for ext in extractors if isinstance(ext, HttpExtractor) and not ext.source_loaded]
+        if len(http):
+            HttpExtractor.load_sources(http, config, self.opts.force, self.opts.force_older_than)
+            
+        for ext in extractors:
+            if isinstance(ext, HttpExtractor) and ext.not_modified:
+                task['stats']['skipped'] += 1
+                continue
+            try:
+                if isinstance(ext, PdfExtractor) and not ext.source_loaded:
+                    task['pending'] += 1
+                    try:
+                        self.pdf_client.submit(ext.bibcode, ext.ft_source, self.pdf_done(task, ext))
+                    except:
+                        task['pending'] -= 1
+                        raise
+                    continue
+            except Exception, e:
+                log.error("something went wrong extracting %s: %s", ext.bibcode, traceback.format_exc())
+                task['stats']['exceptions'] += 1
+                task['stats']['processed'] += 1
+                continue
+            self.extract(task, ext)
+        self.finish(task)
+        
+    def extract(self, task, ext):
+        try:
+            if ext.extract(clobber=self.opts.clobber):
+                task['updates'].append(ext.bibcode)
+        except Exception, e:
+            log.error("something went wrong extracting %s: %s", ext.bibcode, traceback.format_exc())
+            task['stats']['exceptions'] += 1
+        finally:
+            task['stats']['processed'] += 1
+            
+    def pdf_done(self, task, ext):
+        """
+        the pdf_rpc callback for a PDF of a chunk
+        """
+        def callback(body, error):
+            if error is None:
+                ext.set_source(body)
+                self.extract(task, ext)
+            else:
+                log.error("something went wrong extracting %s: %s", ext.bibcode, error)
+                task['stats']['exceptions'] += 1
+                task['stats']['processed'] += 1
+            self.finish(task)
+        return callback
+    
+    def finish(self, task):
+        task['pending'] -= 1
+        if not task['pending']:
+            self.ack(task['id'], task['stats'], task['updates'])
+            
+    def idle(self):
+        self.pdf_client.poll(0)
+
+    def teardown(self):
+        # wait for the outstanding PDFs, then commit whatever has been 
+        # packed into the last segment
+        try:
+            self.pdf_client.drain()
+        finally:
+            pdf_rpc.close_client()
+            fulltext_segments.close_writers()
 
 
 def get_ft_items(opts):
@@ -77,45 +140,31 @@ def get_ft_items(opts):
 @commands
 def extract(opts):
     
-    tasks = JoinableQueue()
-    manager = Manager()
-    stats = manager.dict()
-    updates = manager.list()
-    stats['processed'] = 0
-    stats['exceptions'] = 0
-    
     log.info("Reading input list of bibcodes to be processed")
     items = get_ft_items(opts)
     print items
     log.info("Read %d records from %s" %(len(items), opts.infile))
 
-    # start up our builder threads
+    # find out what needs extracting before starting any extractors
+    log.info("Checking which records need extracting with %d threads" % opts.planners)
+    planner = ExtractionPlanner(opts.planners, opts.force, opts.force_older_than, config)
+    items = planner.plan(items)
+    
+    # start up our extractor processes
     log.info("Creating %d extractor processes" % opts.threads)
     
-    thread_lock = Lock()
-    workers = [ ExtractWorker(tasks, opts, thread_lock, stats, updates) for i in xrange(opts.threads)]
-    for w in workers:
-        w.start()
+    work = WorkQueue(chunk_size=opts.chunk_size)
+    work.add_workers(ExtractWorker(work, opts) for i in xrange(opts.threads))
         
-    # queue up the bibcodes
-    for item in items:
-        tasks.put(item)
-    
-    # add some poison pills to the end of the queue
-    log.info("poisoning our task threads")
-    for i in xrange(opts.threads):
-        tasks.put(None)
-    
-    # join the results queue. this should
-    # block until all tasks in the task queue are completed
-    log.info("Joining the task queue")
-    
-    log.info("Joining the task threads")
-    for w in workers:
-        w.join()
+    # hand out the items in chunks; blocks until every chunk is acknowledged
+    stats = work.run(items)
+    updates = work.output
         
+    log.info("up to date: %d" % (planner.stats['skipped'] + stats['skipped']))
     log.info("processed: %d" % stats['processed'])
-    log.info("exceptions: %d" % stats['exceptions'])
+    log.info("exceptions: %d" % (stats['exceptions'] + planner.stats['exceptions']))
+    for first, error in work.failed:
+        log.error("chunk starting with %s failed: %s" % (first, error))
     log.info("updated: (%d) %s" % (len(updates), ', '.join(updates)))
     
     log.info("All work complete")
@@ -145,6 +194,10 @@ if __name__ == '__main__':
         help='generate docs w/ last generated prior to date in format %Y-%m-%d %H:%M:%S %Z')
     op.add_option('-t','--threads', dest='threads', action='store', type=int,
         help='number of threads to use for extracting (default=12)', default=13)
+    op.add_option('--chunk_size', dest='chunk_size', action='store', type=int,
+        help='number of records handed to an extractor at a time', default=10)
+    op.add_option('--planners', dest='planners', action='store', type=int,
+        help='number of threads checking which records need extracting', default=16)
     op.add_option('--pygraph', dest='pygraph', action='store_true',
         help='capture exec profile in a call graph image', default=False)
     opts, args = op.parse_args()
@@ -10,30 +10,25 @@ import itertools
 from itertools import imap, islice, ifilter
 from optparse import OptionParser
 from pymongo import MongoClient
-from multiprocessing import Process, JoinableQueue, Manager
 
-from adsdata import utils
+from adsdata import utils, fulltext_meta
+from adsdata.workqueue import ChunkWorker, WorkQueue
 
 config = utils.load_config()
 commands = utils.commandList()
 log = logging.getLogger()
 
-class Worker(Process):
-    def __init__(self, queue, opts, stats):
-        Process.__init__(self)
+class Worker(ChunkWorker):
+    def __init__(self, work, opts):
+        ChunkWorker.__init__(self, work)
         self.opts = opts
-        self.queue = queue
-        self.stats = stats
     
-    def run(self):
-        while True:
-            doc = self.queue.get()
-            if doc is None:
-                log.debug("Nothing left to do for worker %s", self.name)
-                self.queue.task_done()
-                break
+    def process_chunk(self, docs):
+        stats = {'processed': 0, 'missing': 0}
+        rows = []
+        for doc in docs:
 
-            self.stats['processed'] += 1
+            stats['processed'] += 1
             log.info("Worker %s is working on %s", self.name, doc['bibcode'])
             
             extract_dir = config['FULLTEXT_EXTRACT_PATH'] + ptree.id2ptree(doc['bibcode'])
@@ -41,18 +36,11 @@ class Worker(Process):
             log.debug("meta path: %s", meta_path)
             
             # dry-run testing
-#            self.queue.task_done()
 #            continue
          
             if not os.path.exists(extract_dir):
                 log.debug("no existing extract dir for %s", doc['bibcode'])
-                self.stats['missing'] += 1
-                self.queue.task_done()
-                continue
-            
-            if os.path.exists(meta_path) and not self.opts.force:
-                log.debug("found existing meta file for %s", doc['bibcode'])
-                self.queue.task_done()
+                stats['missing'] += 1
                 continue
             
             meta = {
@@ -61,6 +49,16 @@ class Worker(Process):
                 'index_date': doc['index_date']
                 }
             
+            if self.opts.store:
+                # written to the meta store by the parent process
+                meta['last_extracted'] = doc['_generated']
+                rows.append((doc['bibcode'], meta))
+                continue
+            
+            if os.path.exists(meta_path) and not self.opts.force:
+                log.debug("found existing meta file for %s", doc['bibcode'])
+                continue
+            
             log.debug("writing meta file for %s", doc['bibcode'])
             with open(meta_path,'w') as f:
                 json.dump(meta, f)
@@ -68,8 +66,35 @@ class Worker(Process):
             mtime = time.mktime(doc['_generated'].timetuple())
             log.debug("setting mtime for %s to %s, %s", meta_path, doc['_generated'], mtime)
             os.utime(meta_path, (mtime, mtime))
+        return {'stats': stats, 'output': rows}
             
-            self.queue.task_done()
+class MigrateWorker(ChunkWorker):
+    """
+    reads the existing meta.json files of a chunk of docs for the meta store
+    """
+    def process_chunk(self, docs):
+        stats = {'processed': 0, 'missing': 0}
+        rows = []
+        for doc in docs:
+            stats['processed'] += 1
+            extract_dir = config['FULLTEXT_EXTRACT_PATH'] + ptree.id2ptree(doc['bibcode'])
+            meta_path = os.path.join(extract_dir, 'meta.json')
+            try:
+                with open(meta_path, 'r') as f:
+                    meta = json.load(f)
+                meta['last_extracted'] = utils.mod_time(meta_path)
+            except IOError:
+                log.debug("no meta file for %s", doc['bibcode'])
+                stats['missing'] += 1
+                continue
+            try:
+                if not meta.get('ft_source', 'http').lower().startswith('http'):
+                    sources = re.split('\s*,\s*', meta['ft_source'])
+                    meta['source_mtime'] = max(utils.mod_time(sf) for sf in sources)
+            except OSError:
+                pass
+            rows.append((doc['bibcode'], meta))
+        return {'stats': stats, 'output': rows}
             
 def get_docs(opts):
     """
@@ -105,47 +130,53 @@ def get_docs(opts):
             continue
         yield doc
         
+def store_rows(opts):
+    """
+    an on_output callback writing (bibcode, meta) rows to the meta store
+    """
+    store = fulltext_meta.get_store(config)
+    if store is None:
+        raise Exception("FULLTEXT_META_DB is not configured")
+    return lambda rows: store.put_many(rows, replace=opts.force)
+
 @commands
 def init(opts):
 
-    tasks = JoinableQueue()
-    manager = Manager()
-    stats = manager.dict()
-    stats['processed'] = 0
-    stats['missing'] = 0
-    
     # start up our workers threads
     log.info("Creating %d workers" % opts.threads)
     
-    workers = [ Worker(tasks, opts, stats) for i in xrange(opts.threads)]
-    for w in workers:
-        w.start()
+    opts.store = fulltext_meta.get_store(config) is not None
+    work = WorkQueue(chunk_size=opts.chunk_size, on_output=opts.store and store_rows(opts) or None)
+    work.add_workers(Worker(work, opts) for i in xrange(opts.threads))
         
-    # queue up the bibcodes
-    for doc in get_docs(opts):
-        tasks.put(doc)
-    
-    # add some poison pills to the end of the queue
-    log.info("poisoning our task threads")
-    for i in xrange(opts.threads):
-        tasks.put(None)
-    
-    # join the results queue. this should
-    # block until all tasks in the task queue are completed
-    log.info("Joining the task queue")
-    tasks.join()
-    
-    log.info("Joining the task threads")
-    for w in workers:
-        w.join()
+    # hand out the docs in chunks; blocks until every chunk is acknowledged
+    stats = work.run(get_docs(opts))
         
     log.info("processed: %d" % stats['processed'])
     log.info("records with no existing extract dir: %d" % stats['missing'])        
+    for first, error in work.failed:
+        log.error("chunk starting with %s failed: %s", first['bibcode'], error)
+    
+@commands
+def migrate(opts):
+    """
+    copy existing meta.json files into the FULLTEXT_META_DB meta store
+    """
+    on_output = store_rows(opts)
+    log.info("Creating %d workers" % opts.threads)
+    work = WorkQueue(chunk_size=opts.chunk_size, on_output=on_output)
+    work.add_workers(MigrateWorker(work) for i in xrange(opts.threads))
+    stats = work.run(get_docs(opts))
+    
+    log.info("processed: %d" % stats['processed'])
+    log.info("records with no meta file: %d" % stats['missing'])        
+    for first, error in work.failed:
+        log.error("chunk starting with %s failed: %s", first['bibcode'], error)
     
 if __name__ == '__main__':
 
     op = OptionParser()
-    op.set_usage("usage: index.py [options] ")
+    op.set_usage("usage: init_fulltext_meta.py [options] [%s]" % '|'.join(commands.map.keys()))
     op.add_option('-v','--verbose', dest='verbose', action='store_true',
         help='write log output to stdout', default=False)
     op.add_option('-d','--debug', dest='debug', action='store_true',
@@ -161,8 +192,10 @@ if __name__ == '__main__':
         help='mongo database name. "docs" collection is assumed')
     op.add_option('-i','--infile', dest='infile', action='store', type=str,
         help='path to input bibcodes file')
+    op.add_option('--chunk_size', dest='chunk_size', action='store', type=int,
+        help='number of docs handed to a worker at a time', default=100)
     op.add_option('--force', dest='force', action='store_true',
-        help='overwrite any existing meta files', default=False)
+        help='overwrite any existing meta files or stored meta', default=False)
     
     opts, args = op.parse_args()
 
@@ -6,6 +6,7 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import time
 import shutil
 import logging
+import traceback
 from optparse import OptionParser
 from multiprocessing import Pool, current_process, cpu_count
 
@@ -28,12 +29,95 @@ def copy_source(data_file, temp_dir):
         log.error("Failed copying source file %s to %s", (data_file, temp_path))
         raise    
 
+def update_index(model_class, session, data_file):
+    """
+    rebuild the indexes derived from a freshly loaded collection now rather
+    than leaving it to the first process that needs them
+    """
+    log = logging.getLogger()
+    try:
+        model_class.update_indexes(session, data_file)
+    except Exception, e:
+        log.error("failed indexing %s: %s", model_class.config_collection_name, traceback.format_exc())
+
 def load_data(update_args):
-    model_class, data_file, batch_size = update_args
+    model_class, data_file, batch_size, stream_aggregate, load_id = update_args
     log = logging.getLogger()
     log.debug("thread '%s' working on %s" % (current_process().name, model_class))
     session = utils.get_session(config)
-    model_class.load_data(session, data_file, batch_size=batch_size)
+    if model_class.load_data(session, data_file, batch_size=batch_size, stream_aggregate=stream_aggregate, load_id=load_id):
+        update_index(model_class, session, data_file)
+    
+def load_chunk(chunk_args):
+    model_class, data_file, start, end, batch_size, stream_aggregate = chunk_args
+    log = logging.getLogger()
+    log.debug("thread '%s' working on %s, bytes %d-%s" % (current_process().name, model_class, start, end))
+    session = utils.get_session(config)
+    try:
+        model_class.load_chunk(session, data_file, start, end, batch_size=batch_size, stream_aggregate=stream_aggregate)
+        return True
+    except Exception, e:
+        log.error("failed loading bytes %d-%s of %s: %s", start, end, data_file, traceback.format_exc())
+        return False
+
+def sync_incremental(update_args):
+    model_class, data_file, batch_size, load_id, touched_file = update_args
+    log = logging.getLogger()
+    log.debug("thread '%s' incrementally syncing %s" % (current_process().name, model_class))
+    session = utils.get_session(config)
+    try:
+        touched = model_class.sync_incremental(session, data_file, batch_size=batch_size, load_id=load_id)
+    except Exception, e:
+        log.error("failed syncing %s: %s", model_class.config_collection_name, traceback.format_exc())
+        return
+    update_index(model_class, session, data_file)
+    if touched is None:
+        log.info("%s was fully reloaded", model_class.config_collection_name)
+        return
+    log.info("writing %d touched bibcodes to %s", len(touched), touched_file)
+    with open(touched_file, 'w') as f:
+        for bibcode in touched:
+            print >>f, bibcode.encode('utf-8')
+
+def finish_load(finish_args):
+    model_class, data_file, batch_size, dlt, stream_aggregate, load_id = finish_args
+    session = utils.get_session(config)
+    model_class.finish_load(session, dlt, stream_aggregate=stream_aggregate)
+    model_class.record_changes(session, data_file, load_id, batch_size)
+    update_index(model_class, session, data_file)
+
+def load_data_chunked(update_args, opts):
+    """
+    split each data file into chunks that get loaded by a pool of worker
+    processes; a collection only gets post-processed & swapped in once 
+    every one of its chunks has loaded successfully
+    """
+    log = logging.getLogger()
+    session = utils.get_session(config)
+    
+    tasks = []
+    load_times = {}
+    for model_class, data_file, batch_size, stream_aggregate, load_id in update_args:
+        # calculate the last_synced timestamp before loading starts
+        load_times[model_class] = model_class.new_load_time()
+        model_class.load_collection(session).drop()
+        chunks = model_class.file_chunks(data_file, opts.chunks)
+        log.info("loading %s in %d chunks" % (model_class.config_collection_name, len(chunks)))
+        for start, end in chunks:
+            tasks.append((model_class, data_file, start, end, batch_size, stream_aggregate))
+    
+    p = Pool(max(opts.threads, 1))
+    results = p.map(load_chunk, tasks)
+    failed = set(task[0] for task, ok in zip(tasks, results) if not ok)
+    
+    finish_args = []
+    for model_class, data_file, batch_size, stream_aggregate, load_id in update_args:
+        if model_class in failed:
+            log.error("not swapping in %s; one or more chunks failed to load" % model_class.config_collection_name)
+            model_class.load_collection(session).drop()
+            continue
+        finish_args.append((model_class, data_file, batch_size, load_times[model_class], stream_aggregate, load_id))
+    p.map(finish_load, finish_args)
     
 def get_models(opts, config):
     for model_class in models.data_file_models():
@@ -56,21 +140,33 @@ def sync(opts, config):
         
     session = utils.get_session(config)
     
+    # all the loads done by this run get journaled under the same load id
+    load_id = models.new_load_id()
+    log.info("load id: %s" % load_id)
+    
     update_args = []
     for model_class, data_file in get_models(opts, config):
         if model_class.needs_sync(session, data_file) or opts.force:
             log.info("%s needs synching" % model_class.config_collection_name)
             data_file = copy_source(data_file, config['ADSDATA_TMP_DIR'])
-            update_args.append((model_class, data_file, config['ADSDATA_MONGO_DATA_LOAD_BATCH_SIZE']))
+            update_args.append((model_class, data_file, config['ADSDATA_MONGO_DATA_LOAD_BATCH_SIZE'], opts.stream_aggregate, load_id))
         else:
             log.info("%s does not need syncing" % model_class.config_collection_name)
-    if opts.threads > 0:
+    if opts.incremental:
+        touched_dir = config['ADSDATA_TMP_DIR'] or '.'
+        incremental_args = [(model_class, data_file, batch_size, load_id,
+                             os.path.join(touched_dir, "%s.touched" % model_class.config_collection_name))
+                            for model_class, data_file, batch_size, stream_aggregate, load_id in update_args]
+        p = Pool(max(opts.threads, 1))
+        p.map(sync_incremental, incremental_args)
+    elif opts.chunks > 1:
+        load_data_chunked(update_args, opts)
+    elif opts.threads > 0:
         p = Pool(opts.threads)
         p.map(load_data, update_args)
     else:
-        for cls, data_file, batch_size in update_args:
-            data_file = copy_source(data_file, config['ADSDATA_TMP_DIR'])
-            load_data((cls, data_file, batch_size))
+        for args in update_args:
+            load_data(args)
         
 @commands
 def status(opts, config):
@@ -91,6 +187,13 @@ if __name__ == "__main__":
     op.add_option('-c','--collection', dest="collection", action="append", default=[])
     op.add_option('-t','--threads', dest="threads", action="store", type=int, default=int(cpu_count() / 2))
     op.add_option('-f','--force', dest="force", action="store_true", default=False)
+    op.add_option('-s','--stream_aggregate', dest="stream_aggregate", action="store_true", default=False,
+        help='aggregate sorted data files while loading instead of using map-reduce')
+    op.add_option('-k','--chunks', dest="chunks", action="store", type=int, default=1,
+        help='split each data file into this many chunks and load them in parallel')
+    op.add_option('-i','--incremental', dest="incremental", action="store_true", default=False,
+        help='only apply the differences from the previously loaded (sorted) data files; '
+             'the touched bibcodes are written to ADSDATA_TMP_DIR/<collection>.touched')
     op.add_option('-d','--debug', dest="debug", action="store_true", default=False)
     op.add_option('-v','--verbose', dest="verbose", action="store_true", default=False)
     opts, args = op.parse_args() 
@@ -7,6 +7,7 @@ Created on Oct 25, 2012
 import os
 import sys
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
 
 
 if sys.version_info < (2,7):
@@ -16,6 +17,7 @@ else:
 
 import pytz
 import tempfile
+import itertools
 import mongobox
 
 import subprocess
@@ -26,10 +28,15 @@ from datetime import datetime, timedelta
 from mongoalchemy import fields
 from mock import patch
 from contextlib import contextmanager
+from optparse import Values
 
 from adsdata import models, utils
 from adsdata.session import *
 from adsdata.models import DataFileCollection
+from adsdata.workqueue import ChunkWorker, WorkQueue
+from adsdata import metrics_engine, membership, fulltext_meta, fulltext_segments
+
+import deletions
 
 class BasicCollection(models.DataFileCollection):
     config_collection_name = 'adsdata_test'
@@ -50,6 +57,7 @@ class AggregatedCollection(models.DataFileCollection):
     foo = fields.StringField(_id=True)
     bar = fields.ListField(fields.StringField())
     aggregated = True
+    aggregate_field = 'bar'
     field_order = [foo, bar]
     
     @classmethod
@@ -190,6 +198,119 @@ class TestDataCollection(AdsdataTestCase):
         self.assertTrue(entry_a is not None)
         self.assertEqual(entry_a.bar, ["1","2"])
         
+    def test_load_data_stream_aggregated(self):
+        tmp = tempfile.NamedTemporaryFile()
+        for pair in zip("aabbbcdd","12345678"):
+            print >>tmp, "%s\t%s" % pair
+        tmp.flush()
+        AggregatedCollection.load_data(self.session, tmp.name, stream_aggregate=True)
+        self.assertEqual(self.session.query(AggregatedCollection).count(), 4)
+        collection = self.session.get_collection('adsdata_test')
+        self.assertEqual(collection.find_one({'_id': 'b'}), {'_id': 'b', 'bar': ["3","4","5"]})
+        self.assertEqual(collection.find_one({'_id': 'c'}), {'_id': 'c', 'bar': ["6"]})
+        
+    def test_load_data_stream_aggregated_unsorted(self):
+        tmp = tempfile.NamedTemporaryFile()
+        for pair in zip("aabba","12345"):
+            print >>tmp, "%s\t%s" % pair
+        tmp.flush()
+        AggregatedCollection.load_data(self.session, tmp.name, stream_aggregate=True)
+        self.assertEqual(self.session.query(AggregatedCollection).count(), 0)
+        self.assertTrue(AggregatedCollection.last_synced(self.session) is None)
+        
+    def test_file_chunks(self):
+        tmp = tempfile.NamedTemporaryFile()
+        for pair in zip("aaabbbbcddddde","12345678901234"):
+            print >>tmp, "%s\t%s" % pair
+        tmp.flush()
+        for cls in [BasicCollection, AggregatedCollection]:
+            chunks = cls.file_chunks(tmp.name, 4)
+            self.assertEqual(chunks[0][0], 0)
+            self.assertEqual(chunks[-1][1], None)
+            lines = []
+            with open(tmp.name) as fh:
+                for start, end in chunks:
+                    chunk = list(cls.read_lines(fh, start, end))
+                    if cls.aggregated and len(lines):
+                        # groups of lines are never split across chunks
+                        self.assertNotEqual(chunk[0][0], lines[-1][0])
+                    lines.extend(chunk)
+            self.assertEqual(''.join(lines), open(tmp.name).read())
+        
+    def test_load_chunks(self):
+        tmp = tempfile.NamedTemporaryFile()
+        for pair in zip("aabbbcdd","12345678"):
+            print >>tmp, "%s\t%s" % pair
+        tmp.flush()
+        dlt = AggregatedCollection.new_load_time()
+        for start, end in AggregatedCollection.file_chunks(tmp.name, 3):
+            AggregatedCollection.load_chunk(self.session, tmp.name, start, end, stream_aggregate=True)
+        AggregatedCollection.finish_load(self.session, dlt, stream_aggregate=True)
+        self.assertEqual(self.session.query(AggregatedCollection).count(), 4)
+        self.assertTrue(AggregatedCollection.last_synced(self.session) is not None)
+        
+    def test_sync_incremental(self):
+        tmp = tempfile.NamedTemporaryFile()
+        for pair in zip("aabbbcdd","12345678"):
+            print >>tmp, "%s\t%s" % pair
+        tmp.flush()
+        # first time through there's nothing to diff against
+        self.assertEqual(AggregatedCollection.sync_incremental(self.session, tmp.name), None)
+        self.assertEqual(self.session.query(AggregatedCollection).count(), 4)
+        
+        tmp = tempfile.NamedTemporaryFile()
+        for pair in zip("aabbcddde","12346789X"):
+            print >>tmp, "%s\t%s" % pair
+        tmp.flush()
+        touched = AggregatedCollection.sync_incremental(self.session, tmp.name)
+        self.assertEqual(touched, ['b', 'd', 'e'])
+        collection = self.session.get_collection('adsdata_test')
+        self.assertEqual(collection.count(), 5)
+        self.assertEqual(collection.find_one({'_id': 'b'}), {'_id': 'b', 'bar': ["3","4"]})
+        self.assertEqual(collection.find_one({'_id': 'e'}), {'_id': 'e', 'bar': ["X"]})
+        
+        tmp = tempfile.NamedTemporaryFile()
+        for pair in zip("aabbcddde","12346789X")[:6]:
+            print >>tmp, "%s\t%s" % pair
+        tmp.flush()
+        touched = AggregatedCollection.sync_incremental(self.session, tmp.name)
+        self.assertEqual(touched, ['d', 'e'])
+        self.assertEqual(collection.find_one({'_id': 'e'}), None)
+        self.assertEqual(collection.find_one({'_id': 'd'}), {'_id': 'd', 'bar': ["7"]})
+        
+    def test_load_journal(self):
+        tmp = tempfile.NamedTemporaryFile()
+        for pair in zip("aabbbcdd","12345678"):
+            print >>tmp, "%s\t%s" % pair
+        tmp.flush()
+        AggregatedCollection.load_data(self.session, tmp.name, stream_aggregate=True, load_id='20150101000000')
+        # nothing to compare against on the first load
+        self.assertEqual(models.journal_bibcodes(self.session, '20150101000000'), None)
+        
+        tmp = tempfile.NamedTemporaryFile()
+        for pair in zip("aabbbcde","12345679"):
+            print >>tmp, "%s\t%s" % pair
+        tmp.flush()
+        AggregatedCollection.load_data(self.session, tmp.name, stream_aggregate=True, load_id='20150102000000')
+        self.assertEqual(models.journal_bibcodes(self.session, '20150102000000'), set(['d', 'e']))
+        
+        # changes to references affect the papers they cite
+        models.record_load_journal(self.session, '20150103000000', 'references', ['1983ARA&A..21..373O'])
+        changed = models.journal_bibcodes(self.session, '20150103000000')
+        self.assertIn('1983ARA&A..21..373O', changed)
+        self.assertIn('1920ApJ....51....4D', changed)
+        changed = models.journal_bibcodes(self.session, '20150103000000', neighbours=False)
+        self.assertEqual(changed, set(['1983ARA&A..21..373O']))
+        
+    def test_aggregate_records(self):
+        records = [{'load_key': 'a', 'agency': 'NASA', 'grant': '1'},
+                   {'load_key': 'a', 'agency': 'NSF', 'grant': '2'},
+                   {'load_key': 'b', 'agency': 'NSF', 'grant': '3'}]
+        self.assertEqual(list(models.Grants.aggregate_records(records)), [
+            {'_id': 'a', 'grants': [{'agency': 'NASA', 'grant': '1'}, {'agency': 'NSF', 'grant': '2'}]},
+            {'_id': 'b', 'grants': [{'agency': 'NSF', 'grant': '3'}]}
+            ])
+        
     def test_coerce_types(self):
         
         class CoerceCollection(models.DataFileCollection):
@@ -217,6 +338,23 @@ class TestDataCollection(AdsdataTestCase):
             cls.coerce_types(rec)
             self.assertEqual(rec, expected)
 
+    def test_row_decoder(self):
+        decode = BasicCollection.row_decoder()
+        self.assertEqual(decode("a\t1\n"), {"_id": "a", "bar": 1})
+        self.assertEqual(decode("a\n"), {"_id": "a", "bar": ""})
+        self.assertEqual(decode("\t6\r\n"), {"_id": "", "bar": 6})
+        self.assertEqual(decode("a\t1\tx\n"), {"_id": "a", "bar": 1})
+        self.assertEqual(decode("\n"), None)
+        
+        decode = NamedRestKeyCollection.row_decoder()
+        self.assertEqual(decode("a\t1\tw\t5\n"), {"_id": "a", "bar": 1, "baz": ["w", "5"]})
+        
+        decode = AggregatedCollection.row_decoder()
+        self.assertEqual(decode("a\t1\n"), {"load_key": "a", "bar": "1"})
+        
+        decode = models.Reads.row_decoder()
+        self.assertEqual(decode("1920ApJ....51....4D\t0\t5\t3\n"), {"_id": "1920ApJ....51....4D", "reads": [0, 5, 3]})
+        
     def test_mapreduce_listify(self):
         source = self.session.get_collection("mapreduce_source")
         source.insert({"foo": "a", "bar": "z"})
@@ -325,6 +463,17 @@ class TestDocs(AdsdataTestCase):
                                })
         self.helper_check_collection_not_made(doc)
 
+
+    def test_generate_docs_many(self):
+        load_data(self.config)
+        bibcodes = ["2012AJ....144...41M", "1874MNRAS..34..279L", "2011AJ....142...62H", "1999abcd.1234..111Q"]
+        docs = list(self.session.generate_docs(bibcodes))
+        self.assertEqual([x['_id'] for x in docs], bibcodes)
+        for doc in docs:
+            self.assertEqual(doc, self.session.generate_doc(doc['_id']))
+        # fetching and assembling can be done separately
+        sources = self.session.fetch_docs_sources(bibcodes)
+        self.assertEqual(list(self.session.assemble_docs(bibcodes, sources)), docs)
         
     def test_build_docs(self):
         load_data(self.config)
@@ -425,6 +574,109 @@ class TestDocs(AdsdataTestCase):
         # datetime value should not have been updated
         self.assertEqual(existing_dt, unmodified_doc['_dt'])
         
+    def test_store_many(self):
+        load_data(self.config)
+        existing_doc = self.session.get_doc("1999abcd.1234..111Q")
+        modified_doc = self.session.get_doc("1999abcd.1234..111Q")
+        modified_doc['abcd'] = 1234
+        new_doc = {"_id": "2000abcd..123..456A", "foo": "bar"}
+        
+        stats = self.session.store_many([existing_doc, new_doc], self.session.docs)
+        self.assertEqual(stats['unchanged'], 1)
+        self.assertEqual(stats['inserted'], 1)
+        self.assertEqual(stats['updated'], 0)
+        self.assertEqual(stats['changed'], ["2000abcd..123..456A"])
+        stored_doc = self.session.get_doc(new_doc['_id'], manipulate=False)
+        self.assertIn("_dt", stored_doc)
+        self.assertEqual(stored_doc['_digest'], record_digest({"_id": "2000abcd..123..456A", "foo": "bar"}, self.session.db))
+        
+        stats = self.session.store_many([modified_doc], self.session.docs)
+        self.assertEqual(stats['updated'], 1)
+        self.assertEqual(stats['changed'], ["1999abcd.1234..111Q"])
+        self.assertEqual(self.session.get_doc("1999abcd.1234..111Q")['abcd'], 1234)
+        
+    def test_record_digest(self):
+        import json, hashlib
+        doc = {"_id": "2000abcd..123..456A", "_digest": "foo", "title": [u"\u00fcber"], 
+               "citations": ["a", "b"], "metrics": {"z": 1.5, "a": None}}
+        legacy = dict((k,v) for k,v in doc.items() if not k.startswith('_'))
+        legacy = hashlib.sha1(json.dumps(legacy, sort_keys=True)).hexdigest()
+        self.assertEqual(record_digest(doc, self.session.db), legacy)
+        crc = record_digest(doc, self.session.db, 'crc32')
+        self.assertTrue(crc.startswith('crc32:'))
+        self.assertEqual(digest_hashtype(crc), 'crc32')
+        self.assertEqual(digest_hashtype(legacy), 'sha1')
+        self.assertTrue(same_content(doc, legacy, self.session.db))
+        
+    def test_digest_upgrade(self):
+        new_doc = {"_id": "2000abcd..123..456A", "foo": "bar"}
+        self.session.store(dict(new_doc), self.session.docs)
+        stored_doc = self.session.get_doc(new_doc['_id'], manipulate=False)
+        self.assertEqual(digest_hashtype(stored_doc['_digest']), 'sha1')
+        
+        self.session.digest_hashtype = 'crc32'
+        self.assertFalse(self.session.store(dict(new_doc), self.session.docs))
+        upgraded_doc = self.session.get_doc(new_doc['_id'], manipulate=False)
+        self.assertEqual(upgraded_doc['_digest'], record_digest(new_doc, self.session.db, 'crc32'))
+        # datetime value should not have been updated
+        self.assertEqual(upgraded_doc['_dt'], stored_doc['_dt'])
+        
+        self.session.digest_hashtype = 'md5'
+        stats = self.session.store_many([dict(new_doc)], self.session.docs)
+        self.assertEqual(stats['unchanged'], 1)
+        self.assertEqual(stats['upgraded'], 1)
+        self.assertEqual(stats['changed'], [])
+        
+    def test_raw_session(self):
+        self.session = utils.get_session(self.config, raw=True)
+        collection_a = self.session.get_collection('test_a')
+        collection_a.insert([{"_id": 1, "foo": "bar"}, {"_id": 2, "foo": "baz"}])
+        docs = [{"_id": "2000abcd..123..456A", "foo": DBRef(collection="test_a", id=1)},
+                {"_id": "2000abcd..123..457A", "foo": DBRef(collection="test_a", id=2)}]
+        self.assertTrue(self.session.store(dict(docs[0]), self.session.docs))
+        self.session.store_many([dict(docs[1])], self.session.docs)
+        
+        stored_doc = self.session.get_doc(docs[0]['_id'], manipulate=False)
+        self.assertIn("_dt", stored_doc)
+        self.assertEqual(stored_doc['_digest'], record_digest(docs[0], self.session.db))
+        self.assertIsInstance(stored_doc['foo'], DBRef)
+        # an empty ref_docs falls back to dereferencing
+        self.assertEqual(record_digest(docs[0], self.session.db, ref_docs={}), stored_doc['_digest'])
+        
+        with patch('adsdata.session.MONGO_DOCS_DEREF_FIELDS', [('docs', 'foo')]):
+            doc = self.session.get_doc(docs[0]['_id'])
+            self.assertEqual(doc, {"_id": "2000abcd..123..456A", "foo": "bar"})
+            found = list(self.session.find_docs({'_id': {'$in': [x['_id'] for x in docs]}}, page_size=1))
+            self.assertEqual(sorted(x['foo'] for x in found), ["bar", "baz"])
+        
+    def test_dereferencing_cursor(self):
+        collection_a = self.session.get_collection('test_a')
+        collection_a.insert([{"_id": 1, "foo": "bar"}, {"_id": 2, "foo": "baz"}])
+        for i in range(5):
+            self.session.store({"_id": "2000abcd..123..45%dA" % i, 
+                                "foo": DBRef(collection="test_a", id=i % 2 + 1)}, self.session.docs)
+        with patch('adsdata.session.MONGO_DOCS_DEREF_FIELDS', [('docs', 'foo')]):
+            cursor = self.session.find_docs({'_id': {'$regex': '^2000abcd'}}, page_size=2)
+            docs = list(cursor.sort('_id', 1))
+        self.assertIsInstance(cursor, DereferencingCursor)
+        self.assertEqual([x['foo'] for x in docs], ["bar", "baz", "bar", "baz", "bar"])
+        self.assertNotIn('_digest', docs[0])
+        self.assertEqual(len(cursor.cache.entries), 2)
+        
+        ref_docs = fetch_ref_docs(self.session.db, [{"foo": DBRef(collection="test_a", id=1)}])
+        self.assertEqual(ref_docs, {("test_a", 1): {"_id": 1, "foo": "bar"}})
+        self.assertEqual(record_digest({"foo": DBRef(collection="test_a", id=1)}, self.session.db, ref_docs=ref_docs),
+                         record_digest({"foo": "bar"}, self.session.db))
+        
+    def test_ref_cache(self):
+        cache = RefCache(size=2)
+        cache.put(('a', 1), {'_id': 1})
+        cache.put(('a', 2), {'_id': 2})
+        cache.get(('a', 1))
+        cache.put(('a', 3), {'_id': 3})
+        self.assertIsNone(cache.get(('a', 2)))
+        self.assertEqual(cache.get(('a', 1)), {'_id': 1})
+        
 class TestMetrics(AdsdataTestCase):        
     
     def test_generate_metrics_data(self):
@@ -454,6 +706,95 @@ class TestMetrics(AdsdataTestCase):
                                                      u'2001': 0.070302403721891962,
                                                      u'2011': 0.27030240372189196}
                                })
+    def test_generate_metrics_data_chunked(self):
+        load_data(self.config)
+        doc = self.session.generate_metrics_data("1920ApJ....51....4D")
+        chunked = {'_id': "1920ApJ....51....4D"}
+        models.Citations.add_metrics_data(chunked, self.session, "1920ApJ....51....4D", chunk_size=2)
+        for k in chunked:
+            self.assertEqual(chunked[k], doc[k])
+
+    def test_generate_metrics_data_many(self):
+        load_data(self.config)
+        bibcodes = ["2011foobar........X", "1920ApJ....51....4D"]
+        docs = list(self.session.generate_metrics_data_many(bibcodes))
+        self.assertEqual([x['_id'] for x in docs], bibcodes)
+        for doc in docs:
+            self.assertEqual(doc, self.session.generate_metrics_data(doc['_id']))
+
+    def test_membership_index(self):
+        load_data(self.config)
+        bibcodes = ["2011foobar........X", "1920ApJ....51....4D"]
+        expected = list(self.session.generate_metrics_data_many(bibcodes))
+        
+        index_dir = tempfile.mkdtemp()
+        self.session.index_dir = index_dir
+        self.session.index_bloom_bits = 10
+        # never loaded, so no index
+        self.assertIsNone(models.Refereed.membership_index(self.session))
+        
+        dlt = models.Refereed.new_load_time()
+        self.session.update(dlt, models.DataLoadTime.collection == 'refereed', upsert=True)
+        index = models.Refereed.membership_index(self.session)
+        self.assertIn("1920ApJ....51....4D", index)
+        self.assertNotIn("2011foobar........X", index)
+        self.assertEqual(len(index), self.session.get_collection('refereed').count())
+        self.assertIs(models.Refereed.membership_index(self.session), index)
+        self.assertEqual(list(self.session.generate_metrics_data_many(bibcodes)), expected)
+        
+        # a new load time means a new index
+        dlt = models.Refereed.new_load_time()
+        dlt.last_synced += timedelta(seconds=1)
+        self.session.update(dlt, models.DataLoadTime.collection == 'refereed', upsert=True)
+        self.assertIsNot(models.Refereed.membership_index(self.session), index)
+        
+    def test_reference_counts(self):
+        load_data(self.config)
+        bibcodes = ["2011foobar........X", "1920ApJ....51....4D"]
+        expected = list(self.session.generate_metrics_data_many(bibcodes))
+        
+        self.session.index_dir = tempfile.mkdtemp()
+        self.assertIsNone(models.References.reference_counts(self.session))
+        dlt = models.References.new_load_time()
+        self.session.update(dlt, models.DataLoadTime.collection == 'references', upsert=True)
+        counts = models.References.reference_counts(self.session)
+        for entry in self.session.get_collection('references').find():
+            self.assertEqual(counts.get(entry['_id']), len(entry['references']))
+        self.assertIsNone(counts.get("2011foobar........Y"))
+        self.assertEqual(list(self.session.generate_metrics_data_many(bibcodes)), expected)
+        
+    @unittest.skipIf(metrics_engine.numpy is None, "numpy is not installed")
+    def test_metrics_engine(self):
+        load_data(self.config)
+        bibcodes = [x['_id'] for x in self.session.get_collection('citations').find()]
+        bibcodes.append("2011foobar........Y")
+        expected = list(self.session.generate_metrics_data_many(bibcodes))
+        # a bibcode without a year fails on its own
+        engine = metrics_engine.MetricsEngine(self.session, bibcodes[:2] + ["xxxxfoobar........Z"] + bibcodes[2:], 
+                                              chunk_size=2)
+        records = list(itertools.chain(*engine.records(chunk_size=3)))
+        self.assertEqual(records, expected)
+        self.assertEqual(engine.failed, ["xxxxfoobar........Z"])
+        
+        # the same with the reference counts & refereed ids from their indexes
+        self.session.index_dir = tempfile.mkdtemp()
+        for model in (models.References, models.Refereed):
+            dlt = model.new_load_time()
+            self.session.update(dlt, models.DataLoadTime.collection == model.config_collection_name, upsert=True)
+        engine = metrics_engine.MetricsEngine(self.session, bibcodes)
+        self.assertEqual(list(itertools.chain(*engine.records())), expected)
+        
+    @unittest.skipIf(metrics_engine.numpy is None, "numpy is not installed")
+    def test_segmented_cumsum(self):
+        values = [0.1, 0.2, 0.3, 0.7, 0.11, 0.13]
+        sums = metrics_engine.segmented_cumsum(values, metrics_engine.numpy.array([0, 3, 3, 4, 6]))
+        self.assertEqual(sums.tolist(), [0.1, 0.1 + 0.2, 0.1 + 0.2 + 0.3, 0.7, 0.11, 0.11 + 0.13])
+
+    def test_get_entries(self):
+        load_data(self.config)
+        entries = models.Refereed.get_entries(self.session, ["1920ApJ....51....4D", "2011foobar........X"], chunk_size=1)
+        self.assertEqual(entries.keys(), ["1920ApJ....51....4D"])
+
     def test_build_metrics_data(self):
         load_data(self.config)
         self.session.store(self.session.generate_metrics_data("1920ApJ....51....4D"), self.session.metrics_data)
@@ -462,5 +803,277 @@ class TestMetrics(AdsdataTestCase):
         self.assertEqual(doc['refereed_citation_num'], 4)
         self.assertEqual(doc['refereed'], True)
 
+class EvenWorker(ChunkWorker):
+    
+    def process_chunk(self, chunk):
+        if 42 in chunk:
+            raise Exception("bad chunk")
+        return {'stats': {'even': len([x for x in chunk if x % 2 == 0])}, 
+                'output': [x for x in chunk if x % 10 == 0]}
+    
+class TestWorkQueue(unittest.TestCase):
+    
+    def test_work_queue(self):
+        work = WorkQueue(chunk_size=7)
+        work.add_workers(EvenWorker(work) for i in xrange(3))
+        stats = work.run(xrange(100))
+        self.assertEqual(stats['chunks'], 15)
+        self.assertEqual(stats['items'], 100)
+        self.assertEqual(stats['failed_chunks'], 1)
+        # the failed chunk is 42-48
+        self.assertEqual(stats['even'], 50 - 4)
+        self.assertEqual(sorted(work.output), [0, 10, 20, 30, 40, 50, 60, 70, 80, 90])
+        self.assertEqual([x[0] for x in work.failed], [42])
+        
+class TestBuilder(unittest.TestCase):
+    
+    def setUp(self):
+        import build_docs
+        self.build_docs = build_docs
+        
+    def test_stage(self):
+        import Queue
+        inbox, outbox, errors = Queue.Queue(), Queue.Queue(), []
+        def func(x):
+            if x == 3:
+                raise Exception("bad item")
+            return x * 2 if x % 2 else None
+        stage = self.build_docs.Stage('test', func, inbox, outbox, threads=2, 
+                                      on_error=lambda item, error: errors.append(item))
+        stage.start()
+        for i in xrange(6):
+            inbox.put(i)
+        stage.stop()
+        self.assertEqual(sorted(outbox.get_nowait() for i in xrange(outbox.qsize())), [2, 10])
+        self.assertEqual(errors, [3])
+        
+    def test_builder(self):
+        import Queue
+        def fetch_docs_sources(bibcodes):
+            if 'B1' in bibcodes:
+                raise Exception("fetch failed")
+        def store_many(docs, collection):
+            if 'C2' in [x['_id'] for x in docs]:
+                raise Exception("store failed")
+            return {'inserted': len(docs), 'updated': 0, 'unchanged': 0, 'conflicts': 0, 'changed': []}
+        def save_metrics_records(records):
+            if 'E4' in [x['_id'] for x in records]:
+                raise Exception("save failed")
+            return {'inserted': len(records), 'updated': 0, 'unchanged': 0, 
+                    'failed': [x['_id'] for x in records if x['_id'] == 'D3']}
+        
+        work = type('Work', (), {'results': Queue.Queue()})
+        with patch.object(self.build_docs, 'config', {}, create=True):
+            with patch.object(self.build_docs.utils, 'get_session') as get_session:
+                with patch.object(self.build_docs.psql_session, 'Session') as psql:
+                    # one thread per stage keeps the chunks in order
+                    builder = self.build_docs.Builder(work, publish_to_solr=False, fetchers=1, writers=1)
+        session = get_session.return_value
+        session.fetch_docs_sources.side_effect = fetch_docs_sources
+        session.assemble_docs.side_effect = lambda bibs, sources: [{'_id': x} for x in bibs]
+        session.assemble_metrics_data.side_effect = lambda bibs, sources: [{'_id': x} for x in bibs]
+        session.store_many.side_effect = store_many
+        psql.return_value.save_metrics_records.side_effect = save_metrics_records
+        builder.psql['payload_size'] = 2
+        
+        chunks = [['A0', 'A0b'], ['B1'], ['C2'], ['D3', 'D3b'], ['E4']]
+        builder.setup()
+        for chunk_id, chunk in enumerate(chunks):
+            builder.handle(chunk_id, chunk)
+        builder.teardown()
+        
+        acks = [work.results.get_nowait() for i in xrange(work.results.qsize())]
+        # each chunk acknowledged exactly once
+        self.assertEqual(sorted(x[0] for x in acks), range(len(chunks)))
+        acks = dict((x[0], x) for x in acks)
+        self.assertIsNone(acks[0][3])
+        self.assertEqual(acks[0][1], {'inserted': 2, 'updated': 0, 'unchanged': 0, 'conflicts': 0, 'metrics': 2})
+        self.assertIn('fetch failed', acks[1][3])
+        self.assertIn('store failed', acks[2][3])
+        self.assertIsNone(acks[3][3])
+        self.assertEqual(acks[3][1]['metrics_failed'], 1)
+        self.assertIn('save failed', acks[4][3])
+
+class TestMembership(unittest.TestCase):
+    
+    def test_file_keys(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(" a\t0\na\t1\r\na\t2\nb \t3\n\nc\n")
+            f.flush()
+            keys = list(membership.file_keys(f.name))
+            # the same keys the loader would use as _ids
+            with open(f.name) as fh:
+                self.assertEqual(keys, [key for key, lines in BasicCollection.read_groups(fh)])
+        self.assertEqual(keys, [' a', 'a', 'b ', 'c'])
+
+class TestMergeMissing(unittest.TestCase):
+    
+    def test_merge_missing(self):
+        merge = lambda s, a: list(deletions.merge_missing(iter(s), iter(a)))
+        self.assertEqual(merge([], []), [])
+        self.assertEqual(merge([], ['a', 'b']), [])
+        self.assertEqual(merge(['a', 'b'], []), ['a', 'b'])
+        # interleaved
+        self.assertEqual(merge(['a', 'c', 'e', 'g'], ['b', 'c', 'd', 'g']), ['a', 'e'])
+        # trailing subject ids
+        self.assertEqual(merge(['a', 'b', 'x', 'y'], ['a', 'b', 'c']), ['x', 'y'])
+        # trailing authority ids
+        self.assertEqual(merge(['b', 'c'], ['a', 'c', 'x', 'y', 'z']), ['b'])
+        self.assertEqual(merge(['a', 'b'], ['a', 'b']), [])
+
+class TestPsqlSession(unittest.TestCase):
+    
+    def setUp(self):
+        from adsdata import psql_session, psql_models
+        with patch.object(psql_models.Base.metadata, 'create_all'):
+            with patch('adsdata.psql_session.create_engine'):
+                with patch('adsdata.psql_session.sessionmaker'):
+                    self.psql = psql_session.Session()
+        self.current = {'A': {'bibcode': 'A', 'citation_num': 1, 'refereed': True},
+                        'B': {'bibcode': 'B', 'citation_num': 1, 'refereed': True}}
+        self.records = [{'_id': 'A', 'citation_num': 1},
+                        {'_id': 'B', 'citation_num': 2},
+                        {'_id': 'C', 'citation_num': 1, 'refereed': False},
+                        {'_id': 'C', 'citation_num': 3}]
+        
+    def save(self, upsert):
+        with patch.object(self.psql, 'current_metrics', return_value=self.current):
+            with patch.object(self.psql, 'upsert_metrics', side_effect=upsert) as upsert_metrics:
+                result = self.psql.save_metrics_records(self.records)
+        return result, [[row['bibcode'] for row in c[0][0]] for c in upsert_metrics.call_args_list]
+        
+    def test_save_metrics_records(self):
+        upserted = []
+        result, calls = self.save(upserted.extend)
+        self.assertEqual(result, {'unchanged': 1, 'inserted': 1, 'updated': 1, 'failed': []})
+        self.assertEqual(len(calls), 1)
+        # the last record of a bibcode wins
+        self.assertEqual(sorted((row['bibcode'], row['citation_num'], 'refereed' in row) for row in upserted),
+                         [('B', 2, False), ('C', 3, False)])
+        self.assertEqual(self.psql.session.commit.call_count, 1)
+        
+        self.current['B']['citation_num'] = 2
+        self.current['C'] = {'bibcode': 'C', 'citation_num': 3, 'refereed': False}
+        result, calls = self.save(None)
+        self.assertEqual(result, {'unchanged': 3, 'inserted': 0, 'updated': 0, 'failed': []})
+        self.assertEqual(calls, [])
+        
+    def test_save_retry(self):
+        from sqlalchemy.exc import SQLAlchemyError
+        def upsert(rows):
+            if 'B' in [row['bibcode'] for row in rows]:
+                raise SQLAlchemyError("bad record")
+        result, calls = self.save(upsert)
+        self.assertEqual(result, {'unchanged': 1, 'inserted': 1, 'updated': 0, 'failed': ['B']})
+        # the batch, then one at a time
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(sorted(calls[1:]), [['B'], ['C']])
+        self.assertEqual(self.psql.session.rollback.call_count, 2)
+        self.assertEqual(self.psql.session.commit.call_count, 1)
+        
+    def test_upsert_metrics(self):
+        from sqlalchemy.dialects import postgresql
+        self.psql.upsert_metrics([{'bibcode': 'A', 'citation_num': 1},
+                                  {'bibcode': 'B', 'citation_num': 2},
+                                  {'bibcode': 'C', 'refereed': True}])
+        statements = [str(c[0][0].compile(dialect=postgresql.dialect())) 
+                      for c in self.psql.session.execute.call_args_list]
+        self.assertEqual(len(statements), 2)
+        # columns missing from a row are left alone
+        by_rows = dict((stmt.count('%(bibcode_m'), stmt) for stmt in statements)
+        self.assertIn('SET citation_num = excluded.citation_num', by_rows[2])
+        self.assertNotIn('refereed', by_rows[2])
+        self.assertIn('SET refereed = excluded.refereed', by_rows[1])
+        self.assertNotIn('citation_num', by_rows[1])
+        for stmt in statements:
+            self.assertIn('ON CONFLICT (bibcode) DO UPDATE', stmt)
+
+class TestDeletions(AdsdataTestCase):
+    
+    def setUp(self):
+        AdsdataTestCase.setUp(self)
+        self.subject = self.session.get_collection('test_subject')
+        self.authority = self.session.get_collection('test_authority')
+        self.subject.insert([{'_id': '2000abcd..123..%03dA' % i} for i in xrange(40)])
+        self.authority.insert([{'_id': '2000abcd..123..%03dA' % i} for i in xrange(40) if i % 10])
+        self.authority.insert([{'_id': '2001abcd..123..%03dA' % i} for i in xrange(5)])
+        self.missing = ['2000abcd..123..%03dA' % i for i in xrange(0, 40, 10)]
+        
+    def opts(self, **kwargs):
+        opts = dict(subject='test_subject', authority='test_authority', threads=2, chunk_size=3,
+                    index=False, merge=False, limit=None, batch_size=2, max_fraction=0.5, max_deletions=None, also=None)
+        opts.update(kwargs)
+        return Values(opts)
+        
+    def test_find_deletions(self):
+        self.assertEqual(sorted(deletions.find_deletions(self.opts(), self.config)), self.missing)
+        self.assertEqual(list(deletions.find_deletions_merged(self.opts(), self.config)), self.missing)
+        self.assertEqual(list(deletions.get_deletions(self.opts(merge=True), self.config)), 
+                         sorted(deletions.get_deletions(self.opts(), self.config)))
+        self.assertEqual(list(deletions.find_deletions_merged(self.opts(limit=15), self.config)), self.missing[:2])
+        
+    def test_delete(self):
+        import ptree, shutil
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.config['FULLTEXT_EXTRACT_PATH'] = tmp_dir + '/'
+        self.config['FULLTEXT_META_DB'] = os.path.join(tmp_dir, 'meta.db')
+        self.config['FULLTEXT_SEGMENT_PATH'] = tmp_dir
+        kept = '2000abcd..123..001A'
+        meta_store = fulltext_meta.get_store(self.config)
+        writer = fulltext_segments.get_writer(self.config)
+        for bib in self.missing + [kept]:
+            os.makedirs(tmp_dir + '/' + ptree.id2ptree(bib))
+            meta_store.put(bib, {'ft_source': '/foo/bar.txt'})
+            writer.append(bib, {'fulltext': u'foo'})
+        writer.commit()
+        self.session.metrics_data.insert([{'_id': x['_id']} for x in self.subject.find()])
+        
+        opts = self.opts(also=['metrics_data', 'metrics', 'fulltext'])
+        with patch('adsdata.psql_session.Session') as psql:
+            deleter = deletions.Deleter(opts, self.config)
+            with patch.object(deleter, 'delete_batch', wraps=deleter.delete_batch) as delete_batch:
+                deletions.find_deletions(opts, self.config, on_output=deleter.add)
+                # nothing goes until everything has been found
+                self.assertEqual(self.subject.count(), 40)
+                deleter.finish()
+        self.assertEqual([len(c[0][0]) for c in delete_batch.call_args_list], [2, 2])
+        self.assertEqual(deleter.count, 4)
+        deleted = [bib for c in psql.return_value.delete_metrics_records.call_args_list for bib in c[0][0]]
+        self.assertEqual(sorted(deleted), self.missing)
+        psql.return_value.close.assert_called_once_with()
+        for collection in (self.subject, self.session.metrics_data):
+            self.assertEqual(collection.count(), 36)
+            self.assertEqual(collection.find({'_id': {'$in': self.missing}}).count(), 0)
+        self.assertFalse(any(os.path.exists(tmp_dir + '/' + ptree.id2ptree(bib)) for bib in self.missing))
+        self.assertTrue(os.path.isdir(tmp_dir + '/' + ptree.id2ptree(kept)))
+        self.assertEqual(meta_store.get_many(self.missing + [kept]).keys(), [kept])
+        segments = fulltext_segments.SegmentStore(tmp_dir)
+        self.assertEqual([bib for bib, contents in segments.records()], [kept])
+        segments.close()
+        fulltext_segments.close_writers()
+        
+    def test_delete_limit(self):
+        # 4 of 40 is more than 5%
+        for merge in (False, True):
+            self.assertRaises(deletions.DeletionLimitExceeded, deletions.delete, 
+                              self.opts(merge=merge, max_fraction=0.05), self.config)
+            self.assertEqual(self.subject.count(), 40)
+        # nor does an empty authority get anything deleted
+        self.authority.remove()
+        self.assertRaises(deletions.DeletionLimitExceeded, deletions.delete, 
+                          self.opts(max_fraction=0.5), self.config)
+        self.assertEqual(self.subject.count(), 40)
+        
+        # a collection too small for its fraction to be a whole record loses none
+        small = self.session.get_collection('test_small')
+        small.insert([{'_id': '2000abcd..123..%03dA' % i} for i in xrange(9, 12)])
+        self.assertRaises(deletions.DeletionLimitExceeded, deletions.delete, 
+                          self.opts(subject='test_small', max_fraction=0.05), self.config)
+        self.assertEqual(small.count(), 3)
+        # unless it's allowed to explicitly
+        deletions.delete(self.opts(subject='test_small', max_fraction=0.05, max_deletions=1), self.config)
+        self.assertEqual(sorted(x['_id'] for x in small.find()), ['2000abcd..123..009A', '2000abcd..123..011A'])
+        
 if __name__ == '__main__':
     unittest.main()
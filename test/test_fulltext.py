@@ -7,8 +7,20 @@ if sys.version_info < (2,7):
     import unittest2 as unittest
 else:
     import unittest
-    
-from adsdata import extractors, utils
+
+import gc
+import json
+import time
+import weakref
+import shutil
+import tempfile
+import threading
+from mock import patch
+from datetime import datetime
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from adsdata import extractors, fulltext_meta, fulltext_segments, pdf_rpc, http_fetch, utils
 base_dir = utils.get_script_path(file_name_space=__file__)
 config_file = os.path.join(base_dir, 'adsdata.cfg.test')
 config = utils.load_config(config_file)
@@ -52,5 +64,320 @@ class TestExtraction(unittest.TestCase):
 
         self.assertEqual(contents['dataset'], expected_output)
 
+class TestExtractionPlanner(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.config = dict(config, FULLTEXT_EXTRACT_PATH=os.path.join(self.tmp, 'extracted') + '/')
+        
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        
+    def source(self, name, age=0):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            f.write("some text")
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+        
+    def test_plan(self):
+        old = ('2000xxx..999..0001L', self.source('old.txt', age=86400 * 3), 'Foo')
+        new = ('2000xxx..999..0002L', self.source('new.txt'), 'Foo')
+        missing = ('2000xxx..999..0003L', os.path.join(self.tmp, 'missing.txt'), 'Foo')
+        for item in (old, missing):
+            ext = extractors.Extractor.factory(*(item + (self.config,)))
+            ext.init_path()
+            ext.write_meta({'ft_source': item[1], 'provider': item[2]})
+            
+        planner = extractors.ExtractionPlanner(threads=2, config=self.config)
+        self.assertEqual(planner.plan([old, new, missing]), [new])
+        self.assertEqual(dict(planner.stats), {'planned': 1, 'skipped': 1, 'exceptions': 1})
+        
+        planner = extractors.ExtractionPlanner(threads=2, force=True, config=self.config)
+        self.assertEqual(planner.plan([old, new]), [old, new])
+        
+    def test_plan_meta_store(self):
+        self.config['FULLTEXT_META_DB'] = os.path.join(self.tmp, 'meta.db')
+        old = ('2000xxx..999..0001L', self.source('old.txt', age=86400 * 3), 'Foo')
+        new = ('2000xxx..999..0002L', self.source('new.txt'), 'Foo')
+        ext = extractors.Extractor.factory(*(old + (self.config,)))
+        self.assertIsNone(ext.last_extracted)
+        self.assertTrue(ext.extract())
+        self.assertFalse(os.path.exists(ext.meta_path))
+        
+        stored = fulltext_meta.get_store(self.config).get(old[0])
+        self.assertEqual(stored['ft_source'], old[1])
+        self.assertEqual(stored['source_mtime'], utils.mod_time(old[1]))
+        self.assertIsNotNone(stored['last_extracted'])
+        
+        planner = extractors.ExtractionPlanner(threads=2, config=self.config)
+        self.assertEqual(planner.plan([old, new]), [new])
+        self.assertEqual(dict(planner.stats), {'planned': 1, 'skipped': 1})
+        
+        store = fulltext_meta.get_store(self.config)
+        self.assertEqual(store.delete_many([old[0], new[0]]), 1)
+        self.assertIsNone(store.get(old[0]))
+        self.assertEqual(planner.plan([old]), [old])
+        
+    def test_packed_output(self):
+        self.config['FULLTEXT_META_DB'] = os.path.join(self.tmp, 'meta.db')
+        self.config['FULLTEXT_SEGMENT_PATH'] = os.path.join(self.tmp, 'segments')
+        os.mkdir(self.config['FULLTEXT_SEGMENT_PATH'])
+        item = ('2000xxx..999..0001L', self.source('old.txt'), 'Foo')
+        ext = extractors.Extractor.factory(*(item + (self.config,)))
+        self.assertTrue(ext.extract())
+        self.assertFalse(os.path.exists(ext.extract_dir))
+        extracted = datetime.now()
+        # the pending segment holds on to nothing of the extractor
+        ext = weakref.ref(ext)
+        gc.collect()
+        self.assertIsNone(ext())
+        
+        # nothing is visible, or recorded as extracted, until the segment is committed
+        store = fulltext_segments.SegmentStore(self.config['FULLTEXT_SEGMENT_PATH'])
+        self.assertIsNone(store.get(item[0]))
+        self.assertIsNone(fulltext_meta.get_store(self.config).get(item[0]))
+        time.sleep(0.01)
+        fulltext_segments.close_writers()
+        store.refresh()
+        self.assertEqual(store.get(item[0]), {'fulltext': u'some text'})
+        # but it's recorded as extracted when it was, not when it was committed
+        stored = fulltext_meta.get_store(self.config).get(item[0])
+        self.assertTrue(stored['last_extracted'] <= extracted)
+        self.assertEqual(stored['source_mtime'], utils.mod_time(item[1]))
+        
+    def test_from_item(self):
+        item = ('2000xxx..999..0002L', self.source('new.txt'), 'Foo')
+        ext = extractors.Extractor.from_item(item, self.config)
+        self.assertTrue(isinstance(ext, extractors.PlainTextExtractor))
+        self.assertFalse(ext.source_loaded)
+        self.assertEqual(ext.get_contents(), {'fulltext': u'some text'})
+
+class TestFulltextSegments(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        
+    def test_segments(self):
+        committed = []
+        writer = fulltext_segments.SegmentWriter(self.tmp, segment_size=100)
+        writer.append('2000A', {'fulltext': u'first'}, on_commit=lambda: committed.append('A'))
+        writer.append('2000B', {'fulltext': u'b', 'dataset': [u'x']})
+        self.assertEqual(committed, [])
+        writer.append('2000C', {'fulltext': os.urandom(50).encode('hex')})
+        self.assertEqual(committed, ['A'])
+        writer.append('2000A', {'fulltext': u'second'})
+        writer.close()
+        
+        store = fulltext_segments.SegmentStore(self.tmp)
+        self.assertEqual(len(store.segments), 2)
+        self.assertEqual(store.get('2000A'), {'fulltext': u'second'})
+        self.assertEqual(store.get('2000B'), {'fulltext': u'b', 'dataset': [u'x']})
+        self.assertIsNone(store.get('2000D'))
+        self.assertEqual(sorted(b for b, c in store.records()), ['2000A', '2000B', '2000C'])
+        self.assertEqual(dict(store.records())['2000A'], {'fulltext': u'second'})
+        
+        writer = fulltext_segments.SegmentWriter(self.tmp)
+        writer.delete('2000B')
+        writer.close()
+        store.refresh()
+        self.assertIsNone(store.get('2000B'))
+        self.assertEqual(sorted(b for b, c in store.records()), ['2000A', '2000C'])
+
+class FakeChannel(object):
+    """
+    a stand-in for a pika channel to the PDF workers, which reply to the
+    requests whose bibcodes are in self.answer
+    """
+    def __init__(self):
+        self.is_open = True
+        self.connection = self
+        self.answer = set()
+        self.requests = []
+        
+    def queue_declare(self, exclusive=False):
+        return type('Result', (), {'method': type('Method', (), {'queue': 'replies'})})
+    
+    def basic_consume(self, callback, no_ack=False, queue=None):
+        self.callback = callback
+        return 'consumer'
+        
+    def basic_publish(self, exchange, routing_key, properties, body):
+        self.requests.append((properties, json.loads(body)))
+        
+    def process_data_events(self, time_limit=0):
+        requests, self.requests = self.requests, []
+        for properties, body in requests:
+            if body['bibcode'] in self.answer:
+                self.callback(self, None, properties, json.dumps({'fulltext': body['bibcode']}))
+            else:
+                self.requests.append((properties, body))
+
+class TestPdfRpc(unittest.TestCase):
+    
+    def test_in_flight(self):
+        channel = FakeChannel()
+        replies = {}
+        def done(body, error):
+            replies[json.loads(body)['fulltext']] = error
+        with patch.object(utils, 'rabbitmq_channel', return_value=channel):
+            client = pdf_rpc.PdfRpcClient('extract_pdf', max_in_flight=2)
+            client.submit('2000A', 'a.pdf', done)
+            client.submit('2000B', 'b.pdf', done)
+            self.assertEqual(len(channel.requests), 2)
+            channel.answer.update(['2000A', '2000B', '2000C'])
+            # waits for a free slot
+            client.submit('2000C', 'c.pdf', done)
+            self.assertEqual(sorted(replies), ['2000A', '2000B'])
+            client.drain()
+            self.assertEqual(sorted(replies), ['2000A', '2000B', '2000C'])
+            self.assertEqual(client.call('2000A', 'a.pdf'), json.dumps({'fulltext': '2000A'}))
+            
+    def test_timeout(self):
+        channel = FakeChannel()
+        with patch.object(utils, 'rabbitmq_channel', return_value=channel):
+            client = pdf_rpc.PdfRpcClient('extract_pdf', timeout=0, retries=2)
+            self.assertRaises(pdf_rpc.PdfRequestTimeout, client.call, '2000A', 'a.pdf')
+            # the first attempt and two retries, each with its own correlation id
+            self.assertEqual(len(set(p.correlation_id for p, body in channel.requests)), 3)
+
+class FulltextHandler(BaseHTTPRequestHandler):
+    """
+    serves /<name> as the text "<name> fulltext", with an ETag, to http/1.1
+    clients, recording each request's path, headers & client port
+    """
+    protocol_version = 'HTTP/1.1'
+    
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers), self.client_address[1]))
+        etag = '"%s"' % self.path
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = '%s fulltext' % self.path[1:]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+        
+    def log_message(self, *args):
+        pass
+        
+class FulltextServer(ThreadingMixIn, HTTPServer):
+    # a thread per kept alive connection
+    daemon_threads = True
+    
+class TestHttpFetch(unittest.TestCase):
+    
+    def setUp(self):
+        self.server = FulltextServer(('127.0.0.1', 0), FulltextHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base_url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        
+    def test_conditional(self):
+        fetcher = http_fetch.HttpFetcher(http_fetch.ValidatorStore(), connections_per_host=1)
+        url = self.base_url + 'a'
+        res = fetcher.fetch(url, conditional=True)
+        self.assertEqual((res.status, res.content), (200, 'a fulltext'))
+        # nothing to go on until the validators have been saved
+        self.assertEqual(fetcher.fetch(url, conditional=True).status, 200)
+        fetcher.save_validators(url, res.validators)
+        self.assertEqual(fetcher.fetch(url, conditional=True).status, 304)
+        self.assertEqual(fetcher.fetch(url).status, 200)
+        # all over one kept alive connection
+        self.assertEqual(len(set(port for path, headers, port in self.server.requests)), 1)
+        
+    def test_fetch_many(self):
+        fetcher = http_fetch.HttpFetcher(rate=20, threads=4)
+        urls = [self.base_url + name for name in 'abcdef']
+        start = time.time()
+        results = fetcher.fetch_many(urls + ['http://127.0.0.1:1/nothing'])
+        # six requests to the one host, at most 20/sec
+        self.assertTrue(time.time() - start >= 0.25)
+        self.assertEqual([res.content for res, error in results[:-1]], 
+                         ['%s fulltext' % name for name in 'abcdef'])
+        self.assertEqual(results[-1][0], None)
+        self.assertTrue(results[-1][1] is not None)
+        
+    def test_get_fetcher(self):
+        http_fetch._fetchers.pop(os.getpid(), None)
+        self.addCleanup(http_fetch._fetchers.pop, os.getpid(), None)
+        with patch.object(http_fetch.log, 'warning') as warning:
+            fetcher = http_fetch.get_fetcher({'FULLTEXT_HTTP_RATE': 10, 'FULLTEXT_HTTP_CONNECTIONS': 4,
+                                              'FULLTEXT_HTTP_THREADS': '2'}, processes=8)
+        self.assertEqual((fetcher.rate, fetcher.connections_per_host, fetcher.threads), (1.25, 1, 2))
+        # eight processes with a connection each is more than the four allowed
+        self.assertEqual(warning.call_count, 1)
+        self.assertIs(http_fetch.get_fetcher({}), fetcher)
+        # without a validators db only If-Modified-Since is sent
+        url = self.base_url + 'a'
+        fetcher.save_validators(url, {'etag': '"/a"', 'last_modified': None})
+        headers = fetcher.request_headers(url, True, datetime(2000, 1, 1))
+        self.assertNotIn('If-None-Match', headers)
+        self.assertEqual(headers['If-Modified-Since'], http_fetch.http_date(datetime(2000, 1, 1)))
+        
+    def test_http_extractor(self):
+        fetcher = http_fetch.HttpFetcher(http_fetch.ValidatorStore())
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        ext_config = dict(config, FULLTEXT_EXTRACT_PATH=tmp_dir)
+        url = self.base_url + 'b'
+        with patch.object(http_fetch, 'get_fetcher', return_value=fetcher):
+            ext = extractors.Extractor.factory('2000xxx..999..1234L', url, 'Foo', ext_config)
+            extractors.HttpExtractor.load_sources([ext], ext_config)
+            self.assertTrue(ext.source_loaded)
+            ext.extract()
+            self.assertEqual(fetcher.validators.get(url)['etag'], '"/b"')
+            ext = extractors.Extractor.factory('2000xxx..999..1234L', url, 'Foo', ext_config)
+            self.assertFalse(ext.needs_extraction())
+        self.assertEqual(self.server.requests[-1][1].get('if-none-match'), '"/b"')
+
+    def close_connections(self, fetcher):
+        for pool in fetcher.pools.values():
+            while not pool.empty():
+                for conn in pool.get().connections.values():
+                    conn.close()
+
+    def test_planned_fetches(self):
+        fetcher = http_fetch.HttpFetcher(http_fetch.ValidatorStore())
+        self.addCleanup(self.close_connections, fetcher)
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        ext_config = dict(config, FULLTEXT_EXTRACT_PATH=tmp_dir)
+        items = [['2000xxx..999..%04dL' % i, self.base_url + name, 'Foo'] for i, name in enumerate('cd')]
+        def run(force=False):
+            # as the planner and the extract workers go about it
+            planned = extractors.ExtractionPlanner(2, force, None, ext_config).plan(items)
+            exts = [extractors.Extractor.from_item(x, ext_config) for x in planned]
+            extractors.HttpExtractor.load_sources(exts, ext_config, force)
+            for ext in exts:
+                if not ext.not_modified:
+                    ext.extract()
+            return [ext.not_modified for ext in exts]
+        with patch.object(http_fetch, 'get_fetcher', return_value=fetcher):
+            self.assertEqual(run(), [False, False])
+            self.assertEqual(run(), [True, True])
+            self.assertEqual(run(force=True), [False, False])
+        # a single GET per url each run, the second a conditional one
+        paths = [path for path, headers, port in self.server.requests]
+        self.assertEqual((paths.count('/c'), paths.count('/d')), (3, 3))
+        conditional = [path for path, headers, port in self.server.requests if 'if-none-match' in headers]
+        self.assertEqual(sorted(conditional), ['/c', '/d'])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file